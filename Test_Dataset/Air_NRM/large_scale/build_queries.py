@@ -14,19 +14,40 @@ already clears 100.
 Capacity consumption per product is set from the observed fare ladder — see
 CONSUMPTION below.
 
-Run:  python sq_direct_2city3/build_queries.py
+Run:  python build_queries.py                      # the shipped 15-query file
+
+The ladder can also be given on the command line, to generate load-test sets
+far larger than the shipped one::
+
+    python build_queries.py --ladder 26x8,98x29 -o q.csv
+    python build_queries.py --ladder 200x60*5000 --per-query-seed \\
+        --workers 8 --quiet -o query_loadtest.csv
+
+``PAIRSxODS`` is one query with that many departures over that many ODs;
+``*N`` repeats it. Queries are written to CSV in chunks as they are generated,
+so the file never has to fit in memory. With the default ladder and seed the
+output is byte-identical to ``query_largescale_CA.csv``.
 """
 
 from __future__ import annotations
 
+import argparse
 import random
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
 _HERE = Path(__file__).resolve().parent
 OUT = _HERE / "query_largescale_CA.csv"
 
+sys.path.insert(0, str(_HERE / "w_transformer"))
+from choice_sets import WINDOWS, load_grid  # noqa: E402
+
 SEED = 20250729
 
 # ── products, cheapest to dearest ─────────────────────────────────────────────
@@ -113,11 +134,8 @@ def load_pool() -> tuple[dict[str, list[str]], list[tuple[str, str]]]:
         .drop_duplicates()
         .merge(usable, on=["Oneway_OD", "Departure Time"], how="inner")
     )
-    by_od: dict[str, list[str]] = {}
-    for od, time in zip(pairs["Oneway_OD"], pairs["Departure Time"]):
-        by_od.setdefault(od, []).append(time)
-    for od in by_od:
-        by_od[od].sort()
+    by_od = {od: sorted(g) for od, g in
+             pairs.groupby("Oneway_OD", sort=False)["Departure Time"]}
     return by_od, list(zip(pairs["Oneway_OD"], pairs["Departure Time"]))
 
 
@@ -146,22 +164,41 @@ def zero_ratio_pairs(by_od: dict[str, list[str]]) -> list[tuple[str, str]]:
     Their term drops out of the balance constraint entirely — the same edge case
     the reference labels carry (``('B','A')`` Eco_lite at 15:40). Keeping at
     least one per query preserves it at the new scale.
+
+    Read off the compiled grid (``choice_sets.load_grid``) with one mask over
+    all ODs, in ``v2.csv`` row order and then departure order.
     """
-    v2 = pd.read_csv(_HERE / "v2.csv")
-    cells = [c for c in v2.columns if c not in ("OD Pairs", "no_purchase")]
-    out = []
-    for _, row in v2.iterrows():
-        od = row["OD Pairs"]
-        if od not in by_od:
-            continue
-        windows = {c.split("*")[1] for c in cells if float(row[c]) == 0.0}
-        out += [(od, t) for t in by_od[od] if window_of(t) in windows]
-    return out
+    grid = load_grid()
+    zero = (grid["V2"] == 0.0).any(axis=1)            # (n_od, window)
+    row_of = {od: i for i, od in enumerate(grid["od_labels"])}
+
+    ods = [od for od in by_od if od in row_of]
+    times = [t for od in ods for t in by_od[od]]
+    if not times:
+        return []
+    row = np.repeat([row_of[od] for od in ods], [len(by_od[od]) for od in ods])
+    t = pd.Series(times)
+    minutes = (t.str.slice(0, 2).astype(int) * 60
+               + t.str.slice(3, 5).astype(int)).to_numpy()
+    win = np.full(len(t), -1)
+    for label, lo, hi in TIME_WINDOWS:
+        hit = ((minutes >= lo) & (minutes < hi)) if lo < hi \
+            else ((minutes >= lo) | (minutes < hi))
+        win[hit & (win < 0)] = WINDOWS.index(label)
+    keep = zero[row, win]
+    order = np.argsort(row[keep], kind="stable")
+    pair_od = np.repeat(ods, [len(by_od[od]) for od in ods])[keep][order]
+    return list(zip(pair_od.tolist(), t[keep].to_numpy()[order].tolist()))
 
 
 def pick(rng: random.Random, by_od: dict[str, list[str]], n_pairs: int,
          n_ods: int, must_include: list[tuple[str, str]]) -> list[tuple[str, str]]:
-    """Choose ``n_pairs`` departures spread over exactly ``n_ods`` ODs."""
+    """Choose ``n_pairs`` departures spread over exactly ``n_ods`` ODs.
+
+    Consumes ``rng`` in exactly the order the original list-based version did,
+    so a given seed still selects the same departures; only the bookkeeping
+    (membership, capacity, the spare queue) is set/counter based.
+    """
     seed_pair = rng.choice(must_include)
     ods = [seed_pair[0]]
 
@@ -176,39 +213,40 @@ def pick(rng: random.Random, by_od: dict[str, list[str]], n_pairs: int,
     # The random draw can land on too many single-departure ODs to reach
     # n_pairs. Swap the thinnest picks for the fattest unpicked ones until the
     # selected ODs can actually supply n_pairs departures between them.
-    def capacity(selected: list[str]) -> int:
-        return sum(len(by_od[od]) for od in selected)
-
-    spare = [od for od in candidates if od not in set(ods)]
-    spare.sort(key=lambda od: (-len(by_od[od]), od))
-    while capacity(ods) < n_pairs and spare:
+    capacity = sum(len(by_od[od]) for od in ods)
+    picked = set(ods)
+    spare = iter([od for od in candidates if od not in picked])   # fattest first
+    while capacity < n_pairs:
+        fat = next(spare, None)
+        if fat is None:
+            break
         thin = min(
             (od for od in ods if od != seed_pair[0]),
             key=lambda od: (len(by_od[od]), od),
         )
-        fat = spare.pop(0)
         if len(by_od[fat]) <= len(by_od[thin]):
             break
         ods[ods.index(thin)] = fat
-    if capacity(ods) < n_pairs:
+        capacity += len(by_od[fat]) - len(by_od[thin])
+    if capacity < n_pairs:
         raise RuntimeError(
-            f"{n_ods} ODs can supply at most {capacity(ods)} departures, "
+            f"{n_ods} ODs can supply at most {capacity} departures, "
             f"need {n_pairs}"
         )
 
     chosen = [seed_pair]
-    remaining = {od: [t for t in by_od[od] if (od, t) not in chosen] for od in ods}
+    remaining = {od: [t for t in by_od[od] if (od, t) != seed_pair] for od in ods}
     # One departure per OD first, so every OD really contributes a variable.
     for od in ods:
-        if od == seed_pair[0] and not remaining[od]:
-            continue
         if od != seed_pair[0]:
             time = rng.choice(remaining[od])
             remaining[od].remove(time)
             chosen.append((od, time))
 
+    # ODs that still have departures, in `ods` order; dropping an exhausted one
+    # keeps the order, so this is the list the original rebuilt every draw.
+    pool = [od for od in ods if remaining[od]]
     while len(chosen) < n_pairs:
-        pool = [od for od in ods if remaining[od]]
         if not pool:
             raise RuntimeError(
                 f"cannot reach {n_pairs} departures from {n_ods} ODs"
@@ -217,6 +255,8 @@ def pick(rng: random.Random, by_od: dict[str, list[str]], n_pairs: int,
         time = rng.choice(remaining[od])
         remaining[od].remove(time)
         chosen.append((od, time))
+        if not remaining[od]:
+            pool.remove(od)
 
     rng.shuffle(chosen)
     return chosen
@@ -236,26 +276,176 @@ def render(flights: list[tuple[str, str]], consumption: dict[str, str]) -> str:
     )
 
 
-def main() -> None:
-    rng = random.Random(SEED)
+_LADDER_ITEM = re.compile(r"^\s*(\d+)\s*x\s*(\d+)\s*(?:\*\s*(\d+))?\s*$")
+
+
+def parse_ladder(spec: str) -> list[tuple[int, int]]:
+    """``"26x8,30x9,200x60*100"`` -> [(26, 8), (30, 9), (200, 60) x 100]."""
+    out: list[tuple[int, int]] = []
+    for item in spec.split(","):
+        m = _LADDER_ITEM.match(item)
+        if not m:
+            raise ValueError(f"bad ladder item {item!r}; expected PAIRSxODS[*N]")
+        n_pairs, n_ods, rep = int(m[1]), int(m[2]), int(m[3] or 1)
+        out += [(n_pairs, n_ods)] * rep
+    return out
+
+
+def check_ladder(ladder: list[tuple[int, int]], by_od: dict[str, list[str]],
+                 must: list[tuple[str, str]] | None = None) -> None:
+    """Reject rungs no selection could satisfy, before generating anything.
+
+    With ``must`` (the pairs ``pick`` seeds every query with), a rung is also
+    checked against the most departures ``n_ods`` ODs can supply when one of
+    them is a seed OD -- the bound ``pick`` itself runs into.
+    """
+    n_total = sum(len(t) for t in by_od.values())
+    seed_ods = sorted({od for od, _ in must or []})
+    for n_pairs, n_ods in sorted(set(ladder)):
+        if not 1 <= n_ods <= len(by_od):
+            raise ValueError(f"{n_pairs}x{n_ods}: need 1..{len(by_od)} ODs")
+        if not n_ods <= n_pairs <= n_total:
+            raise ValueError(
+                f"{n_pairs}x{n_ods}: need {n_ods}..{n_total} departures "
+                f"(every departure appears at most once per query, and this "
+                f"network has {n_total})"
+            )
+        if seed_ods:
+            best = max(
+                len(by_od[seed]) + sum(sorted(
+                    (len(t) for od, t in by_od.items() if od != seed),
+                    reverse=True)[: n_ods - 1])
+                for seed in seed_ods
+            )
+            if n_pairs > best:
+                raise ValueError(
+                    f"{n_pairs}x{n_ods}: {n_ods} ODs can supply at most "
+                    f"{best} departures in this network"
+                )
+
+
+# Per-process state for the worker pool; set once by _init_worker.
+_WORKER: dict = {}
+
+
+def _init_worker(by_od: dict[str, list[str]], must: list[tuple[str, str]],
+                 seed: int) -> None:
+    _WORKER.update(by_od=by_od, must=must, seed=seed)
+
+
+def _one_query(job: tuple[int, int, int],
+               rng: random.Random | None = None) -> tuple[int, int, int, str]:
+    """Build query ``i``. Without ``rng``, it gets its own stream seeded from
+    (seed, i), so the result does not depend on which worker runs it."""
+    i, n_pairs, n_ods = job
+    if rng is None:
+        rng = random.Random(f"{_WORKER['seed']}:{i}")
+    flights = pick(rng, _WORKER["by_od"], n_pairs, n_ods, _WORKER["must"])
+    # n_products * n_flight_pairs + one no-purchase variable per OD.
+    n_ods_used = len({od for od, _ in flights})
+    n_vars = len(PRODUCTS_BY_FARE) * len(flights) + n_ods_used
+    return (len(flights), n_ods_used, n_vars,
+            render(flights, CONSUMPTION[i % len(CONSUMPTION)]))
+
+
+def generate(ladder: list[tuple[int, int]], seed: int = SEED,
+             per_query_seed: bool = False, workers: int = 1):
+    """Iterator of (n_pairs, n_ods, n_vars, query) in ladder order.
+
+    The default draws every query from one ``random.Random(seed)`` stream, in
+    sequence -- that is what the shipped file was built with. ``per_query_seed``
+    gives each query an independent stream instead, which is what makes the
+    work splittable over ``workers`` processes without the output depending on
+    the worker count.
+
+    The ladder is validated here, eagerly, so a bad rung fails before any
+    output file is opened.
+    """
+    if workers > 1 and not per_query_seed:
+        raise ValueError("--workers needs --per-query-seed: a single shared "
+                         "random stream cannot be split across processes")
     by_od, _ = load_pool()
     must = zero_ratio_pairs(by_od)
     if not must:
         raise RuntimeError("no v2 == 0 cell found; the edge case is gone")
-
-    rows, counts = [], []
-    for i, (n_pairs, n_ods) in enumerate(LADDER):
-        flights = pick(rng, by_od, n_pairs, n_ods, must)
-        rows.append(render(flights, CONSUMPTION[i % len(CONSUMPTION)]))
-        # n_products * n_flight_pairs + one no-purchase variable per OD.
-        n_ods_used = len({od for od, _ in flights})
-        n_vars = len(PRODUCTS_BY_FARE) * len(flights) + n_ods_used
-        counts.append(n_vars)
-        print(f"q{i + 1:>2}: pairs={len(flights):>3}  ODs={n_ods_used:>2}  "
-              f"vars={n_vars:>3}")
-
-    pd.DataFrame({"n_variables": counts, "Query": rows}).to_csv(OUT, index=False)
-    print(f"\nwrote {OUT} ({len(rows)} queries)")
+    check_ladder(ladder, by_od, must)
+    _init_worker(by_od, must, seed)
+    jobs = [(i, n_pairs, n_ods) for i, (n_pairs, n_ods) in enumerate(ladder)]
+    return _stream(jobs, by_od, must, seed, per_query_seed, workers)
+
+
+def _stream(jobs, by_od, must, seed, per_query_seed, workers):
+    if not per_query_seed:
+        rng = random.Random(seed)
+        for job in jobs:
+            yield _one_query(job, rng)
+        return
+
+    if workers <= 1:
+        yield from map(_one_query, jobs)
+        return
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(by_od, must, seed)) as ex:
+        yield from ex.map(_one_query, jobs,
+                          chunksize=max(1, len(jobs) // (workers * 8)))
+
+
+def write_chunked(rows, out: Path, chunk_size: int, quiet: bool = False) -> int:
+    """Stream generated queries to ``out`` ``chunk_size`` rows at a time."""
+    n = 0
+    it = iter(rows)
+    while True:
+        chunk = list(islice(it, chunk_size))
+        if not chunk:
+            break
+        if not quiet:
+            for k, (pairs, ods, n_vars, _) in enumerate(chunk, start=n + 1):
+                print(f"q{k:>2}: pairs={pairs:>3}  ODs={ods:>2}  vars={n_vars:>3}")
+        pd.DataFrame({"n_variables": [c[2] for c in chunk],
+                      "Query": [c[3] for c in chunk]}).to_csv(
+            out, index=False, mode="w" if n == 0 else "a", header=n == 0)
+        n += len(chunk)
+    if n == 0:
+        pd.DataFrame({"n_variables": [], "Query": []}).to_csv(out, index=False)
+    return n
+
+
+def main(argv: list[str] | None = None) -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--ladder", default=None,
+                    help="comma-separated PAIRSxODS[*N] rungs; default is the "
+                         "shipped 15-query LADDER")
+    ap.add_argument("-o", "--out", type=Path, default=None,
+                    help=f"output CSV (default {OUT.name}, only with the "
+                         f"default ladder)")
+    ap.add_argument("--seed", type=int, default=SEED)
+    ap.add_argument("--per-query-seed", action="store_true",
+                    help="independent random stream per query (required for "
+                         "--workers > 1)")
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--chunk-size", type=int, default=500,
+                    help="queries buffered per CSV write")
+    ap.add_argument("--quiet", action="store_true",
+                    help="no per-query line (use for thousands of queries)")
+    args = ap.parse_args(argv)
+
+    out = args.out
+    if out is None:
+        if args.ladder:
+            ap.error(f"--ladder needs -o/--out; the default output is the "
+                     f"shipped {OUT.name}")
+        out = OUT
+    try:
+        ladder = parse_ladder(args.ladder) if args.ladder else LADDER
+        rows = generate(ladder, args.seed, args.per_query_seed, args.workers)
+    except ValueError as e:
+        ap.error(str(e))
+    try:
+        n = write_chunked(rows, out, max(1, args.chunk_size), args.quiet)
+    except RuntimeError as e:
+        # a rung check_ladder let through but this seed's draw cannot fill
+        ap.error(str(e))
+    print(f"\nwrote {out} ({n} queries)")
 
 
 if __name__ == "__main__":
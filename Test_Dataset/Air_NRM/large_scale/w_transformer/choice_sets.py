@@ -23,6 +23,7 @@ OD maps origin/destination to ``__UNKNOWN__``, so only the ODs listed in
 
 from __future__ import annotations
 
+import hashlib
 from pathlib import Path
 
 import numpy as np
@@ -75,57 +76,184 @@ def _hhmm(minutes: float) -> int:
 
 # ────────────────────────────────────────────────────────── Air_NRM SQ grid
 
+# Every CSV the compiled grid is derived from. The cache key hashes their bytes,
+# so regenerating any of them (build_air_nrm_inputs.py) invalidates the cache
+# without anyone having to remember to delete it.
+GRID_INPUTS = {
+    "v1": _BUILD / "v1.csv",
+    "v2": _BUILD / "v2.csv",
+    "status": _BUILD / "Supplement" / "v1_cell_status.csv",
+    "code_map": _BUILD / "Supplement" / "airport_code_map.csv",
+    "market": _BUILD / "Supplement" / "od_market_size.csv",
+    "price": _BUILD / "Supplement" / "flight_price_coverage.csv",
+}
+GRID_CACHE_DIR = _HERE / ".grid_cache"
+# Bump when compile_grid() changes what it writes, so stale caches are ignored.
+GRID_FORMAT = 1
+
+
+def grid_key(inputs: dict[str, Path] = GRID_INPUTS) -> str:
+    """sha256 over the input CSVs' bytes (in a fixed order) + GRID_FORMAT."""
+    h = hashlib.sha256(f"air_nrm_grid/{GRID_FORMAT}".encode())
+    for name in sorted(inputs):
+        h.update(name.encode())
+        h.update(inputs[name].read_bytes())
+    return h.hexdigest()
+
+
+def _od_tuple(s: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """``"('215', '865')"`` -> (``'215'``, ``'865'``), column-wise."""
+    parts = s.astype(str).str.extract(r"\('?([^',]*)'?,\s*'?([^')]*)'?\)")
+    return parts[0], parts[1]
+
+
+def compile_grid(inputs: dict[str, Path] = GRID_INPUTS) -> dict[str, np.ndarray]:
+    """Compile the 16-cell SQ grid of every OD into dense arrays.
+
+    Rows follow ``v1.csv``; cells are ``product x window`` in ``PRODUCTS`` x
+    ``WINDOWS`` order. Fares and departure minutes are filled with one
+    ``bincount`` pass over ``flight_price_coverage.csv`` instead of a groupby
+    per OD:
+
+      * fare — pax-weighted across the departures in the window; the OD x
+        product mean where the window is not served (NaN if the product is not
+        sold on the OD at all);
+      * dep_min — pax-weighted departure minute in the window; the window's
+        midpoint where it is not served.
+    """
+    code = pd.read_csv(inputs["code_map"], dtype=str)
+    decode = pd.Series(code.iata_code.to_numpy(), index=code.surrogate.to_numpy())
+
+    def decoded(a: pd.Series) -> np.ndarray:
+        a = a.astype(str)
+        return a.map(decode).fillna(a).to_numpy(str)
+
+    cols = [f"{p}*{w}" for p in PRODUCTS for w in WINDOWS]
+    v1 = pd.read_csv(inputs["v1"])
+    v2 = pd.read_csv(inputs["v2"])
+    if not v2["OD Pairs"].equals(v1["OD Pairs"]):
+        raise ValueError("v1.csv and v2.csv list the OD pairs in different orders")
+    a, b = _od_tuple(v1["OD Pairs"])
+    orig, dest = decoded(a), decoded(b)
+    n = len(v1)
+    row = pd.Series(np.arange(n), index=pd.MultiIndex.from_arrays([orig, dest]))
+
+    def row_index(o: pd.Series, d: pd.Series) -> np.ndarray:
+        idx = pd.MultiIndex.from_arrays([decoded(o), decoded(d)])
+        return row.reindex(idx).to_numpy(float)
+
+    status = pd.read_csv(inputs["status"])
+    observed = (status[cols].to_numpy() == "observed").reshape(-1, 4, 4)
+
+    mkt = pd.read_csv(inputs["market"])
+    sq_share = np.full(n, np.nan)
+    mi = row_index(mkt.origin, mkt.destination)
+    ok = ~np.isnan(mi)
+    sq_share[mi[ok].astype(int)] = mkt.sq_share.to_numpy(float)[ok]
+
+    fp = pd.read_csv(inputs["price"], dtype={"origin": str, "destination": str})
+    fi = row_index(fp.origin, fp.destination)
+    fp = fp[~np.isnan(fi)]
+    oi = fi[~np.isnan(fi)].astype(int)
+    pi = pd.Categorical(fp["product"], categories=PRODUCTS).codes
+    dep = (fp.departure_time.str.slice(0, 2).astype(int) * 60
+           + fp.departure_time.str.slice(3, 5).astype(int)).to_numpy(float)
+    # window_of(), vectorised; indices follow WINDOWS
+    wi = np.select([(dep >= 12 * 60) & (dep < 18 * 60),
+                    (dep >= 18 * 60) & (dep < 22 * 60),
+                    (dep >= 8 * 60) & (dep < 12 * 60)],
+                   [0, 1, 3], default=2)
+    wt = np.maximum(fp.pax.to_numpy(float), 1e-9)
+    keep = (pi >= 0) & (wi >= 0)
+    oi, pi, wi, wt, dep = oi[keep], pi[keep], wi[keep], wt[keep], dep[keep]
+    price = fp.avg_price.to_numpy(float)[keep]
+
+    cell = (oi * 4 + pi) * 4 + wi
+    num = np.bincount(cell, weights=wt * price, minlength=n * 16)
+    den = np.bincount(cell, weights=wt, minlength=n * 16)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fare = np.where(den > 0, num / den, np.nan).reshape(n, 4, 4)
+
+    # unserved windows: the OD x product mean, taken from the first row of that
+    # (od, product) exactly as the per-OD loop did
+    fallback = np.full((n, 4), np.nan)
+    first = pd.DataFrame({"o": oi, "p": pi,
+                          "v": fp.od_product_price.to_numpy(float)[keep]}
+                         ).drop_duplicates(["o", "p"])
+    fallback[first.o.to_numpy(), first.p.to_numpy()] = first.v.to_numpy()
+    fare = np.where(np.isnan(fare), fallback[:, :, None], fare)
+
+    slot = oi * 4 + wi
+    t_num = np.bincount(slot, weights=wt * dep, minlength=n * 4)
+    t_den = np.bincount(slot, weights=wt, minlength=n * 4)
+    mid = np.array([WIN_MID[w] for w in WINDOWS], float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dep_min = np.where(t_den > 0, t_num / t_den, np.tile(mid, n)).reshape(n, 4)
+
+    return {
+        "od_labels": v1["OD Pairs"].to_numpy(str),
+        "origin": orig,
+        "destination": dest,
+        "V": v1[cols].to_numpy(float).reshape(-1, 4, 4),
+        "v0": v1["no_purchase"].to_numpy(float),
+        "V2": v2[cols].to_numpy(float).reshape(-1, 4, 4),
+        "v2_0": v2["no_purchase"].to_numpy(float),
+        "observed": observed,
+        "fare": fare,
+        "dep_min": dep_min,
+        "sq_share": sq_share,
+    }
+
+
+def load_grid(cache_dir: Path | None = GRID_CACHE_DIR,
+              refresh: bool = False) -> dict[str, np.ndarray]:
+    """``compile_grid()``, cached as ``<cache_dir>/air_nrm_grid_<key>.npz``.
+
+    The key is ``grid_key()``, so a hit is only possible while every input CSV
+    is byte-identical to the one the cache was compiled from. ``cache_dir=None``
+    compiles without touching the disk.
+    """
+    if cache_dir is None:
+        return compile_grid()
+    path = Path(cache_dir) / f"air_nrm_grid_{grid_key()[:16]}.npz"
+    if path.exists() and not refresh:
+        with np.load(path, allow_pickle=False) as z:
+            return {k: z[k] for k in z.files}
+    arrays = compile_grid()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp.npz")
+    np.savez(tmp, **arrays)
+    tmp.replace(path)                   # never leave a half-written cache behind
+    return arrays
+
+
 class AirNrmGrid:
-    """The 16-cell SQ grid per OD: attractions, fares, representative times."""
+    """The 16-cell SQ grid per OD: attractions, fares, representative times.
 
-    def __init__(self) -> None:
-        code = pd.read_csv(_BUILD / "Supplement" / "airport_code_map.csv")
-        self.decode = dict(zip(code.surrogate.astype(str), code.iata_code))
+    Backed by the dense arrays of ``load_grid()``; ``fare`` / ``dep_min`` /
+    ``sq_share`` stay available per OD as views into them.
+    """
 
-        self.v1 = pd.read_csv(_BUILD / "v1.csv")
+    def __init__(self, cache_dir: Path | None = GRID_CACHE_DIR,
+                 refresh: bool = False) -> None:
+        g = load_grid(cache_dir, refresh)
+        self.arrays = g
         self.cols = [f"{p}*{w}" for p in PRODUCTS for w in WINDOWS]
-        ods = [tuple(s.strip("()").replace("'", "").split(", "))
-               for s in self.v1["OD Pairs"]]
-        self.ods = [(self.decode.get(a, a), self.decode.get(b, b)) for a, b in ods]
+        self.od_labels = g["od_labels"]
+        self.ods = [(str(a), str(b)) for a, b in zip(g["origin"], g["destination"])]
         self.row_of = {od: i for i, od in enumerate(self.ods)}
 
-        self.V = self.v1[self.cols].to_numpy(float).reshape(-1, 4, 4)
-        self.v0 = self.v1["no_purchase"].to_numpy(float)
-
-        status = pd.read_csv(_BUILD / "Supplement" / "v1_cell_status.csv")
-        self.observed = (status[self.cols].to_numpy() == "observed").reshape(-1, 4, 4)
-
-        mkt = pd.read_csv(_BUILD / "Supplement" / "od_market_size.csv")
-        mkt["od"] = [(self.decode.get(str(a), str(a)), self.decode.get(str(b), str(b)))
-                     for a, b in zip(mkt.origin, mkt.destination)]
-        self.sq_share = dict(zip(mkt.od, mkt.sq_share))
-
-        fp = pd.read_csv(_BUILD / "Supplement" / "flight_price_coverage.csv")
-        fp["od"] = [(self.decode.get(str(a), str(a)), self.decode.get(str(b), str(b)))
-                    for a, b in zip(fp.origin, fp.destination)]
-        fp["dep_min"] = (fp.departure_time.str.slice(0, 2).astype(int) * 60
-                         + fp.departure_time.str.slice(3, 5).astype(int))
-        fp["win"] = fp["dep_min"].map(window_of)
-        self._fp = fp
-
-        # per-(od, product, window) fare: pax-weighted across the departures in
-        # the window; the OD x product mean where the window is not served.
-        self.fare = {}
-        self.dep_min = {}
-        for od, g in fp.groupby("od"):
-            f = np.full((4, 4), np.nan)
-            for (p, w), gg in g.groupby(["product", "win"]):
-                f[PRODUCTS.index(p), WINDOWS.index(w)] = np.average(
-                    gg.avg_price, weights=np.maximum(gg.pax, 1e-9))
-            for p, gg in g.groupby("product"):
-                row = f[PRODUCTS.index(p)]
-                row[np.isnan(row)] = float(gg.od_product_price.iloc[0])
-            self.fare[od] = f
-
-            t = np.array([WIN_MID[w] for w in WINDOWS], float)
-            for w, gg in g.groupby("win"):
-                t[WINDOWS.index(w)] = np.average(gg.dep_min, weights=np.maximum(gg.pax, 1e-9))
-            self.dep_min[od] = t
+        self.V = g["V"]
+        self.v0 = g["v0"]
+        self.observed = g["observed"]
+        self.fares = g["fare"]
+        self.dep_mins = g["dep_min"]
+        self.sq_shares = g["sq_share"]
+
+        self.sq_share = {od: self.sq_shares[i] for i, od in enumerate(self.ods)
+                         if not np.isnan(self.sq_shares[i])}
+        self.fare = {od: self.fares[i] for i, od in enumerate(self.ods)}
+        self.dep_min = {od: self.dep_mins[i] for i, od in enumerate(self.ods)}
 
     def sq_duration_seconds(self, od: tuple[str, str]) -> float:
         return _flight_table().duration(od, "SQ")
@@ -9,10 +9,20 @@ asked for.
 Outputs
 -------
 tables/cost_table.csv / .tex     resource cost per (method, model, dataset)
-                                 -> referee 2 Q3
-tables/stage_breakdown.csv       tokens / calls / cost per pipeline stage
+                                 -> referee 2 Q3; paid vs cache-replayed
+                                 calls are kept apart (cache_hit_%)
+tables/stage_breakdown.csv       tokens / calls / cost per pipeline stage,
+                                 with the provider prompt-cache hit rate and
+                                 what the cost would be without it
 tables/classification.csv        classifier accuracy + confusion matrix
                                  -> referee 1 Q3
+tables/classification_by_path.csv  accuracy / cost per classifier path
+                                 (knn fast path vs agent), when logged
+tables/latency_table.csv / .tex  p50/p90/p99 call latency, time to first
+                                 token and output tokens/s per (stage, model,
+                                 provider), from calls.jsonl; plus one
+                                 "(instance)" row per method with wall-clock
+                                 percentiles and instances per hour
 tables/per_instance.csv          flat table, one row per instance (for plots)
 
 The optional --gold CSV supplies correctness labels; join key is
@@ -30,6 +40,7 @@ import math
 import sys
 from collections import Counter, defaultdict
 from pathlib import Path
+from typing import List, Optional
 
 import pandas as pd
 
@@ -38,6 +49,11 @@ RESOURCE_COLS = [
     "prompt_tokens", "completion_tokens", "total_tokens",
     "cached_prompt_tokens", "reasoning_tokens",
     "cost_usd", "llm_latency_s", "wall_s",
+    "n_cache_hits", "replayed_cost_usd",
+    "n_sql_queries", "sql_rows_returned",
+    # process telemetry (lx.ResourceSampler)
+    "cpu_user_s", "cpu_sys_s", "rss_peak_mb", "rss_end_mb",
+    "gc_collections", "gc_pause_s", "threads_max", "disk_read_mb",
 ]
 
 
@@ -57,6 +73,7 @@ def load_instances(root: Path) -> pd.DataFrame:
                 "dataset": d.get("dataset"),
                 "repeat_index": d.get("repeat_index", 0),
                 "instance_id": d.get("instance_id"),
+                "started_unix": d.get("started_unix"),
                 "status": d.get("status"),
                 "gold_type": d.get("gold_type"),
                 "pred_type": d.get("pred_type"),
@@ -64,6 +81,15 @@ def load_instances(root: Path) -> pd.DataFrame:
                 "n_llm_calls_failed": s.get("n_llm_calls_failed", 0),
                 "n_estimated_token_calls": s.get("n_estimated_token_calls", 0),
                 "objective_value": d.get("objective_value"),
+                # set by lx.KnnClassifier: knn | rule | agent (absent when
+                # every query went through the agent)
+                "classification_path": d.get("classification_path"),
+                "knn_margin": d.get("knn_margin"),
+                # live vector-store bytes at instance exit (lx.RunLogger._settle)
+                "index_bytes": d.get("index_bytes"),
+                # first | escalated when a role runs a model cascade
+                # (lx.CascadeChatModel); absent otherwise
+                "cascade_path": d.get("cascade_path"),
             }
             for c in RESOURCE_COLS:
                 row[c] = s.get(c) or 0
@@ -72,7 +98,11 @@ def load_instances(root: Path) -> pd.DataFrame:
                 row[f"stage::{stage_name}::tool_calls"] = sv.get("tool_calls", 0)
                 row[f"stage::{stage_name}::prompt_tokens"] = sv.get("prompt_tokens", 0)
                 row[f"stage::{stage_name}::completion_tokens"] = sv.get("completion_tokens", 0)
+                row[f"stage::{stage_name}::cached_prompt_tokens"] = \
+                    sv.get("cached_prompt_tokens", 0)
                 row[f"stage::{stage_name}::cost_usd"] = sv.get("cost_usd", 0.0)
+                row[f"stage::{stage_name}::cache_saved_usd"] = \
+                    sv.get("cache_saved_usd", 0.0)
                 row[f"stage::{stage_name}::latency_s"] = sv.get("latency_s", 0.0)
             rows.append(row)
     if not rows:
@@ -80,6 +110,24 @@ def load_instances(root: Path) -> pd.DataFrame:
     return _dedupe(pd.DataFrame(rows))
 
 
+#: Columns of calls.jsonl the latency table needs; the rest (queries, tool
+#: inputs, ...) is dropped while reading.
+CALL_COLS = ["run_id", "dataset", "method", "model_profile", "instance_id",
+             "type", "stage", "model", "provider", "tool_name", "retriever",
+             "latency_s", "ttft_s", "completion_tokens", "ok", "cache_hit",
+             "batched"]
+
+
+def load_calls(root: Path) -> pd.DataFrame:
+    rows = []
+    for f in sorted(root.rglob("calls.jsonl")):
+        for line in f.read_text(encoding="utf-8").splitlines():
+            if line.strip():
+                d = json.loads(line)
+                rows.append({c: d.get(c) for c in CALL_COLS})
+    return pd.DataFrame(rows, columns=CALL_COLS)
+
+
 def _dedupe(df: pd.DataFrame) -> pd.DataFrame:
     """Collapse repeated records for the same instance within one run.
 
@@ -229,6 +277,19 @@ def cost_table(df: pd.DataFrame, per_run: bool = False) -> pd.DataFrame:
             "latency_s_p95": x["wall_s"].quantile(0.95),
             "retries_mean": x["n_retries"].mean(),
             "est_tokens_%": 100 * (x["n_estimated_token_calls"] > 0).mean(),
+            # Calls answered from the local response cache cost nothing and
+            # take no provider time. cost_usd above is what was PAID;
+            # replayed_usd_total is what the replayed calls would have cost,
+            # so paid + replayed is the method's price. A nonzero
+            # cache_hit_% also means the latency columns are not provider
+            # latencies and should not go into a paper table.
+            "cache_hit_%": 100 * x["n_cache_hits"].sum()
+                           / max(1, x["n_llm_calls"].sum()),
+            "replayed_usd_total": x["replayed_cost_usd"].sum(),
+            # share of instances a cascaded profile handed to the strong
+            # model; compare its usd_per_correct with the fixed profile's
+            "cascade_escalated_%": 100 * (x["cascade_path"] == "escalated").mean()
+                                   if x["cascade_path"].notna().any() else math.nan,
         }
         # cost per additional correct instance vs. nothing (interpretability aid)
         if not math.isnan(out["acc_optimal_%"]) and out["acc_optimal_%"] > 0:
@@ -260,18 +321,115 @@ def stage_breakdown(df: pd.DataFrame) -> pd.DataFrame:
                                      dropna=False):
         stages = sorted({c.split("::")[1] for c in stage_cols})
         for s in stages:
+            col = lambda k: x.get(f"stage::{s}::{k}", pd.Series([0])).fillna(0)
+            prompt = col("prompt_tokens").sum()
+            cost, saved = col("cost_usd").mean(), col("cache_saved_usd").mean()
             recs.append({
                 "dataset": ds, "method": m, "model_profile": mp, "stage": s,
-                "calls_mean": x.get(f"stage::{s}::calls", pd.Series([0])).mean(),
-                "tool_calls_mean": x.get(f"stage::{s}::tool_calls", pd.Series([0])).mean(),
-                "prompt_tok_mean": x.get(f"stage::{s}::prompt_tokens", pd.Series([0])).mean(),
-                "completion_tok_mean": x.get(f"stage::{s}::completion_tokens", pd.Series([0])).mean(),
-                "cost_usd_mean": x.get(f"stage::{s}::cost_usd", pd.Series([0])).mean(),
-                "latency_s_mean": x.get(f"stage::{s}::latency_s", pd.Series([0])).mean(),
+                "calls_mean": col("calls").mean(),
+                "tool_calls_mean": col("tool_calls").mean(),
+                "prompt_tok_mean": col("prompt_tokens").mean(),
+                "completion_tok_mean": col("completion_tokens").mean(),
+                # share of the stage's prompt tokens the provider served from
+                # its prompt cache (and billed at price_cached_in_per_1m)
+                "cache_hit_%": 100 * col("cached_prompt_tokens").sum() / prompt
+                               if prompt else math.nan,
+                # cost_usd_mean is what was paid, i.e. the effective cost;
+                # the no-cache figure is the same tokens at the full input
+                # price, so the two columns compare prompt layouts directly
+                "cost_usd_mean": cost,
+                "cost_no_cache_usd_mean": cost + saved,
+                "cache_saving_%": 100 * saved / (cost + saved)
+                                  if cost + saved else math.nan,
+                "latency_s_mean": col("latency_s").mean(),
             })
     return pd.DataFrame(recs).round(4)
 
 
+LATENCY_KEYS = ["dataset", "method", "model_profile", "type", "stage",
+                "model", "provider"]
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _quantiles(g, col: str, prefix: str) -> pd.DataFrame:
+    q = g[col].quantile(list(QUANTILES)).unstack()
+    q.columns = [f"{prefix}_p{int(round(100 * p))}" for p in q.columns]
+    return q
+
+
+def _instances_per_hour(df: pd.DataFrame) -> pd.Series:
+    """Instances finished per hour of run time, per (dataset, method,
+    model_profile). A run's time is first start to last end when the log has
+    start times (so concurrent instances count once), else the sum of wall_s."""
+    start = pd.to_numeric(df["started_unix"], errors="coerce")
+    x = df.assign(started_unix=start, end=start + df["wall_s"])
+    per_run = x.groupby(["dataset", "method", "model_profile", "run_id"],
+                        dropna=False).agg(
+        n=("instance_id", "size"), t0=("started_unix", "min"),
+        t1=("end", "max"), wall=("wall_s", "sum"))
+    span = (per_run["t1"] - per_run["t0"]).fillna(per_run["wall"])
+    per_run = per_run.assign(hours=span / 3600)
+    g = per_run.groupby(level=[0, 1, 2], dropna=False)
+    return g["n"].sum() / g["hours"].sum().where(lambda h: h > 0)
+
+
+def latency_table(calls: pd.DataFrame, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Latency distribution per (stage, model, provider) for capacity planning:
+    p50/p90/p99 of per-call latency and of time to first token (streamed
+    calls only), and output tokens/s -- completion tokens over the time after
+    the first token, or over the whole call when it was not streamed.
+
+    Calls replayed from the response cache and batched shares are left out:
+    their latency is not a request's latency. Tool and retriever calls are
+    kept (model = tool / retriever name, provider = "local"). One extra row
+    per method, stage "(instance)", holds the percentiles of instance wall
+    time, the run's instances per hour and, in n_instances, how many
+    instances that is (its n_calls stays empty).
+    """
+    c = calls.copy()
+    for col in ("latency_s", "ttft_s", "completion_tokens"):
+        c[col] = pd.to_numeric(c[col], errors="coerce")
+    if not c.empty:
+        skip = (c["cache_hit"].fillna(False).astype(bool)
+                | c["batched"].fillna(False).astype(bool))
+        c = c[~skip & c["latency_s"].notna()]
+    if c.empty:
+        out = pd.DataFrame(columns=LATENCY_KEYS)
+    else:
+        local = c["type"] != "llm"
+        c["model"] = c["model"].where(~local, c["tool_name"].fillna(
+            c["retriever"]).fillna(c["type"]))
+        c["provider"] = c["provider"].where(~local, "local")
+        c[["stage", "model", "provider"]] = \
+            c[["stage", "model", "provider"]].fillna("?")
+        ok = c["ok"].fillna(True).astype(bool)
+        c["failed"] = ~ok
+        decode = c["latency_s"] - c["ttft_s"].fillna(0.0)
+        c["tokens_per_s"] = (c["completion_tokens"] / decode).where(
+            ok & (decode > 0) & (c["type"] == "llm"))
+        g = c.groupby(LATENCY_KEYS, dropna=False)
+        out = pd.concat([
+            g.size().rename("n_calls"),
+            g["failed"].sum().rename("n_failed"),
+            _quantiles(g, "latency_s", "latency_s"),
+            g["latency_s"].mean().rename("latency_s_mean"),
+            _quantiles(g, "ttft_s", "ttft_s"),
+            _quantiles(g, "tokens_per_s", "tokens_per_s"),
+        ], axis=1).reset_index()
+    if not df.empty:
+        gi = df.groupby(["dataset", "method", "model_profile"], dropna=False)
+        inst = pd.concat([
+            gi.size().rename("n_instances"),
+            _quantiles(gi, "wall_s", "latency_s"),
+            gi["wall_s"].mean().rename("latency_s_mean"),
+            _instances_per_hour(df).rename("instances_per_hour"),
+        ], axis=1).reset_index().assign(type="instance", stage="(instance)",
+                                        model="all", provider="all")
+        out = pd.concat([out, inst], ignore_index=True)
+    return out.sort_values(LATENCY_KEYS).reset_index(drop=True).round(4)
+
+
 def classification_report(df: pd.DataFrame, out_dir: Path) -> pd.DataFrame:
     sub = df[df["gold_type"].notna() & df["pred_type"].notna()]
     if sub.empty:
@@ -293,15 +451,53 @@ def classification_report(df: pd.DataFrame, out_dir: Path) -> pd.DataFrame:
 
         cm = pd.crosstab(x["gold_type"], x["pred_type"], dropna=False)
         cm.to_csv(out_dir / f"confusion__{ds}__{m}__{mp}.csv")
+
+    by_path = classification_by_path(sub)
+    if not by_path.empty:
+        by_path.to_csv(out_dir / "classification_by_path.csv", index=False)
     return pd.DataFrame(rows).round(3)
 
 
-def to_latex(t: pd.DataFrame, path: Path, caption: str, label: str):
-    cols = ["method", "model_profile", "n_instances", "n_unique_instances",
-            "acc_optimal_%",
-            "acc_formulation_%", "llm_calls_mean", "tool_calls_mean",
-            "prompt_tok_mean", "completion_tok_mean", "cost_usd_mean",
-            "latency_s_mean"]
+def classification_by_path(sub: pd.DataFrame) -> pd.DataFrame:
+    """Accuracy and classification-stage cost per classifier path.
+
+    With the kNN fast path on, the headline accuracy mixes two populations:
+    the queries the vote was sure about and the ambiguous ones handed to the
+    agent. The fast path only pays off if its accuracy holds up on its share
+    of the traffic, and its saving is the difference in classification cost
+    between the rows -- neither is visible in the pooled number.
+    """
+    if "classification_path" not in sub or \
+            sub["classification_path"].isna().all():
+        return pd.DataFrame()
+    sub = sub.assign(classification_path=sub["classification_path"]
+                     .fillna("agent"))
+    cost = sub.get("stage::classification::cost_usd",
+                   pd.Series(0.0, index=sub.index)).fillna(0.0)
+    calls = sub.get("stage::classification::calls",
+                    pd.Series(0, index=sub.index)).fillna(0)
+    hit = (sub["gold_type"].str.strip().str.lower()
+           == sub["pred_type"].str.strip().str.lower())
+    rows = []
+    keys = ["dataset", "method", "model_profile"]
+    for key, x in sub.groupby(keys, dropna=False):
+        for path, y in x.groupby("classification_path"):
+            rows.append({**dict(zip(keys, key)), "path": path,
+                         "n": len(y), "share_%": 100 * len(y) / len(x),
+                         "classification_acc_%": 100 * hit[y.index].mean(),
+                         "cls_llm_calls_mean": calls[y.index].mean(),
+                         "cls_cost_usd_mean": cost[y.index].mean(),
+                         "knn_margin_mean": y["knn_margin"].mean()})
+    return pd.DataFrame(rows).round(4)
+
+
+def to_latex(t: pd.DataFrame, path: Path, caption: str, label: str,
+             cols: Optional[List[str]] = None):
+    cols = cols or ["method", "model_profile", "n_instances",
+                    "n_unique_instances", "acc_optimal_%",
+                    "acc_formulation_%", "llm_calls_mean", "tool_calls_mean",
+                    "prompt_tok_mean", "completion_tok_mean", "cost_usd_mean",
+                    "latency_s_mean"]
     cols = [c for c in cols if c in t.columns]
     sub = t[cols]
 
@@ -381,12 +577,32 @@ def main():
     if not sb.empty:
         sb.to_csv(args.out / "stage_breakdown.csv", index=False)
 
+    calls = load_calls(args.runs_dir)
+    calls = calls[calls["run_id"].isin(df["run_id"].unique())]
+    lt = latency_table(calls, df)
+    if not lt.empty:
+        lt.to_csv(args.out / "latency_table.csv", index=False)
+        to_latex(lt, args.out / "latency_table.tex",
+                 "Per-call latency percentiles by stage, model and provider, "
+                 "time to first token for streamed calls, output throughput, "
+                 "and instances per hour for the whole run.",
+                 "tab:latency",
+                 cols=["method", "type", "stage", "model", "n_calls",
+                       "n_instances", "latency_s_p50", "latency_s_p90", "latency_s_p99",
+                       "ttft_s_p50", "tokens_per_s_p50",
+                       "instances_per_hour"])
+
     cr = classification_report(df, args.out)
     if not cr.empty:
         cr.to_csv(args.out / "classification.csv", index=False)
 
     print(ct.to_string(index=False))
 
+    if "cache_hit_%" in ct.columns and (ct["cache_hit_%"] > 0).any():
+        print("\nnote: some LLM calls were replayed from the response cache "
+              "(cache_hit_% > 0). cost_usd counts only what was paid; latency "
+              "for those rows is not provider latency.")
+
     if len(ct_run) > len(ct):
         cols = [c for c in ("run_id", "n_instances", "n_unique_instances",
                             "acc_optimal_%", "cost_usd_total", "latency_s_mean")
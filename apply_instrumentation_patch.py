@@ -36,6 +36,22 @@ What the patch does
    still appends a row (the old `except: continue` dropped rows, which made
    the result columns line up with the wrong queries).
 7. Redirects result CSVs into the run directory.
+8. Replaces the per-row `df.iterrows()` serialisation loops with
+   `lx.table_rows` / `lx.table_documents` (same text, built column-wise).
+9. Hands the modelling-agent prefixes and the get_code prompt to
+   `lx.agent_kwargs` / `lx.assemble_prompt` as (kind, text) parts, so
+   `prompt_layout` can move the per-instance pieces behind the static ones.
+10. Appends `*lx.data_tools(CFG, dataset_address)` to the data agents' tool
+   lists: the read-only SQL tool when `sql_tool.enabled`, otherwise nothing.
+11. Builds the stores behind `lx.build_retriever` with `lx.build_store`, so
+   `retrievers.<name>.search: bm25` replaces the FAISS index (and the
+   embedding calls) with an in-process BM25 index.
+12. Does the same for the Air-NRM stores built inside Classification_Agent,
+   New_Vectors_Flight / _Demand, FlowAgent and CA_Agent, so the index
+   registry reuses them across instances instead of re-embedding.
+13. Passes every agent's tool list through `lx.early_tools(CFG, ...)`: with
+   `agent_early_tool_start` and a streaming model the tool starts as soon as
+   the streamed Action Input is complete; otherwise the list is unchanged.
 
 Every rule declares how many matches it expects; a mismatch aborts the patch
 rather than silently producing a half-instrumented notebook.
@@ -143,6 +159,99 @@ AGENT_TAIL_RE = re.compile(
 
 TO_CSV_RE = re.compile(r'\.to_csv\(\s*(?P<q>["\'])(?P<name>[^"\']+\.csv)(?P=q)')
 
+# modelling-agent prefix with the retrieved few-shot list in the middle; the
+# brace-free text around it is kept verbatim so "original" layout is exact
+FEWSHOT_PREFIX_RE = re.compile(
+    r'(?P<ind>[ \t]*)prefix = f"""(?P<head>[^{}"]*)\{few_shot_examples\}'
+    r'(?P<tail>[^{}"]*)"""')
+
+GET_CODE_HEAD_RE = re.compile(
+    r'(?P<ind>[ \t]*)prompt = f"""\n(?P<instr>[ \t]*You are an expert in '
+    r'mathematical optimization[^\n]*\n)(?P<model>\n[ \t]*Mathematical '
+    r'Optimization Model:\n[ \t]*\{output\}\n[ \t]*)"""\n')
+
+# The notebooks' row-serialisation loops, shape by shape. Every replacement
+# produces the same strings (see lx.table_rows); only the per-row Series that
+# iterrows builds is gone. `ind` is the indentation of the `for` line.
+_KV = r'", "\.join\(\[?f"\{(?P<c>col|c)\}(?P<sep> = |=)\{(?P<r>row|r)\[(?P=c)\]\}" for (?P=c) in (?P<df>\w+)\.columns\]?\)'
+ROW_LOOP_RULES = [
+    # documents.append(Document(page_content=...)) per row
+    (re.compile(
+        r'(?P<ind>[ \t]*)for row_idx, row in df\.iterrows\(\):\n'
+        r'[ \t]*page_content = ' + _KV + r'\n'
+        r'[ \t]*documents\.append\(Document\(page_content=page_content\)\)'),
+     lambda m: f'{m["ind"]}documents.extend(lx.table_documents(df))'),
+    # ... and with metadata={"source": file_name}
+    (re.compile(
+        r'(?P<ind>[ \t]*)for row_idx, row in df\.iterrows\(\):\n'
+        r'[ \t]*page_content = ' + _KV + r'\n'
+        r'(?:[ \t]*(?:#[^\n]*)?\n)*'
+        r'[ \t]*metadata = \{"source": file_name\}\n'
+        r'(?:[ \t]*(?:#[^\n]*)?\n)*'
+        r'[ \t]*documents\.append\(Document\(page_content=page_content, '
+        r'metadata=metadata\)\)'),
+     lambda m: f'{m["ind"]}documents.extend(lx.table_documents(df, file_name))'),
+    # data.append(description + "\n"), optionally with a "Product id" lead
+    (re.compile(
+        r'(?P<ind>[ \t]*)for i, r in df\.iterrows\(\):\n'
+        r'[ \t]*description = f?"(?P<lead>(?:Product id: \{i\+1\}; )?)"\n'
+        r'[ \t]*description \+= ' + _KV + r'\n'
+        r'[ \t]*data\.append\(description \+ "\\n"\)'),
+     lambda m: (f'{m["ind"]}data.extend(f"Product id: {{i+1}}; {{row}}\\n" for i, row\n'
+                f'{m["ind"]}            in zip(df.index, lx.table_rows(df)))'
+                if m["lead"] else
+                f'{m["ind"]}data.extend(row + "\\n" for row in lx.table_rows(df))')),
+    # example_data_description += description + "\n"
+    (re.compile(
+        r'(?P<ind>[ \t]*)for z, r in df\.iterrows\(\):\n'
+        r'[ \t]*description = ""\n'
+        r'[ \t]*description \+= ' + _KV + r'\n'
+        r'[ \t]*example_data_description \+= description \+ "\\n"'),
+     lambda m: (f'{m["ind"]}example_data_description += "".join(\n'
+                f'{m["ind"]}    row + "\\n" for row in lx.table_rows(df))')),
+    # rows concatenated with no separator at all (FLP data_description)
+    (re.compile(
+        r'(?P<ind>[ \t]*)for row_idx, row in df\.iterrows\(\):\n'
+        r'[ \t]*(?P<acc>\w+) \+= ' + _KV),
+     lambda m: f'{m["ind"]}{m["acc"]} += "".join(lx.table_rows(df))'),
+    # gpt-oss: "\n".join(", ".join(f"{col}={row[col]}" ...) for _, row in ...)
+    (re.compile(
+        r'"\\n"\.join\(\n[ \t]*' + _KV + r'\n'
+        r'[ \t]*for _, (?P=r) in (?P=df)\.iterrows\(\)\n[ \t]*\)'),
+     lambda m: f'"\\n".join(lx.table_rows({m["df"]}, sep="{m["sep"]}"))'),
+]
+
+# `X = FAISS.from_texts(items, emb)` directly followed by build_retriever(X)
+STORE_RE = re.compile(
+    r'(?P<ind>[ \t]*)(?P<var>\w+) = FAISS\.from_(?:texts|documents)'
+    r'\((?P<items>[^,\n]+), (?P<emb>\w+)\)(?P<gap>\n(?:[ \t]*\n)*)'
+    r'(?P=ind)(?P<ret>\w+ = lx\.build_retriever\(CFG, (?P=var), "(?P<name>\w+)"\))')
+
+# Air-NRM: FAISS.from_documents(...) inside these functions -> build_store,
+# under the retriever name the store is later queried with
+AIR_STORES = {
+    "Classification_Agent": "refdata",
+    "New_Vectors_Flight": "air_flight",
+    "New_Vectors_Demand": "air_demand",
+    "FlowAgent": "air_examples",
+    "CA_Agent": "air_examples",
+}
+FROM_DOCS_RE = re.compile(r"FAISS\.from_documents\((?P<items>[^,\n]+), (?P<emb>\w+)\)")
+DEF_RE = re.compile(r"^[ \t]*def (\w+)\(", re.M)
+
+# the data agents: the ones built inside get_<X>_response(..., dataset_address)
+DATA_AGENT_FN_RE = re.compile(r"def get_\w+_response\([^)]*dataset_address")
+DATA_AGENT_TOOLS_RE = re.compile(
+    r"(?P<head>initialize_agent\(\s*tools=\[)(?P<tool>qa_tool|CSVQA_TOOL)\]")
+
+# every agent's tool list: a literal (`tools=[qa_tool]`) or a name, passed
+# positionally (`tools,`) or by keyword (`tools=TOOLS`)
+AGENT_TOOLS_RE = re.compile(
+    r"(?P<head>initialize_agent\(\s*(?:tools=)?)"
+    r"(?P<tools>\[[^\]\n]*\]|[A-Za-z_]\w*)(?=\s*,)")
+
+GET_CODE_CALL = "    messages = [\n        HumanMessage(content=prompt)"
+
 # Air-NRM data was split into two cases under one parent folder:
 #   Test_Dataset/Air_NRM/small_scale/   the original 3-airport toy instance
 #   Test_Dataset/Air_NRM/large_scale/   the SQ direct 2-city real-data build
@@ -487,6 +596,158 @@ class Patcher:
             n += 1
         self.expect(n, want if want is not None else n, "gurobipy import")
 
+    def patch_row_loops(self, want=None):
+        """
+        Rows rendered as "col = val, ..." with one iterrows() step each.
+        iterrows builds a pandas Series per row, which on the larger data
+        files (OnlineSalesinUSA.csv, 48k rows) costs seconds per instance
+        before any model is called. lx.table_rows returns the same strings.
+        """
+        n = 0
+        for i, c in enumerate(self.nb["cells"]):
+            if c["cell_type"] != "code":
+                continue
+            s = self.src(i)
+            for pat, rep in ROW_LOOP_RULES:
+                s, k = pat.subn(rep, s)
+                n += k
+            if s != self.src(i):
+                self.set_src(i, s)
+        self.expect(n, want if want is not None else n, "row loops")
+
+    def patch_prompt_layout(self, want_agents=None, want_code=None):
+        """
+        Split the modelling prompts into static / exemplar / instance parts.
+
+        The modelling agents paste the few-shot examples RETRIEVED for the
+        query between two static paragraphs of the prefix, and get_code puts
+        the instance's model between its instructions and the fixed per-class
+        exemplar. Either way the first per-instance token comes early and the
+        provider's prefix cache has almost nothing to reuse across instances.
+        The parts are listed in the original order; with prompt_layout:
+        original the joined text is unchanged.
+        """
+        n_agents = n_code = 0
+        for i, c in enumerate(self.nb["cells"]):
+            if c["cell_type"] != "code":
+                continue
+            s = self.src(i)
+
+            def agent_repl(m):
+                nonlocal n_agents
+                n_agents += 1
+                ind = m.group("ind")
+                return (f'{ind}# retrieved per query -> "instance" part; '
+                        f'see lx.assemble_prompt\n'
+                        f'{ind}prefix = [\n'
+                        f'{ind}    ("static", """{m.group("head")}"""),\n'
+                        f'{ind}    ("instance", f"{{few_shot_examples}}"),\n'
+                        f'{ind}    ("static", """{m.group("tail")}"""),\n'
+                        f'{ind}]')
+
+            s2 = FEWSHOT_PREFIX_RE.sub(agent_repl, s)
+
+            m = GET_CODE_HEAD_RE.search(s2)
+            if m and GET_CODE_CALL in s2:
+                ind = m.group("ind")
+                head = (f'{ind}# instructions, the instance\'s model, then the '
+                        f'class exemplar\n'
+                        f'{ind}# (prompt += below); lx.assemble_prompt orders '
+                        f'them per prompt_layout\n'
+                        f'{ind}instructions = """\n{m.group("instr")}"""\n'
+                        f'{ind}model_block = f"""{m.group("model")}"""\n'
+                        f'{ind}prompt = ""\n')
+                s2 = s2[:m.start()] + head + s2[m.end():]
+                s2 = s2.replace(GET_CODE_CALL, (
+                    '    prompt = lx.assemble_prompt(CFG, [("static", instructions),\n'
+                    '                                      ("instance", model_block),\n'
+                    '                                      ("exemplars", prompt)])\n'
+                    + GET_CODE_CALL), 1)
+                n_code += 1
+            if s2 != s:
+                self.set_src(i, s2)
+        self.expect(n_agents, want_agents if want_agents is not None
+                    else n_agents, "prompt parts (agents)")
+        self.expect(n_code, want_code if want_code is not None else n_code,
+                    "prompt parts (get_code)")
+
+    def patch_stores(self, want=None):
+        """
+        FAISS.from_texts / from_documents -> lx.build_store(CFG, name, ...)
+        wherever the store only feeds lx.build_retriever(CFG, store, name).
+        With the default search: dense build_store makes the same call.
+        """
+        n = 0
+        for i, c in enumerate(self.nb["cells"]):
+            if c["cell_type"] != "code":
+                continue
+            s, k = STORE_RE.subn(
+                r'\g<ind>\g<var> = lx.build_store(CFG, "\g<name>", \g<items>, '
+                r'\g<emb>)\g<gap>\g<ind>\g<ret>', self.src(i))
+            if k:
+                self.set_src(i, s)
+                n += k
+        self.expect(n, want if want is not None else n, "retriever stores")
+
+    def patch_named_stores(self, names: dict, want=None):
+        """
+        FAISS.from_documents(...) -> lx.build_store(CFG, name, ...) inside the
+        functions listed in `names` (function -> retriever name). These stores
+        are rebuilt on every call from the same files; through build_store
+        the index registry builds each once per run.
+        """
+        n = 0
+        for i, c in enumerate(self.nb["cells"]):
+            if c["cell_type"] != "code":
+                continue
+            s = self.src(i)
+
+            def repl(m):
+                nonlocal n
+                fns = DEF_RE.findall(s, 0, m.start())
+                name = names.get(fns[-1]) if fns else None
+                if name is None:
+                    return m.group(0)
+                n += 1
+                return (f'lx.build_store(CFG, "{name}", {m.group("items")}, '
+                        f'{m.group("emb")})')
+
+            new = FROM_DOCS_RE.sub(repl, s)
+            if new != s:
+                self.set_src(i, new)
+        self.expect(n, want if want is not None else n, "named stores")
+
+    def patch_data_tools(self, want=None):
+        """
+        Offer the data agents lx.data_tools() next to their CSVQA tool. The
+        list is empty unless sql_tool.enabled, so by default the agents and
+        their prompts are exactly the original ones.
+        """
+        n = 0
+        for i, c in enumerate(self.nb["cells"]):
+            if c["cell_type"] != "code" or not DATA_AGENT_FN_RE.search(self.src(i)):
+                continue
+            s, k = DATA_AGENT_TOOLS_RE.subn(
+                r"\g<head>\g<tool>, *lx.data_tools(CFG, dataset_address)]",
+                self.src(i))
+            if k:
+                self.set_src(i, s)
+                n += k
+        self.expect(n, want if want is not None else n, "data agent tools")
+
+    def patch_early_tools(self, want=None):
+        """Route each agent's tools through lx.early_tools (rule 13)."""
+        n = 0
+        for i, c in enumerate(self.nb["cells"]):
+            if c["cell_type"] != "code":
+                continue
+            s, k = AGENT_TOOLS_RE.subn(
+                r"\g<head>lx.early_tools(CFG, \g<tools>)", self.src(i))
+            if k:
+                self.set_src(i, s)
+                n += k
+        self.expect(n, want if want is not None else n, "agent tool lists")
+
     def patch_to_csv(self, want=None):
         n = 0
         for i, c in enumerate(self.nb["cells"]):
@@ -656,6 +917,10 @@ def run_test(test, agent, log=LOG, cfg=CFG):
     def csv_detect(row):
         return 1 if 'Dataset_address' in row.index else 0
 
+    # one batched embedding call for every query up front; the per-instance
+    # retrievals of the same text are then served from memory
+    lx.prefetch_queries(cfg, EMBEDDINGS, test['Query'])
+
     for index, row in test.iterrows():
         query = row['Query']
         # 'Problem Type' is what Large-scale-or-101.csv actually calls it;
@@ -923,6 +1188,8 @@ def patch_air_nrm_41(check):
         10: ["air_flight", "air_flight", "air_demand", "air_examples"],
     })
     p.patch_agents(want=3)
+    p.patch_named_stores(AIR_STORES, want=5)
+    p.patch_early_tools(want=3)
     p.patch_process_input(12)
     p.patch_batch_loop(14)
     p.patch_to_csv()
@@ -954,6 +1221,8 @@ def patch_air_nrm_oss(check):
         10: ["air_flight", "air_flight", "air_demand", "air_examples"],
     })
     p.patch_agents(want=(0, 1, 2, 3))
+    p.patch_named_stores(AIR_STORES, want=5)
+    p.patch_early_tools(want=3)
     p.patch_process_input(12)
     p.patch_batch_loop(14)
     p.patch_to_csv()
@@ -981,6 +1250,11 @@ def patch_large_41(check):
         19: ["examples_others_nocsv"],
     })
     p.patch_agents(want=7)
+    p.patch_row_loops(want=9)
+    p.patch_prompt_layout(want_agents=5, want_code=1)
+    p.patch_data_tools(want=5)
+    p.patch_stores(want=12)
+    p.patch_early_tools(want=7)
     p.replace_cell(23, RUN_TEST_LARGE, "def run_test")
     p.patch_to_csv()
     p.patch_read_back()
@@ -1013,6 +1287,11 @@ def patch_large_oss(check):
         22: ["oss_examples_nocsv"],
     })
     p.patch_agents(want=(0, 1, 2, 3, 4, 5, 6))
+    p.patch_row_loops(want=9)
+    p.patch_prompt_layout(want_agents=0, want_code=1)
+    p.patch_data_tools(want=5)
+    p.patch_stores(want=4)
+    p.patch_early_tools(want=6)
     p.replace_cell(24, RUN_TEST_OSS_LARGE + "\n\n" +
                    _tail_of_cell(p, 24, "def read_and_combine_csvs"),
                    "def run_test")
@@ -1033,7 +1312,8 @@ def _tail_of_cell(p: Patcher, cell: int, marker: str) -> str:
     return s[idx:]
 
 
-def patch_ablation(path_name, method, check, retrievers=None, air_nrm_paths=0):
+def patch_ablation(path_name, method, check, retrievers=None, air_nrm_paths=0,
+                   stores=0):
     p = Patcher(_orig(path_name), "gpt-4.1", method, "Air-NRM-CA")
     p.insert_config(4)
     p.patch_air_nrm_paths(want=air_nrm_paths)
@@ -1043,6 +1323,8 @@ def patch_ablation(path_name, method, check, retrievers=None, air_nrm_paths=0):
     if retrievers:
         p.patch_retrievers(retrievers)
     p.patch_agents()
+    p.patch_named_stores(AIR_STORES, want=stores)
+    p.patch_early_tools(want=3)
     # Process_Input / Batch cells are located by content, not by index
     for i, c in enumerate(p.nb["cells"]):
         if c["cell_type"] != "code":
@@ -1094,11 +1376,11 @@ def main():
              {6: ["refdata"],
               9: ["air_flight", "air_flight", "air_demand", "air_examples"],
               10: ["air_flight", "air_flight", "air_demand", "air_examples"]},
-             air_nrm_paths=6)),
+             air_nrm_paths=6, stores=5)),
         ("Ablation_Study_Air_NRM_Few-shot_Only",
          lambda c: patch_ablation(
              "Ablation_Study_Air_NRM_Few-shot_Only.ipynb", "Abl-FewShotOnly", c,
-             {5: ["refdata"]}, air_nrm_paths=15)),
+             {5: ["refdata"]}, air_nrm_paths=15, stores=1)),
         ("Benchmark_Base_Model_Small_Scale", patch_benchmark),
     ]
 
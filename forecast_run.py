@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+forecast_run.py
+===============
+Cost and wall-clock of a full run, forecast before any money is spent.
+
+    python forecast_run.py --dataset Large-Scale-OR --profile gpt-4.1
+    python forecast_run.py --dataset Air-NRM --profile gpt-4.1 --concurrency 8
+    python forecast_run.py --dataset Large-Scale-OR --profile gpt-5.2 \\
+        --method LEAN-LLM-OPT --runs runs/ --level 0.95
+
+Why this exists
+---------------
+`run_baseline.py --dry-run` sizes the single-call baseline's prompts, but the
+pipeline makes a varying number of calls per instance, and the advice so far
+has been "run 3 instances and multiply". That ignores which instances the 3
+were: a run whose first rows have small tables underestimates one whose tail
+has the 2,000-row ones, and "multiply" says nothing about how wrong it can be.
+
+How it forecasts
+----------------
+The history is every logged instance of the same method and profile (same
+dataset if there is any, else any dataset; else any profile, repriced at this
+profile's prices). For every instance of the run to forecast:
+
+  1. its input size is _estimate_tokens(query + data section), the data
+     section built exactly as run_baseline.py inlines it;
+  2. a history instance of the same problem type is drawn (the dataset's gold
+     type stands in for the type the classifier will predict; history uses
+     pred_type) -- that gives calls per stage, tokens, completion/prompt ratio
+     and wall time;
+  3. its prompt tokens per call are shifted by slope x (input size difference),
+     the slope fitted per stage on the history; completion tokens follow the
+     drawn instance's completion/prompt ratio; cost is priced per stage model;
+  4. its wall time moves by the extra completion tokens at the profile's
+     median decode rate (tokens/s from calls.jsonl).
+
+Each simulation first resamples the history itself (bootstrap), so a forecast
+from 3 instances comes with the wide interval it deserves. The run's wall
+clock is the makespan of the instance times on --concurrency workers taking
+instances in dataset order, as lx.run_instances_async does. Provider throttling
+at high concurrency is not modelled: the latencies are those of the history.
+"""
+
+from __future__ import annotations
+
+import argparse
+import heapq
+import re
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import yaml
+
+import aggregate_runs
+import leanopt_exp as lx
+from run_baseline import build_data_section, load_dataset
+
+HERE = Path(__file__).parent
+
+_STAGE_RE = re.compile(r"^stage::(.+)::(calls|prompt_tokens|completion_tokens|"
+                       r"cached_prompt_tokens|cost_usd|latency_s)$")
+
+
+# --------------------------------------------------------------------------- #
+def input_tokens(query: Any, dataset_address: Any, encoding: str,
+                 table_format: str = "kv", max_rows_per_file: int = 200,
+                 max_chars: int = 120_000) -> int:
+    """What an instance hands the pipeline: its query plus its data files, as
+    the single-call baseline would inline them."""
+    data, _ = build_data_section(dataset_address, max_rows_per_file,
+                                 max_chars, table_format)
+    return (lx._estimate_tokens(str(query or ""), encoding)
+            + lx._estimate_tokens(data, encoding))
+
+
+def dataset_inputs(cfg: lx.ExpConfig, test: pd.DataFrame) -> pd.DataFrame:
+    """instance_id, input_tokens and type for every row of a dataset."""
+    colmap = lx.resolve_columns(cfg, test.columns)
+    if not colmap["query"]:
+        raise SystemExit(f"no query column found; have {list(test.columns)}")
+    rows = []
+    for idx, row in test.iterrows():
+        get = lambda f: row.get(colmap[f]) if colmap.get(f) else None  # noqa: E731
+        rows.append({"instance_id": idx,
+                     "input_tokens": input_tokens(
+                         get("query"), get("dataset_address"),
+                         cfg.token_fallback_encoder, cfg.table_format),
+                     "type": _norm_type(get("gold_type"))})
+    return pd.DataFrame(rows)
+
+
+def _norm_type(t: Any) -> Optional[str]:
+    if t is None or (isinstance(t, float) and np.isnan(t)):
+        return None
+    return str(t).strip().lower() or None
+
+
+# --------------------------------------------------------------------------- #
+def select_history(inst: pd.DataFrame, method: str, profile: str,
+                   dataset: str) -> Tuple[pd.DataFrame, str]:
+    """The closest history there is, and a line saying which one it was."""
+    m = inst["method"] == method
+    p = inst["model_profile"] == profile
+    d = inst["dataset"] == dataset
+    for mask, what in ((m & p & d, "same method, profile and dataset"),
+                       (m & p, "same method and profile, other datasets"),
+                       (m, "same method, other profiles -- repriced at "
+                           f"{profile}'s prices")):
+        if mask.any():
+            return inst[mask].reset_index(drop=True), what
+    raise SystemExit(
+        f"no logged instance of method {method!r} under the runs directory; "
+        f"run a few first (e.g. the notebook's first 3 rows) so there is "
+        f"something to forecast from")
+
+
+def stage_long(hist: pd.DataFrame) -> pd.DataFrame:
+    """One row per (history instance, stage) from the stage::* columns."""
+    cols = {}
+    for c in hist.columns:
+        mt = _STAGE_RE.match(c)
+        if mt:
+            cols.setdefault(mt.group(1), {})[mt.group(2)] = c
+    parts = []
+    for stage, m in cols.items():
+        part = pd.DataFrame({"h": hist.index, "stage": stage})
+        for k in ("calls", "prompt_tokens", "completion_tokens",
+                  "cached_prompt_tokens", "cost_usd"):
+            part[k] = pd.to_numeric(hist[m[k]], errors="coerce").fillna(0.0) \
+                if k in m else 0.0
+        parts.append(part)
+    if not parts:
+        return pd.DataFrame(columns=["h", "stage", "calls", "prompt_tokens",
+                                     "completion_tokens",
+                                     "cached_prompt_tokens", "cost_usd"])
+    out = pd.concat(parts, ignore_index=True)
+    return out[out["calls"] > 0].reset_index(drop=True)
+
+
+def fit_slopes(long: pd.DataFrame, x: np.ndarray) -> Dict[str, float]:
+    """Per stage, prompt tokens per call against the instance's input size
+    (least squares, clipped at 0). Fewer than 3 distinct sizes: slope 0, the
+    drawn instance's prompt is used as it was."""
+    out = {}
+    for stage, g in long.groupby("stage"):
+        xs = x[g["h"].to_numpy()]
+        ok = ~np.isnan(xs)
+        ys = (g["prompt_tokens"] / g["calls"]).to_numpy()[ok]
+        xs = xs[ok]
+        if len(np.unique(xs)) < 3:
+            out[stage] = 0.0
+            continue
+        slope = np.polyfit(xs, ys, 1)[0]
+        out[stage] = max(float(slope), 0.0)
+    return out
+
+
+def stage_models(calls: pd.DataFrame) -> Dict[Tuple[str, Any, str], str]:
+    """(run_id, instance_id, stage) -> the model most of its LLM calls used."""
+    c = calls[(calls["type"] == "llm") & calls["model"].notna()]
+    if c.empty:
+        return {}
+    top = (c.groupby(["run_id", "instance_id", "stage"])["model"]
+            .agg(lambda s: s.value_counts().index[0]))
+    return {(r, str(i), s): m for (r, i, s), m in top.items()}
+
+
+def decode_rate(calls: pd.DataFrame) -> Optional[float]:
+    """Median completion tokens per second after the first token."""
+    c = calls[(calls["type"] == "llm") & ~calls["cache_hit"].fillna(False)
+              .astype(bool)]
+    lat = pd.to_numeric(c["latency_s"], errors="coerce")
+    dec = lat - pd.to_numeric(c["ttft_s"], errors="coerce").fillna(0.0)
+    tps = pd.to_numeric(c["completion_tokens"], errors="coerce") / dec
+    tps = tps[(dec > 0) & tps.notna() & (tps > 0)]
+    return float(tps.median()) if len(tps) else None
+
+
+def _cost(spec: Optional[lx.ModelSpec], prompt: np.ndarray, cached: np.ndarray,
+          completion: np.ndarray) -> np.ndarray:
+    """The tracker's pricing (UsageTracker.on_llm_end), vectorised."""
+    if spec is None or spec.price_in_per_1m is None \
+            or spec.price_out_per_1m is None:
+        return np.zeros_like(prompt)
+    return (np.maximum(prompt - cached, 0) * spec.price_in_per_1m
+            + cached * (spec.price_cached_in_per_1m or 0.0)
+            + completion * spec.price_out_per_1m) / 1e6
+
+
+# --------------------------------------------------------------------------- #
+def makespan(walls: np.ndarray, concurrency: int) -> float:
+    """Instances taken in order by whichever of `concurrency` workers frees
+    up first."""
+    free = [0.0] * max(int(concurrency), 1)
+    for w in walls:
+        heapq.heappush(free, heapq.heappop(free) + float(w))
+    return max(free)
+
+
+def forecast(cfg: lx.ExpConfig, targets: pd.DataFrame, hist: pd.DataFrame,
+             calls: pd.DataFrame, concurrency: int = 1, n_sims: int = 1000,
+             level: float = 0.9, seed: int = 0) -> Dict[str, Any]:
+    """
+    targets: instance_id, input_tokens, type (one row per instance to run).
+    hist:    history instances (aggregate_runs.load_instances rows) with an
+             input_tokens column (NaN where unknown).
+    calls:   aggregate_runs.load_calls rows for the same runs.
+    """
+    hist = hist.reset_index(drop=True)
+    long = stage_long(hist)
+    x_h = pd.to_numeric(hist["input_tokens"], errors="coerce").to_numpy(float)
+    x_t = targets["input_tokens"].to_numpy(float)
+    slopes = fit_slopes(long, x_h)
+    models = stage_models(calls)
+    tracker = lx.UsageTracker(cfg)
+    tps = decode_rate(calls)
+
+    n_t, n_h = len(targets), len(hist)
+    # (target, history) -> what that target costs / takes if it behaves like
+    # that history instance; a simulation only picks columns
+    dx = x_t[:, None] - x_h[None, :]
+    dx[np.isnan(dx)] = 0.0
+    cost = np.zeros((n_t, n_h))
+    extra_completion = np.zeros((n_t, n_h))
+    by_stage: Dict[str, np.ndarray] = {}
+    for r in long.itertuples(index=False):
+        h = r.h
+        key = (hist.at[h, "run_id"], str(hist.at[h, "instance_id"]), r.stage)
+        spec = tracker._price(models.get(key))
+        per_call = max(r.prompt_tokens / r.calls, 0.0)
+        prompt = np.maximum(per_call + slopes.get(r.stage, 0.0) * dx[:, h],
+                            0.0) * r.calls
+        ratio = (r.completion_tokens / r.prompt_tokens
+                 if r.prompt_tokens else 0.0)
+        completion = (prompt * ratio if r.prompt_tokens
+                      else np.full(n_t, float(r.completion_tokens)))
+        cached = prompt * (r.cached_prompt_tokens / r.prompt_tokens
+                           if r.prompt_tokens else 0.0)
+        c = _cost(spec, prompt, cached, completion)
+        cost[:, h] += c
+        by_stage.setdefault(r.stage, np.zeros((n_t, n_h)))[:, h] += c
+        extra_completion[:, h] += completion - r.completion_tokens
+    # embeddings and anything else that is not an LLM call, as logged
+    other = (pd.to_numeric(hist["cost_usd"], errors="coerce").fillna(0.0)
+             - long.groupby("h")["cost_usd"].sum().reindex(
+                 hist.index, fill_value=0.0)).clip(lower=0.0).to_numpy()
+    cost += other[None, :]
+    wall_h = pd.to_numeric(hist["wall_s"], errors="coerce").fillna(0.0) \
+        .to_numpy(float)
+    wall = wall_h[None, :] + (extra_completion / tps if tps else 0.0)
+    wall = np.maximum(wall, 0.0)
+
+    # which history instances a target may be drawn from
+    h_type = [_norm_type(t) for t in hist.get("pred_type",
+                                               pd.Series([None] * n_h))]
+    pools: Dict[Optional[str], np.ndarray] = {}
+    for t in targets["type"].unique():
+        same = np.array([ht == t for ht in h_type]) if t else np.zeros(n_h, bool)
+        pools[t] = same if same.any() else np.ones(n_h, bool)
+
+    rng = np.random.default_rng(seed)
+    totals, walls = np.empty(n_sims), np.empty(n_sims)
+    rows = np.arange(n_t)
+    for s in range(n_sims):
+        w = rng.multinomial(n_h, np.full(n_h, 1.0 / n_h)).astype(float)
+        pick = np.empty(n_t, dtype=int)
+        for t, pool in pools.items():
+            idx = np.flatnonzero((targets["type"] == t).to_numpy()
+                                 if t is not None
+                                 else targets["type"].isna().to_numpy())
+            p = w * pool
+            if p.sum() == 0:                     # resample lost this type
+                p = w if w.sum() else pool.astype(float)
+            pick[idx] = rng.choice(n_h, size=len(idx), p=p / p.sum())
+        totals[s] = cost[rows, pick].sum()
+        walls[s] = makespan(wall[rows, pick], concurrency)
+
+    lo, hi = (1 - level) / 2, 1 - (1 - level) / 2
+    weights = np.stack([pools[t] for t in targets["type"]]).astype(float)
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    def expect(m):
+        return float((m * weights).sum())
+
+    stages = []
+    for stage, g in long.groupby("stage"):
+        stages.append({
+            "stage": stage,
+            "calls_per_instance": g["calls"].sum() / n_h,
+            "prompt_per_call": g["prompt_tokens"].sum() / g["calls"].sum(),
+            "completion_per_prompt": (g["completion_tokens"].sum()
+                                      / max(g["prompt_tokens"].sum(), 1)),
+            "slope": slopes.get(stage, 0.0),
+            "usd": expect(by_stage[stage]),
+        })
+    return {
+        "n_instances": n_t, "n_history": n_h,
+        "history_runs": int(hist["run_id"].nunique()),
+        "concurrency": concurrency, "level": level,
+        "cost_usd": float(np.median(totals)),
+        "cost_usd_ci": (float(np.quantile(totals, lo)),
+                        float(np.quantile(totals, hi))),
+        "wall_s": float(np.median(walls)),
+        "wall_s_ci": (float(np.quantile(walls, lo)),
+                      float(np.quantile(walls, hi))),
+        "decode_tokens_per_s": tps,
+        # the "run 3 and multiply" number, for comparison
+        "naive_cost_usd": float(pd.to_numeric(hist["cost_usd"],
+                                              errors="coerce").mean() * n_t),
+        "stages": pd.DataFrame(stages),
+    }
+
+
+def _hms(sec: float) -> str:
+    sec = int(round(sec))
+    return f"{sec // 3600:d}:{sec % 3600 // 60:02d}:{sec % 60:02d}"
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dataset", required=True)
+    ap.add_argument("--profile", required=True)
+    ap.add_argument("--method", default="LEAN-LLM-OPT")
+    ap.add_argument("--runs", type=Path, default=HERE / "runs",
+                    help="where the history is (runs/*/instances.jsonl)")
+    ap.add_argument("--limit", type=int, default=None,
+                    help="forecast only the first N instances")
+    ap.add_argument("--rows", default=None,
+                    help="comma-separated row indices, as in run_baseline.py")
+    ap.add_argument("--concurrency", type=int, default=1)
+    ap.add_argument("--level", type=float, default=0.9,
+                    help="confidence level of the intervals")
+    ap.add_argument("--sims", type=int, default=2000)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    cfg_raw = yaml.safe_load((HERE / "exp_config.yaml").read_text(encoding="utf-8"))
+    cfg = lx.load_config(HERE / "exp_config.yaml", model_profile=args.profile,
+                         method=args.method, dataset=args.dataset)
+    test = load_dataset(args.dataset, cfg_raw)
+    if args.rows:
+        test = test.loc[[int(x) for x in args.rows.split(",") if x.strip()]]
+    if args.limit:
+        test = test.head(args.limit)
+    targets = dataset_inputs(cfg, test)
+
+    inst = aggregate_runs.load_instances(args.runs)
+    hist, what = select_history(inst, args.method, args.profile, args.dataset)
+    # the history's input sizes, from the rows of the datasets it ran on
+    sizes: Dict[Tuple[str, str], int] = {}
+    for ds in hist["dataset"].dropna().unique():
+        try:
+            d_cfg = lx.load_config(HERE / "exp_config.yaml",
+                                   model_profile=args.profile,
+                                   method=args.method, dataset=ds)
+            d_in = dataset_inputs(d_cfg, load_dataset(ds, cfg_raw)) \
+                if ds != args.dataset else targets
+        except SystemExit:
+            continue
+        sizes.update({(ds, str(i)): v for i, v in
+                      zip(d_in["instance_id"], d_in["input_tokens"])})
+    hist["input_tokens"] = [sizes.get((d, str(i)), np.nan)
+                            for d, i in zip(hist["dataset"], hist["instance_id"])]
+    calls = aggregate_runs.load_calls(args.runs)
+    calls = calls[calls["run_id"].isin(hist["run_id"])]
+
+    f = forecast(cfg, targets, hist, calls, concurrency=args.concurrency,
+                 n_sims=args.sims, level=args.level, seed=args.seed)
+    pct = f"{100 * args.level:g}%"
+    print(f"[forecast] {args.dataset} | {args.method} | {args.profile} | "
+          f"{f['n_instances']} instances | concurrency {args.concurrency}")
+    print(f"[forecast] history: {f['n_history']} instances from "
+          f"{f['history_runs']} run(s) ({what})")
+    print(f"[forecast] input size (query + data): median "
+          f"{targets['input_tokens'].median():,.0f} tokens "
+          f"(history {hist['input_tokens'].median():,.0f})")
+    lo, hi = f["cost_usd_ci"]
+    print(f"cost   ${f['cost_usd']:.2f}   {pct} CI ${lo:.2f} - ${hi:.2f}   "
+          f"(history mean x N: ${f['naive_cost_usd']:.2f})")
+    lo, hi = f["wall_s_ci"]
+    print(f"wall   {_hms(f['wall_s'])}   {pct} CI {_hms(lo)} - {_hms(hi)}")
+    if not f["stages"].empty:
+        print("\nper stage (history; usd = expected per run):")
+        print(f["stages"].round(3).to_string(index=False))
+    budget = cfg.budget_usd_per_run
+    if budget and f["cost_usd_ci"][1] > budget:
+        print(f"\n[forecast] the upper bound is above budget_usd_per_run "
+              f"(${budget:.2f}): the run may stop with BudgetExceeded")
+    print("no API calls made")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -52,6 +52,7 @@ Then:  python aggregate_runs.py runs/ -o tables/
 
 from __future__ import annotations
 
+import asyncio
 import contextlib
 import contextvars
 import dataclasses
@@ -59,23 +60,32 @@ import hashlib
 import json
 import os
 import platform
+import re
 import subprocess
 import sys
 import threading
 import time
 import uuid
+import warnings
+from collections import Counter, OrderedDict, deque
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 __all__ = [
     "ExpConfig", "ModelSpec", "load_config", "build_llm", "build_embeddings",
-    "build_retriever", "agent_kwargs", "UsageTracker", "TRACKER", "stage",
-    "ensure_api_keys", "load_refdata", "load_refdata_docs",
-    "refdata_token_report",
-    "RunLogger", "InstanceRecord", "call_with_retry", "environment_manifest",
-    "dataset_fingerprint",
+    "prefetch_queries", "IndexRegistry", "INDEXES", "ResourceSampler",
+    "RESOURCES", "chrome_trace", "export_trace", "early_tools",
+    "EarlyToolStart", "EARLY_TOOLS", "cascade_first", "CASCADE",
+    "build_retriever", "adaptive_k", "build_store", "BM25Index", "agent_kwargs",
+    "assemble_prompt", "UsageTracker", "TRACKER", "stage", "ensure_api_keys",
+    "load_refdata", "load_refdata_docs", "refdata_token_report", "TABLE_FORMATS", "serialize_table", "table_rows",
+    "table_documents", "table_format_report", "http_client", "clear_clients",
+    "ResponseCache", "response_cache", "KnnClassifier", "BatchClassifier",
+    "build_classifier", "SqlTool", "data_tools", "SQL_TOOLS",
+    "RunLogger", "InstanceRecord", "call_with_retry", "ainvoke_with_retry",
+    "run_instances_async", "environment_manifest", "dataset_fingerprint",
 ]
 
 # Repository root. Dataset paths in exp_config.yaml are written relative to it,
@@ -107,6 +117,18 @@ class ModelSpec:
     # gateway (OpenRouter, vLLM, Azure) use its own key without touching
     # OPENAI_API_KEY.
     api_key_env: str = "OPENAI_API_KEY"
+    # Stream the reply. The tracker then sees every token: time to first and
+    # last token per call, and agents can start a tool before the generation
+    # is closed (agent_early_tool_start). Usage comes from the final chunk.
+    stream: bool = False
+    # Tokens the model accepts (prompt + completion) and how many of them to
+    # keep for the reply (None: max_tokens). Only adaptive retrieval k reads
+    # them -- see adaptive_k.
+    context_window: Optional[int] = None
+    output_reserve: Optional[int] = None
+    # Try a cheaper model first: {first: {model: ..., price_*: ...},
+    # escalate_on: {...}}. See CascadeChatModel.
+    cascade: Optional[Dict[str, Any]] = None
     extra: Dict[str, Any] = field(default_factory=dict)
 
 
@@ -132,6 +154,17 @@ class ExpConfig:
     embedding_api_key_env: str = "OPENAI_API_KEY"
     # USD per 1M tokens for the embedding model (0 for local models).
     embedding_price_per_1m: float = 0.02
+    # Reuse / eviction / per-instance freeing of vector stores -- see
+    # IndexRegistry. Patterns are fnmatch globs over retriever names.
+    index_registry: Dict[str, Any] = field(default_factory=lambda: {
+        "enabled": True, "max_bytes": 512 * 2**20,
+        "pin": ["refdata", "oss_refdata", "examples_*", "oss_examples*",
+                "air_examples"],
+        "per_instance": ["data_*", "oss_data_*"],
+    })
+    # Embed the whole test set's queries in one embed_documents call before
+    # the instance loop -- see prefetch_queries.
+    embedding_prefetch: bool = True
 
     # --- retrieval ------------------------------------------------------- #
     # Per-call-site retrieval settings, e.g.
@@ -142,6 +175,20 @@ class ExpConfig:
     retriever_k: Dict[str, int] = field(default_factory=lambda: {"default": 5})
     retriever_max_tokens_limit: Optional[int] = None
     retriever_search_type: str = "similarity"
+    # How retrieved table rows are shown to the model (kv | csv | markdown |
+    # matrix); a retrievers.<name>.table_format entry overrides it. See
+    # serialize_table.
+    table_format: str = "kv"
+    # dense (FAISS over embeddings) | bm25 | hybrid, for stores built with
+    # build_store; a retrievers.<name>.search entry overrides it.
+    retriever_search: str = "dense"
+    # `k: auto` on a retriever sizes k from the table and the context window
+    # of `role`'s model; the other keys are the defaults of the per-retriever
+    # overrides (share / k_min / k_max / role). See adaptive_k.
+    adaptive_k: Dict[str, Any] = field(default_factory=lambda: {
+        "role": "data_agent", "share": 0.25, "k_min": 1, "k_max": None,
+        "sample_rows": 50,
+    })
 
     # --- classification ---------------------------------------------------- #
     # Which RefData columns the classifier is allowed to see. Dropping `Label`
@@ -160,6 +207,21 @@ class ExpConfig:
     agent_early_stopping_method: str = "force"
     handle_parsing_errors: bool = True
     verbose: bool = False
+    # Order of the prompt pieces built by assemble_prompt / agent_kwargs:
+    # "original" keeps each call site's order, "cache_friendly" moves the
+    # per-instance pieces to the end -- see assemble_prompt.
+    prompt_layout: str = "original"
+    # Start a ReAct agent's tool as soon as its streamed Action Input is
+    # complete, ahead of the executor -- see EarlyToolStart. Needs the
+    # agent's model to have stream: true.
+    agent_early_tool_start: bool = False
+    # Read-only SQL over the instance's CSVs, offered to the data agents as an
+    # extra tool -- see SqlTool. Off by default: a new tool changes the prompt.
+    sql_tool: Dict[str, Any] = field(default_factory=lambda: {
+        "enabled": False, "name": "CSVSQL", "max_rows": 200,
+        "max_bytes": 16000, "timeout_s": 30.0, "table_format": "csv",
+        "threads": 1,
+    })
 
     # --- execution ------------------------------------------------------- #
     seed: int = 20250101
@@ -172,9 +234,35 @@ class ExpConfig:
     # Hard stop for a single run. 0 disables it. The check happens after each
     # instance, so the overshoot is bounded by one instance.
     budget_usd_per_run: float = 0.0
+    # Instances in flight at once under run_instances_async(). The sequential
+    # LOG.instance() loop ignores it.
+    async_concurrency: int = 16
+    # Connection pooling for the provider clients -- see http_client().
+    http: Dict[str, Any] = field(default_factory=lambda: {
+        "reuse_models": True, "max_connections": 64,
+        "max_keepalive_connections": 32, "keepalive_expiry_s": 60.0,
+        "http2": False,
+    })
+    # Replay of identical requests from a local SQLite file -- see
+    # ResponseCache. mode: off | read-write | read-only | record.
+    llm_cache: Dict[str, Any] = field(default_factory=lambda: {
+        "mode": "off", "path": "runs/llm_cache.sqlite",
+        "system_fingerprint": "any", "allow_sampling": False,
+    })
 
     # --- logging --------------------------------------------------------- #
     out_dir: str = "runs"
+    # CPU / memory / GC / thread / disk figures per instance -- see
+    # ResourceSampler. interval_s is how often RSS and threads are sampled.
+    telemetry: Dict[str, Any] = field(default_factory=lambda: {
+        "enabled": True, "interval_s": 0.25,
+    })
+    # Timeline of every instance (stages, agents/chains, tools, retrievers,
+    # LLM calls) as Chrome trace JSON -- see chrome_trace. chains: record
+    # chain spans; write_on_close: write runs/<run_id>/trace.json on close().
+    trace: Dict[str, Any] = field(default_factory=lambda: {
+        "chains": True, "write_on_close": True,
+    })
     log_prompts: bool = True           # dumps full prompts -> referee 1 Q4
     log_raw_responses: bool = True
     token_fallback_encoder: str = "o200k_base"
@@ -208,6 +296,8 @@ class ExpConfig:
         if "max_tokens_limit" not in cfg and self.retriever_max_tokens_limit:
             cfg["max_tokens_limit"] = self.retriever_max_tokens_limit
         cfg.setdefault("search_type", self.retriever_search_type)
+        cfg.setdefault("table_format", self.table_format)
+        cfg.setdefault("search", self.retriever_search)
         return cfg
 
     def to_dict(self) -> Dict[str, Any]:
@@ -430,10 +520,28 @@ _CURRENT_STAGE: contextvars.ContextVar[str] = \
 def stage(name: str):
     """Attribute every LLM/tool call inside the block to a pipeline stage."""
     token = _CURRENT_STAGE.set(name)
+    rec = _CURRENT_RECORD.get()
+    t0 = time.perf_counter()
     try:
         yield
     finally:
         _CURRENT_STAGE.reset(token)
+        if rec is not None:
+            rec.add_span({"kind": "stage", "name": name,
+                          "t0": _rel(rec, t0), "t1": _rel(rec)})
+
+
+def _rel(rec: "InstanceRecord", t: Optional[float] = None) -> float:
+    """Seconds since the instance started, for span timestamps."""
+    return round((time.perf_counter() if t is None else t) - rec.t_start, 6)
+
+
+def _run_ids(run_id, kwargs) -> Dict[str, Optional[str]]:
+    """LangChain's run_id / parent_run_id, under names that cannot collide
+    with the experiment run_id the JSONL rows already carry."""
+    parent = (kwargs or {}).get("parent_run_id")
+    return {"span_id": str(run_id) if run_id is not None else None,
+            "parent_id": str(parent) if parent is not None else None}
 
 
 def _extract_usage(response) -> Dict[str, Any]:
@@ -483,6 +591,8 @@ def _extract_usage(response) -> Dict[str, Any]:
                 meta = getattr(msg, "response_metadata", None) or {}
                 usage["model_name"] = usage["model_name"] or meta.get("model_name") \
                     or meta.get("model")
+                usage["system_fingerprint"] = usage["system_fingerprint"] \
+                    or meta.get("system_fingerprint")
         except Exception:
             pass
 
@@ -492,6 +602,16 @@ def _extract_usage(response) -> Dict[str, Any]:
     return usage
 
 
+def _is_cache_hit(response) -> bool:
+    try:
+        return any((getattr(getattr(g, "message", None), "response_metadata",
+                            None) or {}).get(_CACHE_HIT_MARK)
+                   for gen in response.generations for g in gen)
+    except Exception:                                 # noqa: BLE001
+        return False
+
+
+_CACHE_HIT_MARK = "leanopt_cache_hit"
 _ENCODER_CACHE: Dict[str, Any] = {}
 
 
@@ -507,6 +627,20 @@ def _estimate_tokens(text: str, encoding: str = "o200k_base") -> int:
         return max(1, len(text) // 4)
 
 
+def _owner(st: Optional[Dict[str, Any]]) -> Optional["InstanceRecord"]:
+    """The record a call belongs to: the one current when the call STARTED.
+
+    Reading _CURRENT_RECORD at the end event instead is only right when the
+    instances run one after another. With several instances in flight on one
+    event loop (see run_instances_async), an end callback can be dispatched
+    from a context other than the one that started the call -- an executor
+    thread, or a handler LangChain chose not to run inline -- and the tokens
+    would land on whichever instance that context happens to carry.
+    """
+    rec = (st or {}).get("rec")
+    return rec if rec is not None else _CURRENT_RECORD.get()
+
+
 class UsageTracker:
     """
     LangChain callback handler (duck-typed; inherits BaseCallbackHandler when
@@ -539,8 +673,14 @@ class UsageTracker:
         if not self.cfg:
             return None
         if model_name:
-            for spec in self.cfg.models.values():
-                if spec.model == model_name or model_name.startswith(spec.model):
+            specs = [x for spec in self.cfg.models.values()
+                     for x in (cascade_first(spec), spec) if x is not None]
+            # exact ids first: "gpt-4.1-mini" must not price as "gpt-4.1"
+            for spec in specs:
+                if spec.model == model_name:
+                    return spec
+            for spec in specs:
+                if model_name.startswith(spec.model):
                     return spec
         # fall back to the modeler spec (dominant cost) if unmatched
         return self.cfg.models.get("modeler") or next(
@@ -561,6 +701,8 @@ class UsageTracker:
                     serialized=serialized, kwargs=kwargs)
 
     def _begin(self, run_id, kind, prompts, serialized, kwargs):
+        if _CASCADE_MARK in ((kwargs or {}).get("metadata") or {}):
+            return      # the cascade itself; its inner models are logged
         key = str(run_id)
         invocation = (kwargs or {}).get("invocation_params", {}) or {}
         with self._lock:
@@ -571,20 +713,25 @@ class UsageTracker:
                 "kind": kind,
                 "prompts": prompts,
                 "stage": _CURRENT_STAGE.get(),
+                "rec": _CURRENT_RECORD.get(),
                 "requested_model": invocation.get("model") or
                                    invocation.get("model_name"),
                 "temperature": invocation.get("temperature"),
                 "top_p": invocation.get("top_p"),
+                **_run_ids(run_id, kwargs),
             }
 
     def on_llm_end(self, response, *, run_id=None, **kwargs):
         key = str(run_id)
         with self._lock:
             st = self._starts.pop(key, None)
-        rec = _CURRENT_RECORD.get()
-        if rec is None or st is None:
-            # st is None => this run_id was already accounted for (the handler
-            # is registered both globally and on the model object)
+        if st is None:
+            # this run_id was already accounted for (the handler is registered
+            # both globally and on the model object)
+            return
+        EARLY_TOOLS.end(key)
+        rec = _owner(st)
+        if rec is None:
             return
         latency = time.perf_counter() - st["t0"]
         usage = _extract_usage(response)
@@ -606,9 +753,10 @@ class UsageTracker:
             usage["token_source"] = "estimated"
 
         model_name = usage["model_name"] or st.get("requested_model")
+        cache_hit = _is_cache_hit(response)
         spec = self._price(model_name)
         p_in = (usage["prompt_tokens"] or 0) - (usage["cached_prompt_tokens"] or 0)
-        cost, price_missing = 0.0, False
+        cost, cache_saved, price_missing = 0.0, 0.0, False
         if spec is None:
             price_missing = True
         elif spec.price_in_per_1m is None or spec.price_out_per_1m is None:
@@ -618,6 +766,10 @@ class UsageTracker:
             cost = (max(p_in, 0) / 1e6) * spec.price_in_per_1m \
                  + ((usage["cached_prompt_tokens"] or 0) / 1e6) * (spec.price_cached_in_per_1m or 0.0) \
                  + ((usage["completion_tokens"] or 0) / 1e6) * spec.price_out_per_1m
+            # what the provider's prompt cache took off this call; with an
+            # unset cached price the cached tokens were billed as free
+            cache_saved = ((usage["cached_prompt_tokens"] or 0) / 1e6) * (
+                spec.price_in_per_1m - (spec.price_cached_in_per_1m or 0.0))
 
         call = {
             "type": "llm",
@@ -635,9 +787,27 @@ class UsageTracker:
             "token_source": usage["token_source"],
             "latency_s": latency,
             "cost_usd": cost,
+            "cache_saved_usd": cache_saved,
             "price_missing": price_missing,
+            "provider": spec.provider if spec is not None else None,
+            # seconds to the first / last streamed token; None when the call
+            # was not streamed (the whole reply arrives at latency_s)
+            "streamed": "t_first" in st,
+            "ttft_s": (st["t_first"] - st["t0"]) if "t_first" in st else None,
+            "last_token_s": (st["t_last"] - st["t0"]) if "t_last" in st else None,
+            "stream_chunks": st.get("n_chunks", 0),
             "ok": True,
+            "span_id": st.get("span_id"),
+            "parent_id": st.get("parent_id"),
         }
+        if cache_hit:
+            # Served from the local response cache: nothing was paid. Keep
+            # what the call WOULD have cost so a replayed run still reports
+            # the method's price, just not as money spent.
+            call["cache_hit"] = True
+            call["replayed_cost_usd"] = cost
+            call["cost_usd"] = 0.0
+            call["cache_saved_usd"] = 0.0
         if self.cfg and self.cfg.log_prompts:
             call["prompts"] = st.get("prompts", [])
         if self.cfg and self.cfg.log_raw_responses:
@@ -648,9 +818,11 @@ class UsageTracker:
         key = str(run_id)
         with self._lock:
             st = self._starts.pop(key, None)
-        rec = _CURRENT_RECORD.get()
+        EARLY_TOOLS.end(key)
+        rec = _owner(st)
         if rec is None:
             return
+        st = st or {}
         rec.add_call({
             "type": "llm",
             "stage": st.get("stage", "unassigned"),
@@ -660,8 +832,24 @@ class UsageTracker:
             "error": f"{type(error).__name__}: {error}",
             "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0,
             "cost_usd": 0.0,
+            "span_id": st.get("span_id"), "parent_id": st.get("parent_id"),
         })
 
+    def on_llm_new_token(self, token, *, run_id=None, chunk=None, **kwargs):
+        # Once per streamed chunk, so no lock: a dict lookup and a few
+        # assignments are atomic under the GIL.
+        st = self._starts.get(str(run_id))
+        if st is None:
+            return
+        now = time.perf_counter()
+        if "t_first" not in st:
+            st["t_first"] = now
+        if token:
+            st["t_last"] = now
+        st["n_chunks"] = st.get("n_chunks", 0) + 1
+        if EARLY_TOOLS.active():
+            EARLY_TOOLS.feed(str(run_id), token, chunk, st.get("rec"))
+
     # -- tools ----------------------------------------------------------- #
     def on_tool_start(self, serialized, input_str, *, run_id=None, **kwargs):
         with self._lock:
@@ -670,13 +858,15 @@ class UsageTracker:
                 "kind": "tool",
                 "name": (serialized or {}).get("name", "unknown_tool"),
                 "stage": _CURRENT_STAGE.get(),
+                "rec": _CURRENT_RECORD.get(),
                 "input": str(input_str)[:2000],
+                **_run_ids(run_id, kwargs),
             }
 
     def on_tool_end(self, output, *, run_id=None, **kwargs):
         with self._lock:
             st = self._starts.pop(str(run_id), None)
-        rec = _CURRENT_RECORD.get()
+        rec = _owner(st)
         if rec is None or st is None:
             return
         rec.add_call({
@@ -687,32 +877,39 @@ class UsageTracker:
             "ok": True,
             "input": st["input"],
             "output_chars": len(str(output)),
+            "span_id": st["span_id"], "parent_id": st["parent_id"],
         })
 
     def on_tool_error(self, error, *, run_id=None, **kwargs):
         with self._lock:
             st = self._starts.pop(str(run_id), None)
-        rec = _CURRENT_RECORD.get()
+        rec = _owner(st)
         if rec is None or st is None:
             return
         rec.add_call({
             "type": "tool", "stage": st["stage"], "tool_name": st["name"],
             "latency_s": time.perf_counter() - st["t0"], "ok": False,
             "error": f"{type(error).__name__}: {error}",
+            "span_id": st["span_id"], "parent_id": st["parent_id"],
         })
 
     # -- retriever ------------------------------------------------------- #
     def on_retriever_start(self, serialized, query, *, run_id=None, **kwargs):
+        meta = kwargs.get("metadata") or {}
         with self._lock:
             self._starts[str(run_id)] = {
                 "t0": time.perf_counter(), "kind": "retriever",
-                "stage": _CURRENT_STAGE.get(), "query": str(query)[:1000],
+                "stage": _CURRENT_STAGE.get(), "rec": _CURRENT_RECORD.get(),
+                "query": str(query)[:1000],
+                "retriever": meta.get("retriever"), "search": meta.get("search"),
+                "index": meta.get("index"), "k": meta.get("k"),
+                **_run_ids(run_id, kwargs),
             }
 
     def on_retriever_end(self, documents, *, run_id=None, **kwargs):
         with self._lock:
             st = self._starts.pop(str(run_id), None)
-        rec = _CURRENT_RECORD.get()
+        rec = _owner(st)
         if rec is None or st is None:
             return
         rec.add_call({
@@ -720,25 +917,95 @@ class UsageTracker:
             "latency_s": time.perf_counter() - st["t0"],
             "n_docs": len(documents or []), "ok": True,
             "query": st["query"],
+            "retriever": st.get("retriever"), "search": st.get("search"),
+            "index": st.get("index"), "k": st.get("k"),
+            "span_id": st["span_id"], "parent_id": st["parent_id"],
         })
 
     def on_retriever_error(self, error, *, run_id=None, **kwargs):
         with self._lock:
             self._starts.pop(str(run_id), None)
 
-    # -- unused hooks (kept so LangChain never crashes) ------------------- #
-    def on_llm_new_token(self, *a, **k):
-        pass
+    # -- SQL tool ------------------------------------------------------- #
+    # Not a LangChain event: the tool callback only sees the input string and
+    # the output text, not how many rows the engine returned or whether the
+    # reply was cut. SqlTool.run reports those here.
+    def on_sql(self, query, *, latency_s, rows=0, bytes_out=0,
+               truncated=False, error=None):
+        rec = _CURRENT_RECORD.get()
+        if rec is None:
+            return
+        call = {
+            "type": "sql", "stage": _CURRENT_STAGE.get(),
+            "latency_s": latency_s, "ok": error is None,
+            "rows": rows, "bytes_out": bytes_out, "truncated": truncated,
+            "query": str(query)[:2000],
+        }
+        if error is not None:
+            call["error"] = error
+        rec.add_call(call)
 
-    def on_chain_start(self, *a, **k):
-        pass
+    # -- chains (timeline spans only) ----------------------------------- #
+    # Agents, LLMChain, RetrievalQA ... are chains. They carry no tokens, so
+    # they never become calls; they only give the timeline its nesting
+    # (stage -> agent -> tool -> chain -> retriever / LLM). The steps LCEL
+    # tags "seq:step:N" (prompt template, parser, ...) are left out: there
+    # are several per LLM call and each takes microseconds.
+    def on_chain_start(self, serialized, inputs, *, run_id=None, **kwargs):
+        if self.cfg is not None and not self.cfg.trace.get("chains", True):
+            return
+        if any(str(t).startswith("seq:step:") for t in kwargs.get("tags") or ()):
+            return
+        rec = _CURRENT_RECORD.get()
+        if rec is None:
+            return
+        name = (kwargs.get("name") or (serialized or {}).get("name")
+                or ((serialized or {}).get("id") or ["chain"])[-1])
+        with self._lock:
+            self._starts.setdefault(str(run_id), {
+                "t0": time.perf_counter(), "kind": "chain", "name": name,
+                "stage": _CURRENT_STAGE.get(), "rec": rec,
+                **_run_ids(run_id, kwargs),
+            })
 
-    def on_chain_end(self, *a, **k):
-        pass
+    def _end_chain(self, run_id, error=None):
+        with self._lock:
+            st = self._starts.get(str(run_id))
+            if st is None or st.get("kind") != "chain":
+                return
+            del self._starts[str(run_id)]
+        rec = st["rec"]
+        span = {"kind": "chain", "name": st["name"], "stage": st["stage"],
+                "t0": _rel(rec, st["t0"]), "t1": _rel(rec),
+                "span_id": st["span_id"], "parent_id": st["parent_id"]}
+        if error is not None:
+            span["error"] = f"{type(error).__name__}: {error}"[:300]
+        rec.add_span(span)
+
+    def agent_run(self, run_id) -> Optional[str]:
+        """The AgentExecutor run enclosing `run_id`, walking up the chain
+        starts still open; None outside an agent or with chains untraced."""
+        cur = str(run_id) if run_id is not None else None
+        with self._lock:
+            while cur is not None:
+                st = self._starts.get(cur)
+                if st is None or st.get("kind") != "chain":
+                    return None
+                if st["name"] == "AgentExecutor":
+                    return cur
+                cur = st.get("parent_id")
+        return None
 
-    def on_chain_error(self, *a, **k):
-        pass
+    def on_chain_end(self, outputs, *, run_id=None, **kwargs):
+        self._end_chain(run_id)
+        out = outputs.get("output") if isinstance(outputs, dict) else None
+        if isinstance(out, str) and out.startswith(_AGENT_STOPPED):
+            CASCADE.agent_stopped(_CURRENT_RECORD.get())
+
+    def on_chain_error(self, error, *, run_id=None, **kwargs):
+        self._end_chain(run_id, error)
 
+    # -- agent / misc (kept so LangChain never crashes) ------------------ #
     def on_agent_action(self, action, *, run_id=None, **kwargs):
         rec = _CURRENT_RECORD.get()
         if rec is not None:
@@ -840,23 +1107,18 @@ def load_refdata_docs(cfg: ExpConfig, columns: Optional[List[str]] = None):
         raise KeyError(f"columns {missing} not in RefData "
                        f"(have: {list(df.columns)})")
 
-    import pandas as pd
     label_col = cfg.classification.get("label_column", "New Problem Type")
+    # Skip empty cells instead of emitting "Data_address: nan": only 18 of
+    # the 96 reference rows have a Data_address, and a literal "nan" is
+    # noise in the retrieval text as well as wasted prompt tokens.
+    texts = table_rows(df[cols], sep=": ", joiner="\n", skip_empty=True)
+    labels = (list(map(str, df[label_col])) if label_col in df.columns
+              else None)
     docs = []
-    for idx, row in df[cols].iterrows():
-        # Skip empty cells instead of emitting "Data_address: nan": only 18 of
-        # the 96 reference rows have a Data_address, and a literal "nan" is
-        # noise in the retrieval text as well as wasted prompt tokens.
-        parts = []
-        for c in cols:
-            v = row[c]
-            if pd.isna(v) or str(v).strip() in ("", "nan"):
-                continue
-            parts.append(f"{c}: {str(v).strip()}")
-        text = "\n".join(parts)
+    for i, (idx, text) in enumerate(zip(df.index, texts)):
         meta = {"row": int(idx)}
-        if label_col in df.columns:
-            meta["problem_type"] = str(df.at[idx, label_col])
+        if labels is not None:
+            meta["problem_type"] = labels[i]
         docs.append(Document(page_content=text, metadata=meta))
     return docs
 
@@ -871,16 +1133,10 @@ def refdata_token_report(cfg: ExpConfig, encoding: str = "o200k_base"):
                                   ["prompt", "New Problem Type"])
     k = cfg.k("refdata")
 
-    import pandas as pd
-
-    def row_text(r, columns):
-        return "\n".join(
-            f"{c}: {str(r[c]).strip()}" for c in columns
-            if not pd.isna(r[c]) and str(r[c]).strip() not in ("", "nan"))
-
     def row_tokens(columns):
-        return [_estimate_tokens(row_text(r, columns), encoding)
-                for _, r in df.iterrows()]
+        return [_estimate_tokens(t, encoding)
+                for t in table_rows(df, sep=": ", joiner="\n",
+                                    columns=columns, skip_empty=True)]
 
     full = row_tokens(list(df.columns))
     slim = row_tokens(cols)
@@ -901,6 +1157,187 @@ def refdata_token_report(cfg: ExpConfig, encoding: str = "o200k_base"):
     return out
 
 
+# --------------------------------------------------------------------------- #
+# Table serialisation.
+#
+# Every data-retrieval prompt shows table rows as "col = val, col = val, ...",
+# which repeats each column name on each row: for the wide tables pulled in
+# with k=1000 the names are about half the tokens. The alternatives name the
+# columns once. The row documents are still EMBEDDED as kv text, so what gets
+# retrieved does not depend on the format -- only what the model reads does.
+# --------------------------------------------------------------------------- #
+TABLE_FORMATS = ("kv", "csv", "markdown", "matrix")
+
+
+def _check_format(fmt: str) -> str:
+    if fmt not in TABLE_FORMATS:
+        raise ValueError(f"table_format must be one of {TABLE_FORMATS}, "
+                         f"got {fmt!r}")
+    return fmt
+
+
+def _cell_columns(df) -> List[List[str]]:
+    """
+    str() of every cell, one list per column, exactly as an iterrows loop
+    prints them.
+
+    iterrows builds each row Series from df.values -- the frame's COMMON
+    dtype -- so in an all-numeric frame with one float column the integer
+    columns print as "3.0". Reading the same array column by column keeps
+    that, without constructing a Series per row: on the 1.5 MB
+    NRM_testing/NRM4/OnlineSalesinUSA.csv that per-row Series was nearly all
+    of the serialisation time.
+    """
+    vals = df.values
+    return [list(map(str, vals[:, j])) for j in range(vals.shape[1])]
+
+
+def _rows(cols: List[List[str]], n: int) -> List[Tuple[str, ...]]:
+    return list(zip(*cols)) if cols else [()] * n
+
+
+def table_rows(df, sep: str = " = ", joiner: str = ", ",
+               columns: Optional[List[str]] = None,
+               skip_empty: bool = False) -> List[str]:
+    """
+    One "col = val, col = val, ..." string per row -- byte for byte what
+
+        for _, r in df.iterrows():
+            joiner.join(f"{c}{sep}{r[c]}" for c in columns)
+
+    produces, built column-wise. columns defaults to all of them; the cell
+    text still follows the WHOLE frame's dtype, as r[c] does. skip_empty
+    drops NA / blank / "nan" cells and strips the rest (the RefData rule).
+    """
+    names = [str(c) for c in df.columns]
+    cols = _cell_columns(df)
+    if columns is not None:
+        pos = {c: j for j, c in enumerate(df.columns)}
+        cols = [cols[pos[c]] for c in columns]
+        names = [str(c) for c in columns]
+    if not skip_empty:
+        parts = [[f"{c}{sep}{v}" for v in col] for c, col in zip(names, cols)]
+        return [joiner.join(t) for t in _rows(parts, len(df))]
+    na = df.isna() if columns is None else df[list(columns)].isna()
+    parts = []
+    for j, (c, col) in enumerate(zip(names, cols)):
+        miss = na.iloc[:, j].to_numpy()
+        stripped = [v.strip() for v in col]
+        parts.append([None if m or v in ("", "nan") else f"{c}{sep}{v}"
+                      for m, v in zip(miss, stripped)])
+    return [joiner.join(x for x in t if x is not None)
+            for t in _rows(parts, len(df))]
+
+
+def _kv_row(columns: List[str], cells) -> str:
+    return ", ".join(f"{c} = {v}" for c, v in zip(columns, cells))
+
+
+def _render(columns: List[str], rows: List[List[str]], fmt: str) -> str:
+    fmt = _check_format(fmt)
+    columns = [str(c) for c in columns]
+    if fmt == "kv":
+        return "\n".join(_kv_row(columns, r) for r in rows)
+    if fmt == "csv":
+        import csv
+        import io
+        buf = io.StringIO()
+        w = csv.writer(buf, lineterminator="\n")
+        w.writerow(columns)
+        w.writerows(rows)
+        return buf.getvalue().rstrip("\n")
+    if fmt == "markdown":
+        esc = lambda v: v.replace("|", "\\|")
+        lines = ["| " + " | ".join(map(esc, columns)) + " |",
+                 "|" + "---|" * len(columns)]
+        lines += ["| " + " | ".join(map(esc, r)) + " |" for r in rows]
+        return "\n".join(lines)
+    # matrix: the column vector once, then one bracketed row per line -- the
+    # shape the formulations themselves use for cost and capacity matrices.
+    # Meant for numeric tables; a text cell with a comma gets quoted.
+    q = lambda v: f'"{v}"' if "," in v else v
+    return "\n".join([f"columns = [{', '.join(map(q, columns))}]"]
+                     + [f"[{', '.join(map(q, r))}]" for r in rows])
+
+
+def serialize_table(df, fmt: str = "kv") -> str:
+    """
+    A DataFrame as prompt text in one of TABLE_FORMATS.
+
+        kv        Product = A, Revenue = 10        (today's rows, one per line)
+        csv       header line, then comma-separated rows (quoted when needed)
+        markdown  pipe table
+        matrix    columns = [...], then [v1, v2, ...] per row
+    """
+    if _check_format(fmt) == "kv":
+        return "\n".join(table_rows(df))
+    return _render(list(df.columns), _rows(_cell_columns(df), len(df)), fmt)
+
+
+def table_documents(df, source: str = "") -> List["Any"]:
+    """
+    One Document per row, for a vector store that build_retriever formats.
+
+    page_content is the kv row, so the embeddings -- and with them what a
+    query retrieves -- are the same as for the notebooks' own row texts. The
+    cells ride along in metadata; a retriever whose table_format is not kv
+    re-renders the retrieved rows from them with the header shown once.
+    """
+    from langchain_core.documents import Document
+    columns = [str(c) for c in df.columns]
+    cells = _rows(_cell_columns(df), len(df))
+    return [Document(page_content=text,
+                     metadata={"source": source, "row": i,
+                               "columns": columns, "cells": list(c)})
+            for i, (text, c) in enumerate(zip(table_rows(df), cells))]
+
+
+def _format_table_docs(docs: List["Any"], fmt: str) -> List["Any"]:
+    # Rows of the same table collapse into one document, at the position of
+    # the first one retrieved, rows in retrieval order. Anything that is not
+    # a table row passes through untouched.
+    from langchain_core.documents import Document
+    out: List[Any] = []
+    groups: Dict[Any, Dict[str, Any]] = {}
+    for d in docs:
+        meta = d.metadata or {}
+        if "cells" not in meta:
+            out.append(d)
+            continue
+        key = (meta.get("source"), tuple(meta.get("columns") or ()))
+        if key not in groups:
+            groups[key] = {"at": len(out), "rows": [], "idx": []}
+            out.append(None)
+        groups[key]["rows"].append(meta["cells"])
+        groups[key]["idx"].append(meta.get("row"))
+    for (src, cols), g in groups.items():
+        out[g["at"]] = Document(
+            page_content=_render(list(cols), g["rows"], fmt),
+            metadata={"source": src, "rows": g["idx"], "table_format": fmt})
+    return out
+
+
+def table_format_report(df, encoding: str = "o200k_base",
+                        formats=TABLE_FORMATS) -> List[Dict[str, Any]]:
+    """
+    Prompt tokens of the whole table in each format, against kv.
+
+        for r in lx.table_format_report(pd.read_csv(path)): print(r)
+
+    Counted with _estimate_tokens, i.e. the same encoder the run logger
+    falls back to, so the numbers line up with logged prompt_tokens.
+    """
+    columns, rows = list(df.columns), _rows(_cell_columns(df), len(df))
+    tokens = {f: _estimate_tokens(_render(columns, rows, f), encoding)
+              for f in formats}
+    base = tokens.get("kv") or _estimate_tokens(
+        _render(columns, rows, "kv"), encoding)
+    return [{"format": f, "rows": len(rows), "tokens": t,
+             "tokens_per_row": round(t / max(1, len(rows)), 1),
+             "saving_vs_kv_%": round(100 * (base - t) / max(1, base), 1)}
+            for f, t in tokens.items()]
+
+
 PROVIDER_ENV = {
     "openai": "OPENAI_API_KEY",
     "google": "GOOGLE_API_KEY",
@@ -910,6 +1347,23 @@ PROVIDER_ENV = {
 }
 
 
+def _is_loopback(url: Optional[str]) -> bool:
+    """True for an OpenAI-compatible server on this machine (replay_server.py,
+    a local vLLM): it takes no key, and the client still wants a non-empty
+    one, so callers substitute a placeholder instead of prompting."""
+    if not url:
+        return False
+    from urllib.parse import urlparse
+    return (urlparse(url).hostname or "") in ("127.0.0.1", "localhost", "::1")
+
+
+def _api_key(env_var: str, base_url: Optional[str]) -> Optional[str]:
+    key = os.environ.get(env_var)
+    if not key and _is_loopback(base_url):
+        return "local-no-key"
+    return key
+
+
 def ensure_api_keys(cfg: ExpConfig, interactive: bool = True) -> List[str]:
     """
     Make sure the API keys required by THIS profile are present.
@@ -924,11 +1378,12 @@ def ensure_api_keys(cfg: ExpConfig, interactive: bool = True) -> List[str]:
     """
     needed, missing = [], []
     for spec in cfg.models.values():
-        if PROVIDER_ENV.get(spec.provider) is None:
+        if PROVIDER_ENV.get(spec.provider) is None or _is_loopback(spec.base_url):
             continue                      # local server, no key
         if spec.api_key_env not in needed:
             needed.append(spec.api_key_env)
-    if PROVIDER_ENV.get(cfg.embedding_provider) is not None:
+    if PROVIDER_ENV.get(cfg.embedding_provider) is not None \
+            and not _is_loopback(cfg.embedding_base_url):
         if cfg.embedding_api_key_env not in needed:
             needed.append(cfg.embedding_api_key_env)
 
@@ -972,25 +1427,225 @@ def ensure_api_keys(cfg: ExpConfig, interactive: bool = True) -> List[str]:
     return needed
 
 
+# --------------------------------------------------------------------------- #
+# Client reuse.
+#
+# The notebooks call build_llm inside the per-instance functions
+# (`llm2 = lx.build_llm(CFG, "modeler")` in get_NRM_response, `llm_code` in
+# get_code, ...), so every instance used to construct fresh model objects, each
+# with its own HTTP session: a new TCP connection and TLS handshake per call
+# site per instance, and nothing kept alive between them. Two registries fix
+# that without touching the notebooks:
+#
+#   _HTTP_CLIENTS  one keep-alive httpx client per (base URL, sync|async,
+#                  pool limits), shared by every model and embedding object
+#                  on that URL. The async one keeps a pool per event loop:
+#                  its connections belong to the loop that opened them, and
+#                  each asyncio.run() in a notebook is a new loop.
+#   _MODEL_CACHE   one model object per (role, resolved spec, overrides), so
+#                  repeated build_llm calls return the object already built
+#
+# Both are process-wide. clear_clients() empties them (e.g. after switching
+# profile in a long-lived kernel); exp_config.yaml:common.http sizes the pool.
+# --------------------------------------------------------------------------- #
+_HTTP_CLIENTS: Dict[tuple, Any] = {}
+_MODEL_CACHE: Dict[tuple, Any] = {}
+_CLIENT_LOCK = threading.Lock()
+
+_DEFAULT_BASE_URL = {
+    "openai": "https://api.openai.com/v1",
+    "ollama": "http://localhost:11434",
+}
+
+
+def http_client(cfg: ExpConfig, base_url: Optional[str], asynchronous=False):
+    """
+    The shared httpx client for one base URL, created on first use.
+
+    Limits come from exp_config.yaml:common.http. HTTP/2 needs the `h2`
+    package; without it the pool stays on HTTP/1.1 keep-alive and says so
+    once, rather than failing the run over a transport detail.
+    """
+    import httpx
+
+    settings = _pool_settings(cfg)
+    limits = settings["limits"]
+    key = (base_url or "", bool(asynchronous), limits.max_connections,
+           limits.max_keepalive_connections, limits.keepalive_expiry,
+           bool(settings.get("http2")))
+    with _CLIENT_LOCK:
+        if key not in _HTTP_CLIENTS:
+            cls = _per_loop_cls() if asynchronous else httpx.Client
+            _HTTP_CLIENTS[key] = cls(
+                **settings, timeout=httpx.Timeout(600.0, connect=10.0))
+        return _HTTP_CLIENTS[key]
+
+
+_PER_LOOP_CLS = None
+
+
+def _per_loop_cls():
+    """httpx.AsyncClient whose requests go through a pool of the running
+    loop. It is an AsyncClient (the SDKs type-check what they are given) and
+    is handed to the cached model objects once; send() then picks, or opens,
+    the pool of whichever loop is awaiting it, and drops the pools of loops
+    that have closed. Its own inherited pool is never used."""
+    global _PER_LOOP_CLS
+    if _PER_LOOP_CLS is not None:
+        return _PER_LOOP_CLS
+    import httpx
+
+    class PerLoopAsyncClient(httpx.AsyncClient):
+        def __init__(self, **settings):
+            super().__init__(**settings)
+            self._settings = settings
+            self._loop_lock = threading.Lock()
+            self._by_loop: Dict[int, Tuple[Any, Any]] = {}
+
+        def for_loop(self, loop) -> "httpx.AsyncClient":
+            with self._loop_lock:
+                for k, (lp, _) in list(self._by_loop.items()):
+                    if lp.is_closed():
+                        del self._by_loop[k]
+                if id(loop) not in self._by_loop:
+                    self._by_loop[id(loop)] = (
+                        loop, httpx.AsyncClient(**self._settings))
+                return self._by_loop[id(loop)][1]
+
+        async def send(self, request, **kwargs):
+            client = self.for_loop(asyncio.get_running_loop())
+            return await client.send(request, **kwargs)
+
+        async def aclose(self) -> None:
+            with self._loop_lock:
+                entry = self._by_loop.pop(id(asyncio.get_running_loop()),
+                                          None)
+            if entry is not None:
+                await entry[1].aclose()
+
+        def forget(self) -> None:
+            """Drop every loop's pool; their sockets go with the objects."""
+            with self._loop_lock:
+                self._by_loop.clear()
+
+    _PER_LOOP_CLS = PerLoopAsyncClient
+    return _PER_LOOP_CLS
+
+
+def _pool_settings(cfg: ExpConfig) -> Dict[str, Any]:
+    import httpx
+    h = cfg.http or {}
+    out: Dict[str, Any] = {"limits": httpx.Limits(
+        max_connections=h.get("max_connections", 64),
+        max_keepalive_connections=h.get("max_keepalive_connections", 32),
+        keepalive_expiry=h.get("keepalive_expiry_s", 60.0))}
+    if h.get("http2"):
+        try:
+            import h2  # noqa: F401
+            out["http2"] = True
+        except ImportError:
+            if "h2" not in _WARNED:
+                _WARNED.add("h2")
+                print("[leanopt_exp] http2 requested but the `h2` package is "
+                      "not installed; using HTTP/1.1 keep-alive")
+    return out
+
+
+_WARNED: set = set()
+
+
+def clear_clients() -> None:
+    """Forget every cached model object and close the shared HTTP clients."""
+    with _CLIENT_LOCK:
+        clients = list(_HTTP_CLIENTS.values())
+        _HTTP_CLIENTS.clear()
+        _MODEL_CACHE.clear()
+    for c in clients:
+        # AsyncClient only has the coroutine aclose(); its sockets go when
+        # the object is collected, which is all a reset needs.
+        if hasattr(c, "forget"):
+            c.forget()
+        elif hasattr(c, "close"):
+            c.close()
+
+
+def _model_key(role: str, spec: ModelSpec, overrides: Dict[str, Any],
+               cache: Optional[Dict[str, Any]] = None,
+               triggers: Optional[Dict[str, Any]] = None):
+    """Registry key, or None when an override cannot be keyed by value.
+
+    The key is the resolved spec, not the role alone: two profiles can map
+    the same role onto different models, and a reloaded config with an edited
+    temperature must not get the old object back. A cascade's triggers are
+    part of it too, since they are derived from settings outside the spec
+    (agent_max_iterations, classification.knn). An override that is not
+    plain data (a callbacks list, a client object) disables caching for that
+    call instead of being keyed by identity.
+    """
+    try:
+        blob = json.dumps([dataclasses.asdict(spec), overrides, cache or {},
+                           triggers or {}], sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+    return (role, blob)
+
+
 def build_llm(cfg: ExpConfig, role: str, **overrides):
     """
     Single entry point replacing every `ChatOpenAI(...)` / `ChatOllama(...)`
     in the notebooks. The tracker is attached here, once.
+
+    Repeated calls with the same role, spec and overrides return the same
+    object (see _MODEL_CACHE above), unless common.http.reuse_models is off.
     """
     spec = cfg.spec(role)
     TRACKER.bind(cfg)
+    first = cascade_first(spec)
+    triggers = cascade_triggers(cfg, spec) if first is not None else None
+    key = None
+    if (cfg.http or {}).get("reuse_models", True):
+        key = _model_key(role, spec, overrides, cfg.llm_cache, triggers)
+        with _CLIENT_LOCK:
+            if key is not None and key in _MODEL_CACHE:
+                return _MODEL_CACHE[key]
+    llm = _build_llm_raw(cfg, spec, overrides)
+    if first is not None:
+        llm = _cascade_cls()(
+            first=_build_llm_raw(cfg, first, overrides), strong=llm, role=role,
+            triggers=triggers, cache=False, metadata={_CASCADE_MARK: role})
+    if key is not None:
+        with _CLIENT_LOCK:
+            llm = _MODEL_CACHE.setdefault(key, llm)
+    return llm
+
+
+def _build_llm_raw(cfg: ExpConfig, spec: ModelSpec, overrides: Dict[str, Any]):
     common = dict(temperature=spec.temperature, callbacks=[TRACKER])
     if spec.max_tokens is not None:
         common["max_tokens"] = spec.max_tokens
+    if spec.stream and spec.provider in ("openai", "anthropic"):
+        # ChatOllama streams internally whatever it is told, and reports
+        # usage on its last chunk; nothing to switch on there.
+        common["streaming"] = True
+    cache = response_cache(cfg, spec)
+    if cache is not None:
+        common["cache"] = cache
 
     if spec.provider == "openai":
         from langchain_openai import ChatOpenAI
         kw = dict(model=spec.model, top_p=spec.top_p, n=spec.n,
-                  api_key=os.environ.get(spec.api_key_env), **common)
+                  api_key=_api_key(spec.api_key_env, spec.base_url), **common)
         if spec.seed is not None:
             kw["seed"] = spec.seed
+        if spec.stream:
+            # without it a streamed reply carries no usage at all and every
+            # call falls back to estimated tokens
+            kw["stream_usage"] = True
         if spec.base_url:
             kw["base_url"] = spec.base_url
+        url = spec.base_url or _DEFAULT_BASE_URL["openai"]
+        kw["http_client"] = http_client(cfg, url)
+        kw["http_async_client"] = http_client(cfg, url, asynchronous=True)
         kw.update(spec.extra)
         kw.update(overrides)
         return ChatOpenAI(**kw)
@@ -998,13 +1653,17 @@ def build_llm(cfg: ExpConfig, role: str, **overrides):
     if spec.provider == "ollama":
         from langchain_ollama import ChatOllama
         kw = dict(model=spec.model,
-                  base_url=spec.base_url or "http://localhost:11434",
+                  base_url=spec.base_url or _DEFAULT_BASE_URL["ollama"],
                   top_p=spec.top_p, **common)
         if spec.seed is not None:
             kw["seed"] = spec.seed        # Ollama: deterministic sampling
         if spec.max_tokens is not None:
             kw.pop("max_tokens", None)
             kw["num_predict"] = spec.max_tokens
+        # The ollama client builds its own httpx client from keyword
+        # arguments and cannot be handed a shared one, so pass the same pool
+        # limits; reuse then comes from the model cache in build_llm.
+        kw["client_kwargs"] = _pool_settings(cfg)
         kw.update(spec.extra)
         kw.update(overrides)
         return ChatOllama(**kw)
@@ -1024,6 +1683,445 @@ def build_llm(cfg: ExpConfig, role: str, **overrides):
     raise ValueError(f"unknown provider: {spec.provider}")
 
 
+# --------------------------------------------------------------------------- #
+# Model cascade.
+#
+# A profile gives each role one model, so the easy instances pay the same
+# per-token price as the hard ones. A role with a `cascade:` entry asks a
+# cheaper model first and hands the call to its own model only on a sign
+# that the cheap one is failing (escalate_on, all on by default):
+#
+#   parse_failure    a ReAct step (stop at "Observation:") with neither an
+#                    Action / Action Input nor a Final Answer
+#   code_compile     a ```python block in the reply that compile() rejects
+#   iteration_limit  the cheap model has taken this many ReAct steps in one
+#                    AgentExecutor run (default agent_max_iterations - 2), or
+#                    an agent stopped on its limit. Runs are told apart by
+#                    the traced chains; with common.trace.chains off, steps
+#                    count per instance
+#   knn_margin       KnnClassifier's vote margin is below this (default:
+#                    classification.knn.min_margin) -- the fallback agent then
+#                    runs on the strong model
+#
+# The first two re-ask the same messages of the strong model; the cheap reply
+# is discarded but stays in the log and the bill. Once a role escalates it
+# stays on the strong model for the rest of the instance. Each instance
+# records per role the calls made by each model and the signal that
+# escalated it (`cascade`), and `cascade_path`: first | escalated.
+# --------------------------------------------------------------------------- #
+_CASCADE_MARK = "leanopt_cascade"
+_CASCADE_SIGNALS = ("parse_failure", "code_compile", "iteration_limit",
+                    "knn_margin")
+_AGENT_STOPPED = "Agent stopped due to"
+_PY_BLOCK_RE = re.compile(r"```(?:python|py)\s*\n(.*?)```", re.S)
+
+
+def cascade_first(spec: ModelSpec) -> Optional[ModelSpec]:
+    """The cheap spec of a cascaded role: the role's spec with `first` on top."""
+    first = (spec.cascade or {}).get("first")
+    if not first:
+        return None
+    base = {f.name: getattr(spec, f.name) for f in dataclasses.fields(ModelSpec)}
+    base.update(first)
+    base["cascade"] = None
+    return ModelSpec(**base)
+
+
+def cascade_triggers(cfg: ExpConfig, spec: ModelSpec) -> Dict[str, Any]:
+    on = (spec.cascade or {}).get("escalate_on")
+    if on is None:
+        on = {k: True for k in _CASCADE_SIGNALS}
+    elif isinstance(on, (list, tuple)):
+        on = {k: True for k in on}
+    unknown = set(on) - set(_CASCADE_SIGNALS)
+    if unknown:
+        raise ValueError(f"cascade.escalate_on: unknown {sorted(unknown)}; "
+                         f"known {list(_CASCADE_SIGNALS)}")
+    out = {k: v for k, v in on.items() if v is not False and v is not None}
+    if out.get("iteration_limit") is True:
+        out["iteration_limit"] = max(cfg.agent_max_iterations - 2, 1)
+    if out.get("knn_margin") is True:
+        out["knn_margin"] = float({**_KNN_DEFAULTS, **(
+            cfg.classification.get("knn") or {})}["min_margin"])
+    return out
+
+
+def _cascade_signal(text: str, stop, triggers: Dict[str, Any]) -> Optional[str]:
+    """Which escalation signal a cheap reply raises, if any."""
+    react = any("Observation:" in x for x in (stop or ()))
+    if react and "parse_failure" in triggers and "Final Answer:" not in text \
+            and _react_action(text) is None:
+        return "parse_failure"
+    if "code_compile" in triggers:
+        for code in _PY_BLOCK_RE.findall(text):
+            try:
+                compile(code, "<cascade>", "exec")
+            except (SyntaxError, ValueError):
+                return "code_compile"
+    return None
+
+
+class CascadeState:
+    """Per-instance escalation state, kept on the record's `cascade` extra."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_role: Dict[int, str] = {}
+        self._steps: Dict[Tuple[int, str, Optional[str]], int] = {}
+        self._limits: Dict[Tuple[int, str], int] = {}
+
+    def _role(self, rec, role: str) -> Dict[str, Any]:
+        roles = rec.extra.setdefault("cascade", {})
+        rec.extra.setdefault("cascade_path", "first")
+        return roles.setdefault(role, {"first_calls": 0, "strong_calls": 0,
+                                       "escalated_by": None})
+
+    def escalated(self, rec, role: str) -> bool:
+        if rec is None:
+            return False
+        with self._lock:
+            return self._role(rec, role)["escalated_by"] is not None
+
+    def escalate(self, rec, role: str, signal: str) -> None:
+        if rec is None:
+            return
+        with self._lock:
+            st = self._role(rec, role)
+            if st["escalated_by"] is None:
+                st["escalated_by"] = signal
+            rec.extra["cascade_path"] = "escalated"
+
+    def count(self, rec, role: str, strong: bool, react: bool,
+              step_limit: Optional[int],
+              agent: Optional[str] = None) -> Optional[str]:
+        """Book one call; returns "iteration_limit" when the cheap model has
+        used up its ReAct steps in the agent run `agent`."""
+        if rec is None:
+            return None
+        with self._lock:
+            st = self._role(rec, role)
+            st["strong_calls" if strong else "first_calls"] += 1
+            self._last_role[id(rec)] = role
+            if strong or not react or not step_limit:
+                return None
+            key = (id(rec), role, agent)
+            self._steps[key] = self._steps.get(key, 0) + 1
+            return "iteration_limit" if self._steps[key] >= step_limit else None
+
+    def agent_stopped(self, rec) -> None:
+        """An agent gave up on its iteration limit: escalate the role that
+        was last answering in this instance, if it was a cascade."""
+        if rec is None:
+            return
+        with self._lock:
+            role = self._last_role.get(id(rec))
+        if role is not None and "iteration_limit" in self._limits.get(
+                (id(rec), role), ()):
+            self.escalate(rec, role, "iteration_limit")
+
+    def watch(self, rec, role: str, triggers: Dict[str, Any]) -> None:
+        if rec is not None:
+            with self._lock:
+                self._limits[(id(rec), role)] = triggers
+
+    def knn(self, rec, cfg: ExpConfig, margin: float,
+            role: str = "classifier") -> None:
+        """KnnClassifier's hook: a vote this close escalates the classifier."""
+        spec = cfg.models.get(role)
+        if rec is None or spec is None or cascade_first(spec) is None:
+            return
+        limit = cascade_triggers(cfg, spec).get("knn_margin")
+        if limit is not None and margin < float(limit):
+            self.escalate(rec, role, "knn_margin")
+
+    def release(self, rec) -> None:
+        with self._lock:
+            self._last_role.pop(id(rec), None)
+            for key in [k for k in self._steps if k[0] == id(rec)]:
+                del self._steps[key]
+            for key in [k for k in self._limits if k[0] == id(rec)]:
+                del self._limits[key]
+
+
+CASCADE = CascadeState()
+_CASCADE_CLS = None
+
+
+def _cascade_cls():
+    global _CASCADE_CLS
+    if _CASCADE_CLS is None:
+        from langchain_core.language_models.chat_models import BaseChatModel
+        from langchain_core.outputs import ChatResult
+
+        class CascadeChatModel(BaseChatModel):
+            """Cheap model first, the role's own model on escalation."""
+            first: Any
+            strong: Any
+            role: str
+            triggers: Dict[str, Any] = {}
+
+            @property
+            def _llm_type(self) -> str:
+                return "leanopt-cascade"
+
+            def _plan(self, stop):
+                rec = _CURRENT_RECORD.get()
+                CASCADE.watch(rec, self.role, self.triggers)
+                react = any("Observation:" in x for x in (stop or ()))
+                return rec, react, CASCADE.escalated(rec, self.role)
+
+            def _after_first(self, rec, react, text, stop,
+                             run_manager) -> Optional[str]:
+                signal = _cascade_signal(text, stop, self.triggers)
+                agent = TRACKER.agent_run(getattr(run_manager,
+                                                  "parent_run_id", None))
+                steps = CASCADE.count(rec, self.role, False, react,
+                                      self.triggers.get("iteration_limit"),
+                                      agent)
+                if signal is None and steps is not None:
+                    # this step stands; the following ones go to the strong
+                    # model so it still has iterations left to finish
+                    CASCADE.escalate(rec, self.role, steps)
+                return signal
+
+            @staticmethod
+            def _config(run_manager):
+                # the inner call takes the cascade's place in the run tree:
+                # same parent, same inherited handlers, minus the mark that
+                # makes the tracker skip the cascade itself
+                if run_manager is None:
+                    return {}
+                from langchain_core.callbacks import CallbackManager
+                meta = {k: v for k, v in
+                        (run_manager.inheritable_metadata or {}).items()
+                        if k != _CASCADE_MARK}
+                return {"callbacks": CallbackManager(
+                    handlers=list(run_manager.inheritable_handlers),
+                    inheritable_handlers=list(run_manager.inheritable_handlers),
+                    parent_run_id=run_manager.parent_run_id,
+                    tags=list(run_manager.inheritable_tags or []),
+                    inheritable_tags=list(run_manager.inheritable_tags or []),
+                    metadata=meta, inheritable_metadata=meta)}
+
+            def _generate(self, messages, stop=None, run_manager=None, **kw):
+                rec, react, strong = self._plan(stop)
+                cfg = self._config(run_manager)
+                if not strong:
+                    msg = self.first.invoke(messages, cfg, stop=stop, **kw)
+                    signal = self._after_first(rec, react,
+                                               _message_text(msg), stop,
+                                               run_manager)
+                    if signal is None:
+                        return ChatResult(generations=[_chat_generation(msg)])
+                    CASCADE.escalate(rec, self.role, signal)
+                msg = self.strong.invoke(messages, cfg, stop=stop, **kw)
+                CASCADE.count(rec, self.role, True, react, None)
+                return ChatResult(generations=[_chat_generation(msg)])
+
+            async def _agenerate(self, messages, stop=None, run_manager=None,
+                                 **kw):
+                rec, react, strong = self._plan(stop)
+                cfg = self._config(run_manager)
+                if not strong:
+                    msg = await self.first.ainvoke(messages, cfg, stop=stop,
+                                                   **kw)
+                    signal = self._after_first(rec, react,
+                                               _message_text(msg), stop,
+                                               run_manager)
+                    if signal is None:
+                        return ChatResult(generations=[_chat_generation(msg)])
+                    CASCADE.escalate(rec, self.role, signal)
+                msg = await self.strong.ainvoke(messages, cfg, stop=stop, **kw)
+                CASCADE.count(rec, self.role, True, react, None)
+                return ChatResult(generations=[_chat_generation(msg)])
+
+            def bind_tools(self, *args, **kwargs):
+                # tool calling / structured output is not cascaded
+                return self.strong.bind_tools(*args, **kwargs)
+
+        _CASCADE_CLS = CascadeChatModel
+    return _CASCADE_CLS
+
+
+def _message_text(msg) -> str:
+    content = getattr(msg, "content", msg)
+    if isinstance(content, list):
+        return "".join(p.get("text", "") if isinstance(p, dict) else str(p)
+                       for p in content)
+    return str(content or "")
+
+
+def _chat_generation(msg):
+    from langchain_core.outputs import ChatGeneration
+    return ChatGeneration(message=msg)
+
+
+# --------------------------------------------------------------------------- #
+# Response cache.
+#
+# Every profile decodes at temperature 0 with a fixed seed, so re-running a
+# notebook after a scoring-only or aggregation-only change re-buys answers we
+# already have. The cache plugs into LangChain's own `cache=` hook on the chat
+# model, which means a hit still goes through the callback chain: the tracker
+# sees an ordinary on_llm_end carrying the stored usage, and tags the call
+# cache_hit=True with cost_usd=0 (the would-be cost is kept separately).
+#
+# Modes (exp_config.yaml:common.llm_cache.mode):
+#   off         no cache (default)
+#   read-write  serve hits; store misses
+#   read-only   serve hits; misses go to the provider and are NOT stored
+#   record      never serve; store (overwrite) every response
+# --------------------------------------------------------------------------- #
+try:  # pragma: no cover
+    from langchain_core.caches import BaseCache as _BaseCache
+except Exception:  # pragma: no cover
+    class _BaseCache:                 # offline fallback for test_smoke.py
+        pass
+
+_CACHE_MODES = ("off", "read-write", "read-only", "record")
+_SQLITE: Dict[str, Any] = {}
+
+
+def _sqlite(path: Path):
+    """One connection per cache file, shared by every model using it."""
+    import sqlite3
+    key = str(path)
+    with _CLIENT_LOCK:
+        if key not in _SQLITE:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            con = sqlite3.connect(key, check_same_thread=False,
+                                  isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, provider TEXT, model TEXT,"
+                " system_fingerprint TEXT, created_utc TEXT,"
+                " generations TEXT NOT NULL)")
+            _SQLITE[key] = (con, threading.Lock())
+        return _SQLITE[key]
+
+
+class ResponseCache(_BaseCache):
+    """
+    SQLite-backed LangChain cache for one ModelSpec.
+
+    The key is (provider, model, decoding parameters incl. seed and
+    max_tokens, spec.extra, the full serialised message list, and the call's
+    own parameters such as stop words or bound tools). LangChain's
+    `llm_string` is not used as-is: it serialises the whole model object and
+    would change whenever an unrelated field (a client object, an API key
+    source) did.
+
+    system_fingerprint cannot be part of the key -- it is only known once the
+    provider has answered -- so it is stored with each entry and the policy
+    is applied on lookup: "any" serves every stored entry; a fingerprint (or
+    list of them) serves only entries recorded against that backend version,
+    so a silent provider-side model update turns into misses, not stale hits.
+    """
+
+    def __init__(self, path: Path, spec: ModelSpec, mode: str = "read-write",
+                 system_fingerprint: Any = "any"):
+        self.path = Path(path)
+        self.mode = mode
+        self.spec = spec
+        if system_fingerprint in (None, "any"):
+            self._fps = None
+        elif isinstance(system_fingerprint, str):
+            self._fps = {system_fingerprint}
+        else:
+            self._fps = set(system_fingerprint)
+        d = dataclasses.asdict(spec)
+        self._spec_blob = json.dumps(
+            {k: d[k] for k in ("provider", "model", "temperature", "top_p",
+                               "n", "seed", "max_tokens", "extra")},
+            sort_keys=True, default=str)
+        self._con, self._lock = _sqlite(self.path)
+
+    def _key(self, prompt: str, llm_string: str) -> str:
+        # keep only the per-call parameters, i.e. what follows LangChain's
+        # "<serialised model>---" prefix
+        params = llm_string.split("---", 1)[-1]
+        h = hashlib.sha256()
+        for part in (self._spec_blob, params, prompt):
+            h.update(part.encode("utf-8"))
+            h.update(b"\x00")
+        return h.hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str):
+        if self.mode not in ("read-write", "read-only"):
+            return None
+        with self._lock:
+            row = self._con.execute(
+                "SELECT generations, system_fingerprint FROM responses "
+                "WHERE key = ?", (self._key(prompt, llm_string),)).fetchone()
+        if row is None:
+            return None
+        if self._fps is not None and row[1] not in self._fps:
+            return None
+        import warnings
+        from langchain_core.load import loads
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")       # `loads` is marked beta
+            gens = loads(row[0])
+        for g in gens:
+            msg = getattr(g, "message", None)
+            if msg is not None:
+                msg.response_metadata = {**(msg.response_metadata or {}),
+                                         _CACHE_HIT_MARK: True}
+        return gens
+
+    def update(self, prompt: str, llm_string: str, return_val) -> None:
+        if self.mode not in ("read-write", "record"):
+            return
+        from langchain_core.load import dumps
+        fp = None
+        for g in return_val:
+            meta = getattr(getattr(g, "message", None), "response_metadata",
+                           None) or {}
+            fp = fp or meta.get("system_fingerprint")
+        with self._lock:
+            self._con.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (self._key(prompt, llm_string), self.spec.provider,
+                 self.spec.model, fp,
+                 datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                 dumps(list(return_val))))
+
+    def clear(self, **kwargs) -> None:
+        with self._lock:
+            self._con.execute("DELETE FROM responses WHERE provider = ? AND "
+                              "model = ?", (self.spec.provider,
+                                            self.spec.model))
+
+
+def response_cache(cfg: ExpConfig, spec: ModelSpec) -> Optional[ResponseCache]:
+    """The ResponseCache build_llm attaches for this spec, or None when off.
+
+    Sampling profiles are left uncached unless llm_cache.allow_sampling is
+    set: at temperature > 0 replaying one stored draw would quietly turn a
+    distribution into a constant, and n_repeats would measure nothing.
+    """
+    c = cfg.llm_cache or {}
+    mode = c.get("mode", "off") or "off"
+    if mode not in _CACHE_MODES:
+        raise ValueError(f"llm_cache.mode must be one of {_CACHE_MODES}, "
+                         f"got {mode!r}")
+    if mode == "off":
+        return None
+    if (spec.temperature or 0) > 0 and not c.get("allow_sampling"):
+        if ("sampling", spec.model) not in _WARNED:
+            _WARNED.add(("sampling", spec.model))
+            print(f"[leanopt_exp] llm_cache: {spec.model} samples at "
+                  f"temperature={spec.temperature}; not caching it "
+                  f"(set llm_cache.allow_sampling to override)")
+        return None
+    path = Path(c.get("path") or "runs/llm_cache.sqlite")
+    if not path.is_absolute():
+        path = HERE / path
+    return ResponseCache(path, spec, mode=mode,
+                         system_fingerprint=c.get("system_fingerprint", "any"))
+
+
 try:  # pragma: no cover
     from langchain_core.embeddings import Embeddings as _EmbeddingsBase
 except Exception:  # pragma: no cover
@@ -1050,12 +2148,19 @@ class CountingEmbeddings(_EmbeddingsBase):
 
     Token counts are tiktoken estimates (the embeddings endpoint does not
     return usage), and are flagged as such in the log.
+
+    It also holds the run's prefetched query vectors (see prefetch): an
+    embed_query for a prefetched text is answered from memory, and the first
+    such answer inside an instance carries that text's share of the batch.
     """
 
     def __init__(self, inner, cfg: ExpConfig, price_per_1m: float):
         self._inner = inner
         self._cfg = cfg
         self._price = price_per_1m
+        self._vectors: Dict[str, Any] = {}
+        self._shares: Dict[str, Dict[str, Any]] = {}
+        self._n_batches = 0
 
     def __getattr__(self, name):            # delegate everything else
         return getattr(self._inner, name)
@@ -1088,11 +2193,62 @@ class CountingEmbeddings(_EmbeddingsBase):
         return out
 
     def embed_query(self, text, *a, **kw):
+        if text in self._vectors:
+            return self._prefetched(text)
         t0 = time.perf_counter()
         out = self._inner.embed_query(text, *a, **kw)
         self._record([text], "embed_query", t0)
         return out
 
+    # -- prefetch ------------------------------------------------------- #
+    def prefetch(self, texts) -> int:
+        """
+        Embed every text not seen yet in ONE embed_documents call and keep the
+        vectors for the rest of the run. Returns how many were embedded.
+
+        The call usually happens before any instance is open, so it is not
+        logged as it happens. Like BatchClassifier, each text's share (its own
+        tokens and cost, latency in proportion) is charged to the instance
+        that first asks for it, tagged batched=True with the batch id and
+        size; texts no instance asks for stay unbilled.
+        """
+        todo = list(dict.fromkeys(t for t in map(str, texts)
+                                  if t and t not in self._vectors))
+        if not todo:
+            return 0
+        t0 = time.perf_counter()
+        vectors = self._inner.embed_documents(todo)
+        latency = time.perf_counter() - t0
+        enc = self._cfg.token_fallback_encoder
+        toks = [_estimate_tokens(t, enc) for t in todo]
+        total = sum(toks) or 1
+        batch_id = f"e{self._n_batches}"
+        self._n_batches += 1
+        for t, v, tok in zip(todo, vectors, toks):
+            self._vectors[t] = v
+            self._shares[t] = {
+                "type": "embedding", "model": self._cfg.embedding_model,
+                "n_texts": 1, "prompt_tokens": tok, "completion_tokens": 0,
+                "total_tokens": tok, "token_source": "estimated",
+                "latency_s": latency * tok / total, "batch_latency_s": latency,
+                "cost_usd": (tok / 1e6) * self._price, "ok": True,
+                "call": "prefetch", "batched": True, "batch_id": batch_id,
+                "batch_size": len(todo),
+            }
+        return len(todo)
+
+    def _prefetched(self, text: str):
+        rec = _CURRENT_RECORD.get()
+        share = self._shares.pop(text, None) if rec is not None else None
+        if share is not None:
+            rec.add_call({**share, "stage": _CURRENT_STAGE.get()})
+        return self._vectors[text]
+
+    def vector(self, text: str):
+        """The prefetched vector for `text`, or None -- for callers that go
+        through similarity_search_by_vector themselves."""
+        return self._prefetched(text) if text in self._vectors else None
+
     # async variants: some chains use them, and the base class only provides
     # defaults that delegate to the sync methods via a thread pool.
     async def aembed_documents(self, texts, *a, **kw):
@@ -1118,20 +2274,60 @@ class CountingEmbeddings(_EmbeddingsBase):
 
 def build_embeddings(cfg: ExpConfig, count: bool = True):
     emb = _build_embeddings_raw(cfg)
-    if count and cfg.embedding_price_per_1m:
+    # free local models are wrapped too when prefetching: the wrapper holds
+    # the vectors, and their calls are then logged at cost 0
+    if count and (cfg.embedding_price_per_1m or cfg.embedding_prefetch):
         return CountingEmbeddings(emb, cfg, cfg.embedding_price_per_1m)
     return emb
 
 
+def prefetch_queries(cfg: ExpConfig, embeddings, queries) -> int:
+    """
+    Pre-pass before the instance loop: embed the test set's queries in one
+    batched call, in every form the pipeline will later embed them -- the raw
+    query (exemplar retrieval in get_*_response) and, with classification.mode
+    knn, the classification question. The per-instance embed_query calls for
+    those texts are then answered from memory, so FAISS similarity_search and
+    KnnClassifier need no round trip. Queries the agents write themselves
+    (data retrieval) cannot be known in advance and are embedded as before.
+
+    Returns the number of texts embedded; 0 when cfg.embedding_prefetch is off
+    or the embeddings are not wrapped (build_embeddings(count=False)).
+    """
+    if not cfg.embedding_prefetch or not isinstance(embeddings,
+                                                    CountingEmbeddings):
+        return 0
+    texts = []
+    for q in queries:
+        if q is None or (isinstance(q, float) and q != q):
+            continue
+        q = str(q)
+        texts.append(q)
+        if cfg.classification.get("mode") == "knn":
+            texts.append(_classification_query(
+                f"What is the problem type of the text? text:{q}"))
+    t0 = time.perf_counter()
+    n = embeddings.prefetch(texts)
+    if n:
+        print(f"[leanopt_exp] prefetched {n} query embeddings in one call "
+              f"({time.perf_counter() - t0:.2f}s)")
+    return n
+
+
 def _build_embeddings_raw(cfg: ExpConfig):
     if cfg.embedding_provider == "openai":
         from langchain_openai import OpenAIEmbeddings
         kw = dict(model=cfg.embedding_model,
-                  api_key=os.environ.get(cfg.embedding_api_key_env))
+                  api_key=_api_key(cfg.embedding_api_key_env,
+                                   cfg.embedding_base_url))
         if cfg.embedding_base_url:
             kw["base_url"] = cfg.embedding_base_url
             # OpenAI-compatible gateways reject the tokenised batch format
             kw["check_embedding_ctx_length"] = False
+        # same pool as the chat models on this URL
+        url = cfg.embedding_base_url or _DEFAULT_BASE_URL["openai"]
+        kw["http_client"] = http_client(cfg, url)
+        kw["http_async_client"] = http_client(cfg, url, asynchronous=True)
         return OpenAIEmbeddings(**kw)
 
     if cfg.embedding_provider == "huggingface":
@@ -1146,6 +2342,82 @@ def _build_embeddings_raw(cfg: ExpConfig):
     raise ValueError(f"unknown embedding provider: {cfg.embedding_provider}")
 
 
+# --------------------------------------------------------------------------- #
+# Adaptive retrieval k.
+#
+# The data_* k values (1000, 300, 220, 400) were picked per notebook cell for
+# the tables at hand. On a 40-row table k=300 ranks every row to return all
+# of them; on a 5,000-row table k=1000 drops four fifths of it without a
+# word, and whether k=1000 rows even fit depends on the model. `k: auto`
+# derives k instead:
+#
+#   budget = (context_window - output_reserve) * share      tokens for rows
+#   k      = budget // tokens per row, within [k_min, k_max], at most the rows
+#
+# tokens per row are measured on an even sample of the store's rows, rendered
+# in the retriever's table_format. context_window / output_reserve come from
+# the ModelSpec of the role that reads the rows (data_agent by default). The
+# chosen k, the row count and whether rows were cut off are kept on the
+# instance (`retrieval_k`) and on every retriever call (`k`).
+# --------------------------------------------------------------------------- #
+def _store_rows(store, n_sample: int) -> Tuple[Optional[int], List[Any]]:
+    """(row count, an evenly spaced sample of the rows) of a vector store."""
+    if isinstance(store, LexicalStore):
+        docs = store.bm25.documents
+        n = len(docs)
+        get = docs.__getitem__
+    else:
+        index = getattr(store, "index", None)
+        ids = getattr(store, "index_to_docstore_id", None)
+        if index is None or ids is None:
+            return None, []
+        n = int(index.ntotal)
+        get = lambda i: store.docstore.search(ids[i])  # noqa: E731
+    step = max(n // max(n_sample, 1), 1)
+    return n, [get(i) for i in range(0, n, step)][:n_sample]
+
+
+def adaptive_k(cfg: ExpConfig, vectorstore, name: str,
+               rc: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """k for retriever `name` over `vectorstore` under the policy above.
+
+    Returns {"k", "rows", "row_tokens", "budget_tokens", "truncated"}. With no
+    context_window on the model the budget is unknown: every row is taken
+    (up to k_max) and budget_tokens is None.
+    """
+    rc = rc if rc is not None else cfg.retriever_cfg(name)
+    opts = {**cfg.adaptive_k, **{k: v for k, v in rc.items()
+                                 if k in cfg.adaptive_k}}
+    fmt = rc.get("table_format", cfg.table_format)
+    n, sample = _store_rows(vectorstore, int(opts.get("sample_rows") or 50))
+    row_tokens = None
+    if sample:
+        text = "\n".join(d.page_content
+                         for d in _format_table_docs(sample, fmt))
+        row_tokens = max(_estimate_tokens(text, cfg.token_fallback_encoder)
+                         / len(sample), 1.0)
+    spec = cfg.models.get(opts.get("role") or "data_agent")
+    budget = None
+    if spec is not None and spec.context_window:
+        reserve = spec.output_reserve if spec.output_reserve is not None \
+            else (spec.max_tokens or 0)
+        budget = int(max(spec.context_window - reserve, 0)
+                     * float(opts.get("share") or 1.0))
+    if budget is not None and row_tokens:
+        k = int(budget // row_tokens)
+    else:
+        k = n if n is not None else int(opts.get("k_max") or cfg.k("default"))
+    k = max(k, int(opts.get("k_min") or 1))
+    if opts.get("k_max"):
+        k = min(k, int(opts["k_max"]))
+    if n is not None:
+        k = min(k, max(n, 1))
+    return {"k": k, "rows": n,
+            "row_tokens": round(row_tokens, 1) if row_tokens else None,
+            "budget_tokens": budget,
+            "truncated": bool(n is not None and k < n)}
+
+
 def build_retriever(cfg: ExpConfig, vectorstore, name: str = "default",
                     search_kwargs: Optional[dict] = None, **overrides):
     """
@@ -1157,63 +2429,1681 @@ def build_retriever(cfg: ExpConfig, vectorstore, name: str = "default",
     site), so behaviour is unchanged -- only the bookkeeping moves.
     """
     rc = cfg.retriever_cfg(name)
-    sk = {"k": rc["k"]}
+    k = rc["k"]
+    if k == "auto":
+        chosen = adaptive_k(cfg, vectorstore, name, rc)
+        k = chosen["k"]
+        rec = _CURRENT_RECORD.get()
+        if rec is not None:
+            rec.extra.setdefault("retrieval_k", {})[name] = chosen
+        if chosen["truncated"]:
+            print(f"[leanopt_exp] {name}: k={k} of {chosen['rows']} rows "
+                  f"(~{chosen['row_tokens']} tokens/row, budget "
+                  f"{chosen['budget_tokens']}) -- the rest is cut off")
+    sk = {"k": k}
     if search_kwargs:
         sk.update(search_kwargs)
     kw = {"search_type": rc.get("search_type", "similarity"), "search_kwargs": sk}
     if rc.get("max_tokens_limit") is not None:
         kw["max_tokens_limit"] = rc["max_tokens_limit"]
     kw.update(overrides)
-    return vectorstore.as_retriever(**kw)
+    fmt = _check_format(kw.pop("table_format", rc["table_format"]))
+    # lets the run log attribute each retriever call to its call site
+    # (VectorStore has a search() method, so getattr would log a bound method)
+    search = (vectorstore.search if isinstance(vectorstore, LexicalStore)
+              else "dense")
+    kw.setdefault("metadata", {
+        "retriever": name, "search": search,
+        "index": getattr(vectorstore, "_leanopt_index", None), "k": sk["k"]})
+    if isinstance(vectorstore, LexicalStore):
+        return _lexical_retriever_cls()(store=vectorstore, k=sk["k"],
+                                        table_format=fmt,
+                                        tags=list(kw.get("tags") or []),
+                                        metadata=kw["metadata"])
+    if fmt == "kv":
+        return vectorstore.as_retriever(**kw)
+    # Same retriever, re-rendering the table rows it returns (see
+    # table_documents). A subclass rather than a wrapper, so the run logger
+    # still sees exactly one retriever call.
+    tags = list(kw.pop("tags", None) or [])
+    tags.extend(vectorstore._get_retriever_tags())
+    return _table_retriever_cls()(vectorstore=vectorstore, tags=tags,
+                                  table_format=fmt, **kw)
+
+
+_TABLE_RETRIEVER = None
+
+
+def _table_retriever_cls():
+    global _TABLE_RETRIEVER
+    if _TABLE_RETRIEVER is None:
+        from langchain_core.vectorstores import VectorStoreRetriever
+
+        class TableFormatRetriever(VectorStoreRetriever):
+            table_format: str = "kv"
+
+            def _get_relevant_documents(self, query, *, run_manager, **kwargs):
+                docs = super()._get_relevant_documents(
+                    query, run_manager=run_manager, **kwargs)
+                return _format_table_docs(docs, self.table_format)
+
+            async def _aget_relevant_documents(self, query, *, run_manager,
+                                               **kwargs):
+                docs = await super()._aget_relevant_documents(
+                    query, run_manager=run_manager, **kwargs)
+                return _format_table_docs(docs, self.table_format)
+
+        _TABLE_RETRIEVER = TableFormatRetriever
+    return _TABLE_RETRIEVER
 
 
-def agent_kwargs(cfg: ExpConfig, prefix: str, suffix: str,
-                 input_variables: Optional[List[str]] = None) -> dict:
-    """Uniform initialize_agent(**agent_kwargs(...)) settings for all agents."""
-    ak = {"prefix": prefix, "suffix": suffix}
-    if input_variables:
-        ak["input_variables"] = input_variables
-    return {
-        "agent_kwargs": ak,
-        "verbose": cfg.verbose,
-        "handle_parsing_errors": cfg.handle_parsing_errors,
-        "max_iterations": cfg.agent_max_iterations,
-        "max_execution_time": cfg.agent_max_execution_time,
-        "early_stopping_method": cfg.agent_early_stopping_method,
-        "callbacks": [TRACKER],
-        "return_intermediate_steps": False,
-    }
+# --------------------------------------------------------------------------- #
+# Lexical row retrieval.
+#
+# The data retrievers embed every row of the instance's CSVs -- thousands of
+# "Product Name = Sony Bravia XR, Revenue = ..." strings per instance -- only to
+# rank them against a query that names the products or columns it wants.
+# Exact term overlap does that at least as well, and BM25 over an in-process
+# inverted index costs no API call at all. `search:` per retriever name
+# selects it:
+#
+#   dense   FAISS over embeddings (the notebooks' behaviour)
+#   bm25    BM25 only; the rows are never embedded
+#   hybrid  both, merged by reciprocal-rank fusion; still embeds the rows
+#
+# With k >= the row count (data_nrm uses k=1000) every mode returns the whole
+# table; only the order differs. bm25 ties keep file order.
+# --------------------------------------------------------------------------- #
+_SEARCH_MODES = ("dense", "bm25", "hybrid")
+_TOKEN_RE = re.compile(r"[0-9a-z]+(?:\.[0-9]+)?")
 
 
-# Errors that will never succeed on retry: no credit, bad key, no permission.
-# Retrying these just burns wall-clock (and, across 101 instances, a lot of it).
-_FATAL_ERROR_MARKERS = (
-    "insufficient_quota",          # 429 but really "your balance is empty"
-    "invalid_api_key",
-    "authentication",
-    "permission_denied",
-    "model_not_found",
-    "billing_not_active",
-)
+def _bm25_tokens(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
 
 
-def is_fatal_api_error(exc: BaseException) -> bool:
-    text = f"{type(exc).__name__}: {exc}".lower()
-    return any(m in text for m in _FATAL_ERROR_MARKERS)
+class BM25Index:
+    """
+    Okapi BM25 over a fixed list of documents.
 
+    Postings are stored per term as two numpy arrays (document ids, term
+    frequencies), so a query touches only the documents containing one of its
+    terms and scoring is a handful of vector operations per query term.
+    """
 
-def call_with_retry(fn, cfg: ExpConfig, *args, **kwargs):
-    """Uniform failure handling; retries are counted into the current record."""
-    last = None
-    for attempt in range(cfg.max_retries):
-        try:
-            return fn(*args, **kwargs)
-        except Exception as e:                       # noqa: BLE001
-            last = e
-            rec = _CURRENT_RECORD.get()
-            if rec is not None:
-                rec.n_retries += 1
-                rec.errors.append(f"attempt{attempt}: {type(e).__name__}: {e}")
+    def __init__(self, documents: List[Any], k1: float = 1.5, b: float = 0.75):
+        import numpy as np
+        t0 = time.perf_counter()
+        self.documents = list(documents)
+        self.k1, self.b = k1, b
+        postings: Dict[str, Dict[int, int]] = {}
+        lengths = []
+        for i, d in enumerate(self.documents):
+            toks = _bm25_tokens(d.page_content)
+            lengths.append(len(toks))
+            for t, c in Counter(toks).items():
+                postings.setdefault(t, {})[i] = c
+        self._len = np.asarray(lengths, dtype=np.float32)
+        avg = float(self._len.mean()) if len(lengths) else 0.0
+        # the length normalisation is per document, so it is paid once here
+        self._norm = k1 * (1 - b + b * self._len / (avg or 1.0))
+        n = len(self.documents)
+        self._post = {}
+        for t, p in postings.items():
+            ids = np.fromiter(p.keys(), dtype=np.int32, count=len(p))
+            tf = np.fromiter(p.values(), dtype=np.float32, count=len(p))
+            idf = np.log(1.0 + (n - len(p) + 0.5) / (len(p) + 0.5))
+            self._post[t] = (ids, tf, np.float32(idf))
+        self.build_s = time.perf_counter() - t0
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self._len.nbytes + self._norm.nbytes + sum(
+            ids.nbytes + tf.nbytes for ids, tf, _ in self._post.values()))
+
+    @classmethod
+    def from_texts(cls, texts: List[str], **kw) -> "BM25Index":
+        from langchain_core.documents import Document
+        return cls([Document(page_content=t) for t in texts], **kw)
+
+    def scores(self, query: str):
+        import numpy as np
+        s = np.zeros(len(self.documents), dtype=np.float32)
+        for t in set(_bm25_tokens(query)):
+            hit = self._post.get(t)
+            if hit is None:
+                continue
+            ids, tf, idf = hit
+            s[ids] += idf * tf * (self.k1 + 1) / (tf + self._norm[ids])
+        return s
+
+    def ranked(self, query: str, k: int) -> List[int]:
+        """Top-k document ids; equal scores keep document order."""
+        import numpy as np
+        s = self.scores(query)
+        k = min(int(k), len(s))
+        if k <= 0:
+            return []
+        if k < len(s):
+            # only the candidates that can make the cut need a stable sort
+            cut = np.partition(s, len(s) - k)[len(s) - k]
+            cand = np.flatnonzero(s >= cut)
+        else:
+            cand = np.arange(len(s))
+        order = cand[np.argsort(-s[cand], kind="stable")]
+        return order[:k].tolist()
+
+
+@dataclass
+class LexicalStore:
+    """What build_store returns for search: bm25 / hybrid. build_retriever
+    turns it into a retriever; `dense` is only set for hybrid."""
+    bm25: BM25Index
+    dense: Any = None
+    search: str = "bm25"
+    _pos: Optional[Dict[str, List[int]]] = field(default=None, repr=False)
+
+    def positions(self, text: str) -> List[int]:
+        """Document ids holding `text` -- maps FAISS hits back to bm25 ids."""
+        if self._pos is None:
+            self._pos = {}
+            for i, d in enumerate(self.bm25.documents):
+                self._pos.setdefault(d.page_content, []).append(i)
+        return self._pos.get(text, [])
+
+
+def _check_search(mode: str) -> str:
+    if mode not in _SEARCH_MODES:
+        raise ValueError(f"search must be one of {_SEARCH_MODES}, got {mode!r}")
+    return mode
+
+
+def build_store(cfg: ExpConfig, name: str, items, embeddings):
+    """
+    Drop-in for FAISS.from_texts / FAISS.from_documents(items, embeddings) at a
+    call site whose retriever is cfg.retrievers[name]. With the default
+    search: dense this is exactly that call. The store is registered with
+    INDEXES, which may hand back one built earlier from the same content.
+    """
+    items = list(items)
+    return INDEXES.get_or_build(
+        cfg, name, items, lambda: _build_store(cfg, name, items, embeddings),
+        embeddings=embeddings)
+
+
+def _build_store(cfg: ExpConfig, name: str, items: List[Any], embeddings):
+    rc = cfg.retriever_cfg(name)
+    mode = _check_search(rc["search"])
+    texts = all(isinstance(x, str) for x in items)
+    dense = None
+    if mode in ("dense", "hybrid"):
+        dense = _dense_store(name, rc, items, texts, embeddings)
+        if mode == "dense":
+            return dense
+    bm25 = BM25Index.from_texts(items) if texts else BM25Index(items)
+    _record_index(name, "bm25", len(bm25), bm25.build_s)
+    return LexicalStore(bm25=bm25, dense=dense, search=mode)
+
+
+def _record_index(name: str, index: str, n: int, build_s: float, **extra):
+    rec = _CURRENT_RECORD.get()
+    if rec is not None:
+        rec.add_call({"type": "index", "stage": _CURRENT_STAGE.get(),
+                      "retriever": name, "index": index, "n_vectors": n,
+                      "latency_s": build_s, "ok": True, **extra})
+
+
+def _dense_store(name: str, rc: Dict[str, Any], items: List[Any],
+                 texts: bool, embeddings):
+    """
+    FAISS store for one call site. index: Flat without normalize is the
+    notebooks' FAISS.from_texts / from_documents call, unchanged. Anything else
+    goes through faiss.index_factory:
+
+        index: "HNSW32"          graph search, efSearch = ef_search
+        index: "IVF64,Flat"      inverted lists, nprobe of them searched
+        normalize: true          unit vectors + inner product = cosine
+
+    An IVF index needs at least as many vectors as lists to train; smaller
+    stores (most per-instance tables) fall back to Flat and say so in the
+    logged "index" call.
+    """
+    from langchain_community.vectorstores import FAISS
+    factory = str(rc.get("index") or "Flat")
+    normalize = bool(rc.get("normalize"))
+    t0 = time.perf_counter()
+    if factory == "Flat" and not normalize:
+        store = (FAISS.from_texts(items, embeddings) if texts
+                 else FAISS.from_documents(items, embeddings))
+        store._leanopt_index = factory
+        _record_index(name, factory, len(items), time.perf_counter() - t0)
+        return store
+
+    import faiss
+    import numpy as np
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores.utils import DistanceStrategy
+
+    body = items if texts else [d.page_content for d in items]
+    metas = None if texts else [d.metadata for d in items]
+    x = np.asarray(embeddings.embed_documents(body), dtype=np.float32)
+    embed_s = time.perf_counter() - t0
+    t1 = time.perf_counter()
+    if normalize:
+        faiss.normalize_L2(x)
+    metric = faiss.METRIC_INNER_PRODUCT if normalize else faiss.METRIC_L2
+    built, fallback = factory, None
+    nlist = re.match(r"IVF(\d+)", factory)
+    if nlist and len(x) < int(nlist.group(1)):
+        built, fallback = "Flat", f"{len(x)} vectors < {nlist.group(1)} lists"
+    index = faiss.index_factory(x.shape[1], built, metric)
+    if not index.is_trained:
+        index.train(x)
+    if rc.get("nprobe") and built.startswith("IVF"):
+        faiss.extract_index_ivf(index).nprobe = int(rc["nprobe"])
+    if rc.get("ef_search") and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = int(rc["ef_search"])
+    with warnings.catch_warnings():
+        # LangChain warns that normalising is "not applicable" to inner
+        # product -- but it still normalises, and that is what makes IP cosine
+        warnings.simplefilter("ignore", UserWarning)
+        store = FAISS(embeddings, index, InMemoryDocstore(), {},
+                      normalize_L2=normalize,
+                      distance_strategy=(DistanceStrategy.MAX_INNER_PRODUCT
+                                         if normalize else
+                                         DistanceStrategy.EUCLIDEAN_DISTANCE))
+    store.add_embeddings(list(zip(body, x)), metadatas=metas)
+    store._leanopt_index = built
+    extra = {"embed_s": embed_s, "index_s": time.perf_counter() - t1,
+             "normalize": normalize}
+    if fallback:
+        extra["index_fallback"] = fallback
+    _record_index(name, built, len(x), time.perf_counter() - t0, **extra)
+    return store
+
+
+def _rrf(rankings: List[List[int]], k: int, c: int = 60) -> List[int]:
+    """Reciprocal-rank fusion: sum of 1 / (c + rank) over the rankings."""
+    score: Dict[int, float] = {}
+    for ranking in rankings:
+        for r, i in enumerate(ranking):
+            score[i] = score.get(i, 0.0) + 1.0 / (c + r + 1)
+    return sorted(score, key=lambda i: (-score[i], i))[:k]
+
+
+# --------------------------------------------------------------------------- #
+# Index registry.
+#
+# The notebooks build vector stores inside the per-instance functions: the
+# exemplar stores (same CSV every time), the Air-NRM refdata / flight / demand
+# stores (same files every time) and the per-instance data stores. Each build
+# re-embeds its rows, and the stores stay reachable from agents and closures,
+# so a 101-instance run pays the same exemplar embeddings 101 times and the
+# kernel's memory keeps climbing.
+#
+# build_store hands every store to INDEXES, keyed by call-site name, content,
+# the retriever's store settings (search, index, normalize, nprobe,
+# ef_search) and the embedding model, so a changed config never gets a store
+# built under the old one:
+#
+#   pin           returned again whenever the same content is asked for;
+#                 never evicted (exemplars, refdata, fixed lookup tables)
+#   per_instance  owned by the instance that built it and emptied when its
+#                 `LOG.instance(...)` block exits, even if an agent still
+#                 holds a reference (data_* stores)
+#   anything else reused like a pinned store, but evicted least-recently-used
+#                 once the unpinned stores exceed index_registry.max_bytes
+#
+# Eviction only drops the registry's reference; a store someone still uses
+# stays valid. Only the per-instance stores are emptied in place, since
+# nothing may use them after their instance.
+# --------------------------------------------------------------------------- #
+# The retriever settings that change what _build_store builds; k, the table
+# format and the prompt-side limits only change how a store is queried.
+_STORE_FIELDS = ("search", "index", "normalize", "nprobe", "ef_search")
+
+
+def _embeddings_id(cfg: ExpConfig, embeddings) -> List[Any]:
+    """What the vectors depend on: the configured embedding model and the
+    object actually passed in (unwrapped from CountingEmbeddings)."""
+    inner = getattr(embeddings, "_inner", embeddings)
+    return [cfg.embedding_provider, cfg.embedding_model,
+            type(inner).__qualname__,
+            getattr(inner, "model", None),
+            getattr(inner, "dimensions", None) or getattr(inner, "size", None)]
+
+
+def _store_key(cfg: ExpConfig, name: str, items: List[Any],
+               embeddings) -> str:
+    rc = cfg.retriever_cfg(name)
+    spec = json.dumps([{f: rc.get(f) for f in _STORE_FIELDS},
+                       _embeddings_id(cfg, embeddings)],
+                      sort_keys=True, default=str)
+    return _content_key(name + "\0" + spec, items)
+
+
+def _content_key(name: str, items: List[Any]) -> str:
+    h = hashlib.sha1(name.encode())
+    for x in items:
+        if isinstance(x, str):
+            h.update(x.encode("utf-8", "replace"))
+        else:
+            h.update(x.page_content.encode("utf-8", "replace"))
+            h.update(json.dumps(x.metadata, sort_keys=True,
+                                default=str).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _store_nbytes(store) -> int:
+    """Vectors + stored text; an estimate (graph links and Python object
+    overhead are not counted) but consistent across stores."""
+    if isinstance(store, LexicalStore):
+        text = sum(len(d.page_content) for d in store.bm25.documents)
+        dense = _store_nbytes(store.dense) if store.dense is not None else 0
+        return store.bm25.nbytes + text + dense
+    index = getattr(store, "index", None)
+    n = int(index.ntotal) * int(index.d) * 4 if index is not None else 0
+    docs = getattr(getattr(store, "docstore", None), "_dict", {}) or {}
+    return n + sum(len(getattr(d, "page_content", "")) for d in docs.values())
+
+
+def _free_store(store) -> None:
+    if isinstance(store, LexicalStore):
+        store.bm25.documents.clear()
+        store.bm25._post.clear()
+        store._pos = None
+        if store.dense is not None:
+            _free_store(store.dense)
+        return
+    index = getattr(store, "index", None)
+    if index is not None:
+        index.reset()                       # releases the vectors in faiss
+    docs = getattr(getattr(store, "docstore", None), "_dict", None)
+    if docs is not None:
+        docs.clear()
+    if getattr(store, "index_to_docstore_id", None) is not None:
+        store.index_to_docstore_id.clear()
+
+
+def _name_matches(name: str, patterns) -> bool:
+    import fnmatch
+    return any(fnmatch.fnmatchcase(name, p) for p in patterns or ())
+
+
+class IndexRegistry:
+    """Owner of the vector stores built through build_store -- see above."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pinned: Dict[str, Any] = {}
+        self._lru: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+        self._owned: Dict[int, List[Tuple[Any, int]]] = {}
+        self._pinned_bytes = 0
+        self.n_evicted = 0
+
+    def scope(self, cfg: ExpConfig, name: str) -> str:
+        opts = cfg.index_registry or {}
+        if not opts.get("enabled", True):
+            return "off"
+        if _name_matches(name, opts.get("pin")):
+            return "pin"
+        if _name_matches(name, opts.get("per_instance")):
+            return "instance" if _CURRENT_RECORD.get() is not None else "lru"
+        return "lru"
+
+    def get_or_build(self, cfg: ExpConfig, name: str, items: List[Any],
+                     build, embeddings=None) -> Any:
+        scope = self.scope(cfg, name)
+        if scope == "off":
+            return build()
+        if scope == "instance":
+            store = build()
+            rec = _CURRENT_RECORD.get()
+            with self._lock:
+                self._owned.setdefault(id(rec), []).append(
+                    (store, _store_nbytes(store)))
+            return store
+        key = _store_key(cfg, name, items, embeddings)
+        with self._lock:
+            store = self._pinned.get(key)
+            if store is None and key in self._lru:
+                self._lru.move_to_end(key)
+                store = self._lru[key][0]
+        if store is not None:
+            _record_index(name, getattr(store, "_leanopt_index", None)
+                          or (store.search if isinstance(store, LexicalStore)
+                              else "dense"),
+                          len(items), 0.0, cache_hit=True)
+            return store
+        store = build()
+        nbytes = _store_nbytes(store)
+        with self._lock:
+            if scope == "pin":
+                self._pinned[key] = store
+                self._pinned_bytes += nbytes
+            else:
+                self._lru[key] = (store, nbytes)
+                self._evict(int(cfg.index_registry.get("max_bytes") or 0))
+        return store
+
+    def _evict(self, max_bytes: int) -> None:
+        if max_bytes <= 0:
+            return
+        total = sum(b for _, b in self._lru.values())
+        while total > max_bytes and len(self._lru) > 1:
+            _, (_, b) = self._lru.popitem(last=False)
+            total -= b
+            self.n_evicted += 1
+
+    def release(self, rec) -> int:
+        """Empty the stores `rec` owns; returns the bytes freed."""
+        with self._lock:
+            owned = self._owned.pop(id(rec), [])
+        for store, _ in owned:
+            _free_store(store)
+        return sum(b for _, b in owned)
+
+    def nbytes(self) -> int:
+        with self._lock:
+            return (self._pinned_bytes
+                    + sum(b for _, b in self._lru.values())
+                    + sum(b for v in self._owned.values() for _, b in v))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pinned.clear()
+            self._lru.clear()
+            self._owned.clear()
+            self._pinned_bytes = 0
+
+
+INDEXES = IndexRegistry()
+
+
+# --------------------------------------------------------------------------- #
+# Process telemetry per instance.
+#
+# Tokens and latencies say what an instance cost the provider, not what it
+# cost this machine: pandas loads, FAISS builds, solver runs and Python's own
+# garbage collector. RESOURCES brackets every LOG.instance(...) block and puts
+# into the instance summary
+#
+#   cpu_user_s, cpu_sys_s      CPU time spent inside the block, this process
+#                              plus finished child processes (CBC via PuLP)
+#   rss_peak_mb, rss_end_mb    resident memory: highest sample, and at exit
+#                              after the instance's own stores were freed
+#   gc_collections, gc_pause_s collections run inside the block and the time
+#                              the interpreter was stopped for them
+#   threads_max                most OS threads seen (HTTP pools, solvers)
+#   disk_read_mb               bytes the kernel read from storage for us;
+#                              io_read_mb counts every read, page cache included
+#
+# RSS and threads are sampled by one daemon thread every telemetry.interval_s
+# while any instance is open; the rest are before/after differences. All of
+# them are process-wide, so under run_instances_async an instance's figures
+# include the work of the instances in flight beside it. Memory, threads and
+# disk need psutil; without it those keys are None.
+# --------------------------------------------------------------------------- #
+class ResourceSampler:
+    """Per-instance CPU / memory / GC / thread / disk telemetry -- see above."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open: Dict[int, Dict[str, Any]] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self._gc_t0: Optional[float] = None
+        self._gc_hooked = False
+        self._psutil_proc = False           # False: not looked up yet
+
+    def _proc(self):
+        if self._psutil_proc is False:
+            try:
+                import psutil
+                self._psutil_proc = psutil.Process()
+            except Exception:
+                self._psutil_proc = None
+        return self._psutil_proc
+
+    def _snapshot(self, full: bool = True) -> Dict[str, Any]:
+        snap: Dict[str, Any] = {}
+        if full:
+            t = os.times()
+            snap["user"] = t.user + t.children_user
+            snap["sys"] = t.system + t.children_system
+        p = self._proc()
+        if p is None:
+            return snap
+        try:
+            with p.oneshot():
+                snap["rss"] = p.memory_info().rss
+                snap["threads"] = p.num_threads()
+                if full and hasattr(p, "io_counters"):
+                    io = p.io_counters()
+                    snap["read_bytes"] = io.read_bytes
+                    snap["read_chars"] = getattr(io, "read_chars", None)
+        except Exception:                   # AccessDenied in some containers
+            pass
+        return snap
+
+    # ---- gc ------------------------------------------------------------- #
+    def _on_gc(self, phase, info):
+        # Runs inside whichever thread triggered the collection, possibly one
+        # holding self._lock -- so no locking here, only GIL-atomic updates.
+        if phase == "start":
+            self._gc_t0 = time.perf_counter()
+        elif self._gc_t0 is not None:
+            dt = time.perf_counter() - self._gc_t0
+            self._gc_t0 = None
+            for st in list(self._open.values()):
+                st["gc_collections"] += 1
+                st["gc_pause_s"] += dt
+
+    # ---- sampling thread -------------------------------------------------- #
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._open:
+                    self._thread = None
+                    return
+                # each instance keeps the interval it was opened with; the
+                # thread serves the finest one still open
+                interval = min(st["interval_s"] for st in self._open.values())
+            self._sample()
+            # start() sets _wake, so a new, finer interval applies at once
+            # rather than after the sleep already under way
+            self._wake.wait(interval)
+            self._wake.clear()
+
+    def _sample(self):
+        self._fold(self._snapshot(full=False))
+
+    def _fold(self, snap: Dict[str, Any]) -> None:
+        """Count one sample toward the peaks of every open instance."""
+        for st in list(self._open.values()):
+            st["rss_peak"] = max(st["rss_peak"], snap.get("rss") or 0)
+            st["threads_max"] = max(st["threads_max"], snap.get("threads") or 0)
+
+    # ---- per instance ----------------------------------------------------- #
+    def start(self, rec, interval_s: float = 0.25) -> None:
+        snap = self._snapshot()
+        with self._lock:
+            if not self._gc_hooked:
+                import gc
+                gc.callbacks.append(self._on_gc)
+                self._gc_hooked = True
+            # the opening snapshot is a sample for the instances already open
+            self._fold(snap)
+            self._open[id(rec)] = {
+                "t0": snap, "rss_peak": snap.get("rss") or 0,
+                "threads_max": snap.get("threads") or 0,
+                "gc_collections": 0, "gc_pause_s": 0.0,
+                "interval_s": max(float(interval_s), 0.01),
+            }
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="leanopt-telemetry", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def stop(self, rec) -> Dict[str, Any]:
+        """Close `rec`'s bracket; {} when start() was never called for it."""
+        end = self._snapshot()
+        with self._lock:
+            # ... and so is the closing one, this instance's included
+            self._fold(end)
+            st = self._open.pop(id(rec), None)
+        if st is None:
+            return {}
+        t0 = st["t0"]
+
+        def mb(v):
+            return round(v / 2**20, 2) if v is not None else None
+
+        def delta(k):
+            if end.get(k) is None or t0.get(k) is None:
+                return None
+            return end[k] - t0[k]
+
+        have_mem = "rss" in end
+        return {
+            "cpu_user_s": round(delta("user"), 3),
+            "cpu_sys_s": round(delta("sys"), 3),
+            "rss_peak_mb": mb(max(st["rss_peak"], end["rss"])) if have_mem else None,
+            "rss_end_mb": mb(end["rss"]) if have_mem else None,
+            "gc_collections": st["gc_collections"],
+            "gc_pause_s": round(st["gc_pause_s"], 4),
+            "threads_max": (max(st["threads_max"], end["threads"])
+                            if have_mem else None),
+            "disk_read_mb": mb(delta("read_bytes")),
+            "io_read_mb": mb(delta("read_chars")),
+        }
+
+
+RESOURCES = ResourceSampler()
+
+
+_LEXICAL_RETRIEVER = None
+
+
+def _lexical_retriever_cls():
+    global _LEXICAL_RETRIEVER
+    if _LEXICAL_RETRIEVER is None:
+        from langchain_core.retrievers import BaseRetriever
+
+        class LexicalRetriever(BaseRetriever):
+            store: Any
+            k: int = 4
+            table_format: str = "kv"
+
+            def _dense_ids(self, query: str, k: int) -> List[int]:
+                out: List[int] = []
+                for d in self.store.dense.similarity_search(query, k=k):
+                    # duplicate rows: take the first id not used yet
+                    free = [i for i in self.store.positions(d.page_content)
+                            if i not in out]
+                    if free:
+                        out.append(free[0])
+                return out
+
+            def _get_relevant_documents(self, query, *, run_manager, **kwargs):
+                bm25 = self.store.bm25
+                if self.store.search == "hybrid":
+                    fetch = min(len(bm25), 2 * self.k)
+                    ids = _rrf([bm25.ranked(query, fetch),
+                                self._dense_ids(query, fetch)], self.k)
+                else:
+                    ids = bm25.ranked(query, self.k)
+                docs = [bm25.documents[i] for i in ids]
+                if self.table_format == "kv":
+                    return docs
+                return _format_table_docs(docs, self.table_format)
+
+        _LEXICAL_RETRIEVER = LexicalRetriever
+    return _LEXICAL_RETRIEVER
+
+
+# --------------------------------------------------------------------------- #
+# Read-only SQL over the instance's CSV files.
+#
+# The CSVQA tools answer "give me the rows for product X" by embedding every
+# row and having an LLM read the retrieved rows back: one retriever call plus
+# one LLM call per question, and unreliable for anything aggregate ("total
+# shelf capacity", "how many plants"). A query engine answers those exactly,
+# in milliseconds, for no tokens.
+#
+# DuckDB runs in-process -- no server, nothing leaves the machine. Every CSV
+# of dataset_address becomes a VIEW over read_csv_auto(path), so nothing is
+# loaded up front and each query scans the file itself rather than a pandas
+# copy of it. duckdb is optional and only imported when a SqlTool is built.
+# --------------------------------------------------------------------------- #
+def _dataset_paths(dataset_address) -> List[Path]:
+    """The notebooks pass dataset_address as one path per line."""
+    if isinstance(dataset_address, (str, Path)):
+        dataset_address = str(dataset_address).splitlines()
+    out = []
+    for p in dataset_address:
+        p = str(p).strip().strip("'\"")
+        if not p:
+            continue
+        path = Path(p)
+        if not path.is_absolute() and not path.exists():
+            path = HERE / path
+        out.append(path)
+    return out
+
+
+def _sql_name(path: Path, taken) -> str:
+    name = re.sub(r"\W+", "_", path.stem).strip("_").lower() or "t"
+    if name[0].isdigit():
+        name = "t_" + name
+    base, i = name, 2
+    while name in taken:
+        name, i = f"{base}_{i}", i + 1
+    return name
+
+
+def _sql_text(query: str) -> str:
+    """ReAct agents wrap their Action Input in quotes or ```sql fences."""
+    q = str(query).strip()
+    fence = re.match(r"^```(?:sql)?\s*(.*?)\s*```$", q, re.S | re.I)
+    if fence:
+        q = fence.group(1)
+    if len(q) > 1 and q[0] == q[-1] and q[0] in "'\"":
+        q = q[1:-1]
+    return q.strip().rstrip(";").strip()
+
+
+def _sql_quote(s: str) -> str:
+    return "'" + str(s).replace("'", "''") + "'"
+
+
+# What a SELECT needs to read past the views: a table function
+# (read_csv_auto('/etc/passwd'), glob(...), sqlite_scan(...)) or a quoted
+# path or URL in FROM, which DuckDB opens by itself ('/etc/passwd',
+# "../other/costs.csv"). The views never need either. Only a literal in a
+# table position counts: WHERE Product = 'x.csv' is a data filter.
+_SQL_FILE_FUNC_RE = re.compile(
+    r"\b(read_\w+|glob|sniff_csv|parquet_\w+|\w+_scan|getenv)\s*\(", re.I)
+_SQL_TABLE_LITERAL_RE = re.compile(
+    r"\b(?:from|join)\s+"
+    # earlier items of a FROM list: name [AS alias],
+    r"(?:(?:\"[^\"]*\"|\w+)(?:\.\w+)?(?:\s+(?:as\s+)?\w+)?\s*,\s*)*"
+    r"(?:'((?:[^']|'')*)'|\"((?:[^\"]|\"\")*)\")", re.I)
+_SQL_PATH_RE = re.compile(
+    r"^(?:[a-z][a-z0-9+.-]*://|[/\\~]|\.{1,2}[/\\]|[a-z]:[/\\])"
+    r"|\.(?:csv|tsv|txt|parquet|json|jsonl|ndjson|xlsx?|db|duckdb|sqlite)"
+    r"(?:\.gz|\.zst)?$", re.I)
+
+
+def _sql_file_access(sql: str) -> Optional[str]:
+    """Why `sql` could read a file other than the instance's views, or None."""
+    m = _SQL_FILE_FUNC_RE.search(sql)
+    if m:
+        return f"table function {m.group(1)}() is not allowed; query the tables"
+    for single, double in _SQL_TABLE_LITERAL_RE.findall(sql):
+        if _SQL_PATH_RE.search((single or double).strip()):
+            return "file paths and URLs are not allowed; query the tables"
+    return None
+
+
+class SqlTool:
+    """
+    Read-only SQL over the CSV files of one instance.
+
+        sql = lx.SqlTool(CFG, dataset_address)
+        sql.run("SELECT sum(capacity) FROM capacity")
+        agent = initialize_agent(tools=[qa_tool, sql.as_tool()], ...)
+
+    Only a single SELECT (WITH ... SELECT included) is accepted; anything else
+    is refused before it reaches the engine. The connection is locked down to
+    the instance's own directories once the views exist; until then, or if
+    this duckdb cannot be locked down (see `sandboxed`), a SELECT that calls
+    a table function or names a file path or URL as a table is refused
+    as well. Results are capped
+    at `max_rows` rows and `max_bytes` bytes so a careless `SELECT *` over a
+    47k-row sales table cannot flood the agent's context; the reply says when
+    it was cut. Errors come back as text rather than exceptions, so the agent
+    can read them and fix the query.
+
+    Every query is logged as a "sql" call on the current instance (rows and
+    bytes returned, truncation, engine latency) -- see UsageTracker.on_sql.
+    When the agent calls the tool, the LangChain "tool" call is logged as well;
+    the two are counted separately.
+    """
+
+    def __init__(self, cfg: ExpConfig, dataset_address, **overrides):
+        s = {**cfg.sql_tool, **overrides}
+        self.name = s.get("name", "CSVSQL")
+        self.max_rows = int(s.get("max_rows", 200))
+        self.max_bytes = int(s.get("max_bytes", 16000))
+        self.timeout_s = s.get("timeout_s")
+        self.table_format = _check_format(s.get("table_format", "csv"))
+        self.threads = s.get("threads")
+        self.tables: Dict[str, Path] = {}
+        for p in _dataset_paths(dataset_address):
+            if p.suffix.lower() == ".csv":
+                self.tables[_sql_name(p, self.tables)] = p
+        self._con = None
+        self._lock = threading.Lock()
+        self.sandboxed: Optional[bool] = None   # engine lockdown held?
+
+    # ---- connection ------------------------------------------------------ #
+    def _connect(self):
+        if self._con is not None:
+            return self._con
+        try:
+            import duckdb
+        except ImportError as e:
+            raise ImportError(
+                "SqlTool needs duckdb: pip install 'duckdb>=1.0'") from e
+        con = duckdb.connect(":memory:")
+        if self.threads:
+            con.execute(f"SET threads = {int(self.threads)}")
+        for name, path in self.tables.items():
+            con.execute(f'CREATE VIEW "{name}" AS SELECT * FROM '
+                        f"read_csv_auto({_sql_quote(path.resolve().as_posix())})")
+        # The views must keep reading their files; nothing else may (a SELECT
+        # can still call read_csv on any path). duckdb < 1.1 has no
+        # allowed_directories; there _refuse's file-access check is the only
+        # guard, and it runs on every query either way.
+        dirs = sorted({p.resolve().parent.as_posix() + "/"
+                       for p in self.tables.values()})
+        try:
+            con.execute("SET allowed_directories = ["
+                        + ", ".join(map(_sql_quote, dirs)) + "]")
+            con.execute("SET enable_external_access = false")
+            con.execute("SET lock_configuration = true")
+            self.sandboxed = True
+        except Exception as e:
+            self.sandboxed = False
+            print(f"[leanopt_exp] SqlTool: duckdb lockdown unavailable "
+                  f"({type(e).__name__}); refusing table functions and "
+                  f"file paths in queries instead")
+        self._con = con
+        return con
+
+    def close(self) -> None:
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---- schema ------------------------------------------------------------ #
+    def schema(self) -> str:
+        """One line per table: name(column TYPE, ...). Reads only the headers
+        and the sniffer's sample, not the files."""
+        with self._lock:
+            con = self._connect()
+            lines = []
+            for name in self.tables:
+                try:
+                    cols = con.execute(f'DESCRIBE "{name}"').fetchall()
+                    body = ", ".join(f'"{c[0]}" {c[1]}' for c in cols)
+                except Exception as e:
+                    body = f"unreadable: {type(e).__name__}: {e}"
+                lines.append(f"{name}({body})")
+        return "\n".join(lines)
+
+    def _refuse(self, con, sql: str) -> Optional[str]:
+        """Why `sql` may not run, or None."""
+        if not sql:
+            return "empty query"
+        # a locked-down engine refuses these reads itself
+        why = None if self.sandboxed else _sql_file_access(sql)
+        if why is not None:
+            return why
+        try:
+            stmts = con.extract_statements(sql)
+        except AttributeError:              # duckdb < 0.10
+            stmts = None
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+        if stmts is None:
+            if ";" in sql or not re.match(r"(?is)\s*(select|with)\b", sql):
+                return "only a single SELECT statement is allowed"
+            return None
+        import duckdb
+        if len(stmts) != 1 or stmts[0].type != duckdb.StatementType.SELECT:
+            return "only a single SELECT statement is allowed"
+        return None
+
+    # ---- queries ----------------------------------------------------------- #
+    def run(self, query: str) -> str:
+        sql = _sql_text(query)
+        t0 = time.perf_counter()
+        rows: List[Any] = []
+        out, error, truncated = "", None, False
+        with self._lock:
+            con = self._connect()
+            error = self._refuse(con, sql)
+            timer = None
+            if error is None:
+                if self.timeout_s:
+                    timer = threading.Timer(float(self.timeout_s), con.interrupt)
+                    timer.start()
+                try:
+                    cur = con.execute(sql)
+                    columns = [d[0] for d in cur.description]
+                    rows = cur.fetchmany(self.max_rows + 1)
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+        if error is None:
+            truncated = len(rows) > self.max_rows
+            rows = rows[:self.max_rows]
+            cells = [["" if v is None else str(v) for v in r] for r in rows]
+            out = _render(columns, cells, self.table_format)
+            raw = out.encode("utf-8")
+            if len(raw) > self.max_bytes:
+                out = raw[:self.max_bytes].decode("utf-8", "ignore")
+                out = out[:out.rfind("\n")] if "\n" in out else out
+                truncated = True
+            if truncated:
+                out += ("\n[result truncated -- add a WHERE clause, a LIMIT, "
+                        "or aggregate]")
+            elif not rows:
+                out += "\n[no rows]"
+        TRACKER.on_sql(sql, latency_s=time.perf_counter() - t0,
+                       rows=len(rows), bytes_out=len(out.encode("utf-8")),
+                       truncated=truncated, error=error)
+        return f"SQL error: {error}" if error else out
+
+    def description(self) -> str:
+        return ("Run ONE read-only SQL SELECT (DuckDB dialect) over the CSV "
+                "data and get the result as "
+                f"{self.table_format}, at most {self.max_rows} rows. Quote "
+                "column names that contain spaces with double quotes. Use it "
+                "for filters, counts, sums and joins. Tables:\n" + self.schema())
+
+    def as_tool(self):
+        from langchain_core.tools import Tool
+        return Tool(name=self.name, func=self.run,
+                    description=self.description())
+
+
+def data_tools(cfg: ExpConfig, dataset_address) -> List[Any]:
+    """
+    Extra tools for a data agent: [SqlTool(...).as_tool()] when
+    cfg.sql_tool.enabled, else []. Off by default, because adding a tool
+    changes the agent prompt.
+    """
+    if not cfg.sql_tool.get("enabled"):
+        return []
+    sql = SqlTool(cfg, dataset_address)
+    if not sql.tables:
+        return []
+    SQL_TOOLS.own(sql)
+    return [sql.as_tool()]
+
+
+class SqlToolOwner:
+    """The SqlTools data_tools() opened inside an instance. The tool lives in
+    the agent, which the notebook drops at the end of the instance without
+    closing anything; RunLogger closes the DuckDB connection when the
+    instance settles, as it frees the instance's vector stores."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owned: Dict[int, List[SqlTool]] = {}
+
+    def own(self, tool: SqlTool) -> None:
+        rec = _CURRENT_RECORD.get()
+        if rec is None:
+            return
+        with self._lock:
+            self._owned.setdefault(id(rec), []).append(tool)
+
+    def release(self, rec: InstanceRecord) -> int:
+        """Close the instance's connections; returns how many."""
+        with self._lock:
+            tools = self._owned.pop(id(rec), [])
+        for tool in tools:
+            with contextlib.suppress(Exception):
+                tool.close()
+        return len(tools)
+
+
+SQL_TOOLS = SqlToolOwner()
+
+
+# --------------------------------------------------------------------------- #
+# Prompt layout.
+#
+# OpenAI (and the other providers that bill cached input) cache the longest
+# prompt PREFIX already seen in the last few minutes, in 1024-token steps.
+# The modelling agents put the retrieved few-shot examples in the middle of
+# the agent prefix and get_code puts the instance's model before the fixed
+# per-class exemplar, so two consecutive instances share only the first few
+# hundred tokens and nothing is cached. Call sites describe their prompt as
+# (kind, text) parts instead of one string; the layout decides the order.
+# --------------------------------------------------------------------------- #
+PromptParts = List[Tuple[str, str]]
+
+_PROMPT_LAYOUTS = ("original", "cache_friendly")
+# cache_friendly order: what never changes, then what changes per problem
+# class, then what changes per instance. Stable within a kind.
+_PART_RANK = {"static": 0, "exemplars": 1, "instance": 2}
+
+
+def _check_layout(cfg: ExpConfig) -> str:
+    layout = cfg.prompt_layout or "original"
+    if layout not in _PROMPT_LAYOUTS:
+        raise ValueError(f"prompt_layout must be one of {_PROMPT_LAYOUTS}, "
+                         f"got {layout!r}")
+    return layout
+
+
+def _check_parts(parts: PromptParts) -> PromptParts:
+    for kind, _ in parts:
+        if kind not in _PART_RANK:
+            raise ValueError(f"prompt part kind must be one of "
+                             f"{tuple(_PART_RANK)}, got {kind!r}")
+    return list(parts)
+
+
+def assemble_prompt(cfg: ExpConfig, parts: PromptParts) -> str:
+    """
+    Join prompt parts in the configured layout.
+
+        prompt = lx.assemble_prompt(CFG, [("static", instructions),
+                                          ("instance", model_block),
+                                          ("exemplars", class_example)])
+
+    Parts are written in the call site's original order, so "original"
+    is a plain concatenation and reproduces the paper's prompt exactly.
+    "cache_friendly" stable-sorts them static -> exemplars -> instance.
+    """
+    parts = _check_parts(parts)
+    if _check_layout(cfg) == "cache_friendly":
+        parts = sorted(parts, key=lambda p: _PART_RANK[p[0]])
+    return "".join(text for _, text in parts)
+
+
+def _split_agent_prefix(cfg: ExpConfig, prefix: Union[str, PromptParts],
+                        suffix: str) -> Tuple[str, str]:
+    # ZeroShotAgent builds prefix + tools + format instructions + suffix, so
+    # per-instance prefix parts can only get behind the (static) tool list by
+    # moving to the front of the suffix.
+    if isinstance(prefix, str):
+        return prefix, suffix
+    parts = _check_parts(prefix)
+    if _check_layout(cfg) == "original":
+        return "".join(text for _, text in parts), suffix
+    head = assemble_prompt(cfg, [p for p in parts if p[0] != "instance"])
+    tail = "".join(text for kind, text in parts if kind == "instance")
+    return head, tail + suffix
+
+
+def agent_kwargs(cfg: ExpConfig, prefix: Union[str, PromptParts], suffix: str,
+                 input_variables: Optional[List[str]] = None) -> dict:
+    """
+    Uniform initialize_agent(**agent_kwargs(...)) settings for all agents.
+
+    prefix is a string or a list of prompt parts (see assemble_prompt). With
+    prompt_layout: cache_friendly the "instance" parts move from the prefix
+    to the start of the suffix, after the tool descriptions.
+    """
+    prefix, suffix = _split_agent_prefix(cfg, prefix, suffix)
+    ak = {"prefix": prefix, "suffix": suffix}
+    if input_variables:
+        ak["input_variables"] = input_variables
+    return {
+        "agent_kwargs": ak,
+        "verbose": cfg.verbose,
+        "handle_parsing_errors": cfg.handle_parsing_errors,
+        "max_iterations": cfg.agent_max_iterations,
+        "max_execution_time": cfg.agent_max_execution_time,
+        "early_stopping_method": cfg.agent_early_stopping_method,
+        "callbacks": [TRACKER],
+        "return_intermediate_steps": False,
+    }
+
+
+# --------------------------------------------------------------------------- #
+# Early tool start for ReAct agents.
+#
+# A ReAct step is: the LLM writes "Thought / Action: X / Action Input: Y",
+# the executor waits for the whole reply, parses it and only then runs tool
+# X on Y. With the model streaming (ModelSpec.stream), the tracker sees the
+# Action Input line complete before the call is closed -- the stop sequence
+# ("\nObservation:") ends the content, and the reply's last chunks (usage,
+# end of stream), LangChain's aggregation and the parse still follow. The
+# tool's function is started at that point in a worker thread, with the
+# instance's context, and the agent is handed its result when it asks for
+# the same tool with the same input.
+#
+# Only the agents' own tools are started, through early_tools(cfg, tools)
+# (a no-op unless agent_early_tool_start). The input is parsed the way the
+# ReAct output parser parses it, so a mismatch means the agent asked for
+# something else: that result is dropped, but its calls were made and stay
+# on the record. Each instance logs early_tool_hits / early_tool_misses.
+# --------------------------------------------------------------------------- #
+_REACT_ACTION_RE = re.compile(
+    r"Action\s*\d*\s*:[\s]*(.*?)[\s]*Action\s*\d*\s*Input\s*\d*\s*:[\s]*(.*)",
+    re.S)
+
+
+def _react_action(text: str) -> Optional[Tuple[str, str]]:
+    """(tool, input) as MRKLOutputParser would return them, or None."""
+    if "Final Answer:" in text:
+        return None
+    m = _REACT_ACTION_RE.search(text)
+    if m is None:
+        return None
+    return m.group(1).strip(), m.group(2).strip(" ").strip('"')
+
+
+def _chunk_finished(chunk) -> bool:
+    """True on the chunk that closes the generated text (OpenAI: the one
+    with a finish_reason; Anthropic: stop_reason)."""
+    info = dict(getattr(chunk, "generation_info", None) or {})
+    msg = getattr(chunk, "message", None)
+    info.update(getattr(msg, "response_metadata", None) or {})
+    return bool(info.get("finish_reason") or info.get("stop_reason")
+                or info.get("done"))
+
+
+class EarlyToolStart:
+    """Speculative tool execution for streamed ReAct replies -- see above."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._funcs: Dict[Tuple[int, str], Any] = {}
+        self._text: Dict[str, List[str]] = {}
+        self._pending: Dict[Tuple[int, str, str], Any] = {}
+        self._pool = None
+
+    def active(self) -> bool:
+        return bool(self._funcs)
+
+    def wrap(self, cfg: ExpConfig, tools) -> List[Any]:
+        tools = list(tools)
+        if not cfg.agent_early_tool_start:
+            return tools
+        # an agent built outside any instance serves them all (scope 0)
+        rec = _CURRENT_RECORD.get()
+        scope = id(rec) if rec is not None else 0
+        from langchain_core.tools import Tool
+        out = []
+        for t in tools:
+            # single-string tools only: that is what a ReAct Action Input is
+            if not isinstance(t, Tool) or t.func is None:
+                out.append(t)
+                continue
+            with self._lock:
+                self._funcs[(scope, t.name)] = t.func
+            out.append(t.model_copy(
+                update={"func": self._runner(t.name, t.func)}))
+        return out
+
+    def _runner(self, name: str, func):
+        def run(tool_input, *args, **kwargs):
+            fut = self.take(_CURRENT_RECORD.get(), name, tool_input)
+            if fut is not None:
+                return fut.result()
+            return func(tool_input, *args, **kwargs)
+        return run
+
+    # ---- fed by UsageTracker ---------------------------------------------- #
+    def feed(self, run_id: str, token: str, chunk, rec) -> None:
+        if rec is None:
+            return
+        with self._lock:
+            buf = self._text.setdefault(run_id, [])
+            if buf is None:
+                return                  # this call's action is already handled
+            if token:
+                buf.append(token)
+        if not _chunk_finished(chunk):
+            return
+        with self._lock:
+            text = "".join(self._text.get(run_id) or ())
+            self._text[run_id] = None       # started (or not) once per call
+        action = _react_action(text)
+        if action is None:
+            return
+        name, tool_input = action
+        with self._lock:
+            func = (self._funcs.get((id(rec), name))
+                    or self._funcs.get((0, name)))
+            key = (id(rec), name, tool_input)
+            if func is None or key in self._pending:
+                return
+            if self._pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._pool = ThreadPoolExecutor(
+                    max_workers=8, thread_name_prefix="leanopt-early-tool")
+            ctx = contextvars.copy_context()
+            self._pending[key] = self._pool.submit(ctx.run, func, tool_input)
+
+    def end(self, run_id: str) -> None:
+        with self._lock:
+            self._text.pop(run_id, None)
+
+    # ---- used by the wrapped tools / RunLogger ----------------------------- #
+    def take(self, rec, name: str, tool_input) -> Optional[Any]:
+        if rec is None or not isinstance(tool_input, str):
+            return None
+        with self._lock:
+            fut = self._pending.pop((id(rec), name, tool_input), None)
+        if fut is not None:
+            rec.extra["early_tool_hits"] = rec.extra.get("early_tool_hits", 0) + 1
+        return fut
+
+    def release(self, rec) -> None:
+        """Forget `rec`'s tools; wait for its unused speculations, so the
+        calls they made are on the record before it is written."""
+        with self._lock:
+            for k in [k for k in self._funcs if k[0] == id(rec)]:
+                del self._funcs[k]
+            left = [self._pending.pop(k) for k in list(self._pending)
+                    if k[0] == id(rec)]
+        for fut in left:
+            with contextlib.suppress(Exception):
+                fut.result()
+        if left or "early_tool_hits" in rec.extra:
+            rec.set(early_tool_misses=len(left),
+                    early_tool_hits=rec.extra.get("early_tool_hits", 0))
+
+
+EARLY_TOOLS = EarlyToolStart()
+
+
+def early_tools(cfg: ExpConfig, tools) -> List[Any]:
+    """
+    `initialize_agent(lx.early_tools(CFG, tools), llm, ...)`: the same tools,
+    started early from the streamed reply when cfg.agent_early_tool_start.
+    Tools wrapped inside LOG.instance(...) are dropped when it ends; an agent
+    built once at module level serves every instance.
+    """
+    return EARLY_TOOLS.wrap(cfg, tools)
+
+
+# --------------------------------------------------------------------------- #
+# Classification fast path.
+#
+# The classifier is a ReAct agent calling a RetrievalQA tool over RefData: two
+# or more LLM calls with five stuffed reference problems, per query, to pick
+# one of about seven labels. Most queries are not close calls -- their nearest
+# reference problems all carry the same label -- and for those a similarity-
+# weighted vote over the RefData embeddings gives the answer without an LLM
+# call. Only a vote whose margin is below classification.knn.min_margin goes
+# to the agent.
+# --------------------------------------------------------------------------- #
+_KNN_DEFAULTS: Dict[str, Any] = {
+    "k": 7,
+    "min_margin": 0.4,
+    # The agent prompt's first rule: a query that mentions no '.csv' and no
+    # 'column' is "Others without CSV", whatever it is about.
+    "csv_rule": True,
+    "no_csv_label": "Others without CSV",
+    # RefData labels -> the labels the agent is told to answer with, so both
+    # paths feed the same routing in run_test / Batch_Process_Queries.
+    "label_map": {},
+}
+
+
+def _classification_query(text: str) -> str:
+    # run_test asks "What is the problem type of the text? text:<query>";
+    # classify the query, not the constant question in front of it
+    head, sep, tail = text.partition("text:")
+    return tail.strip() if sep else text.strip()
+
+
+class KnnClassifier:
+    """
+    Weighted kNN vote over RefData, with the agent as fallback.
+
+        clf = lx.KnnClassifier(CFG, EMBEDDINGS, fallback=classification_agent)
+        run_test(test, clf)          # drop-in for the agent: .invoke -> {"output"}
+
+    RefData is embedded once, at construction. Per query: one embedding call,
+    cosine similarity against every reference row, and a vote in which each
+    of the k nearest rows adds its similarity to its label's score. margin =
+    (best - runner-up) / total score, in [0, 1]; 1 means all k neighbours
+    agree. At or above min_margin the top label is returned; below it the
+    query goes to `fallback.invoke` unchanged.
+
+    Every call records on the current instance which path answered
+    (`classification_path`: knn | rule | agent), the kNN label and margin --
+    also when the agent answered, so the threshold can be re-tuned offline
+    from the log. aggregate_runs.py breaks accuracy and cost down by path.
+    """
+
+    def __init__(self, cfg: ExpConfig, embeddings, fallback=None,
+                 docs: Optional[List[Any]] = None):
+        import numpy as np
+
+        self.cfg = cfg
+        self.opts = {**_KNN_DEFAULTS, **(cfg.classification.get("knn") or {})}
+        self.fallback = fallback
+        self.embeddings = embeddings
+        docs = docs if docs is not None else load_refdata_docs(cfg)
+        labels = [self._map(d.metadata.get("problem_type")) for d in docs]
+        self.classes = sorted(set(labels))
+        self._codes = np.array([self.classes.index(l) for l in labels])
+        mat = np.asarray(embeddings.embed_documents(
+            [d.page_content for d in docs]), dtype=np.float32)
+        self._mat = mat / np.maximum(
+            np.linalg.norm(mat, axis=1, keepdims=True), 1e-12)
+
+    def _map(self, label) -> str:
+        label = str(label).strip()
+        return self.opts["label_map"].get(label, label)
+
+    def vote(self, query: str) -> Dict[str, Any]:
+        import numpy as np
+
+        q = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        q /= max(float(np.linalg.norm(q)), 1e-12)
+        sims = self._mat @ q
+        k = min(int(self.opts["k"]), len(sims))
+        top = np.argpartition(-sims, k - 1)[:k]
+        scores = np.bincount(self._codes[top], weights=np.clip(sims[top], 0, None),
+                             minlength=len(self.classes))
+        order = np.argsort(-scores)
+        total = float(scores.sum()) or 1.0
+        runner_up = float(scores[order[1]]) if len(order) > 1 else 0.0
+        return {
+            "label": self.classes[order[0]],
+            "margin": round((float(scores[order[0]]) - runner_up) / total, 4),
+            "scores": {self.classes[i]: round(float(scores[i]), 4)
+                       for i in order if scores[i] > 0},
+        }
+
+    def invoke(self, input, *args, **kwargs) -> Dict[str, Any]:
+        text = input if isinstance(input, str) else (input or {}).get("input", "")
+        query = _classification_query(str(text))
+        rec = _CURRENT_RECORD.get()
+
+        if self.opts["csv_rule"] and not any(
+                m in query.lower() for m in (".csv", "column")):
+            if rec is not None:
+                rec.set(classification_path="rule")
+            return {"input": text, "output": self.opts["no_csv_label"],
+                    "classification_path": "rule"}
+
+        v = self.vote(query)
+        CASCADE.knn(rec, self.cfg, v["margin"])
+        confident = v["margin"] >= float(self.opts["min_margin"])
+        path = "knn" if confident or self.fallback is None else "agent"
+        if rec is not None:
+            rec.set(classification_path=path, knn_label=v["label"],
+                    knn_margin=v["margin"], knn_scores=v["scores"])
+        if path == "knn":
+            return {"input": text, "output": v["label"],
+                    "classification_path": "knn", "knn_margin": v["margin"]}
+        out = self.fallback.invoke(input, *args, **kwargs)
+        if isinstance(out, dict):
+            out = {**out, "classification_path": "agent"}
+        return out
+
+    __call__ = invoke
+
+
+_BATCH_DEFAULTS: Dict[str, Any] = {
+    "max_prompt_tokens": 12000,       # preamble + queries, per call
+    "max_queries": 25,
+    "output_tokens_per_query": 24,    # reserve for the JSON answer
+}
+
+BATCH_CLASSIFY_PROMPT = """\
+You classify operations research problems. For every numbered problem below, \
+answer with exactly one of these categories: {labels}.
+
+If a problem does not mention any '.csv' file or 'column', classify it as \
+'{no_csv_label}' whatever it is about.
+{examples}
+Return one entry per problem, using the problem's number as `id`.
+
+{queries}
+"""
+
+
+def _largest_remainder(total: int, fracs: List[float]) -> List[int]:
+    """Split an integer total by fractions so the parts sum to it exactly."""
+    raw = [total * f for f in fracs]
+    out = [int(r) for r in raw]
+    for i in sorted(range(len(raw)), key=lambda i: out[i] - raw[i])[
+            :total - sum(out)]:
+        out[i] += 1
+    return out
+
+
+class BatchClassifier:
+    """
+    Classify a whole batch in a few structured-output calls, then hand each
+    instance its label -- and its share of the bill -- when it asks.
+
+        clf = lx.BatchClassifier(CFG, llm1, fallback=classification_agent,
+                                 examples=few_shot_examples_csv)
+        clf.prepare(test["Query"])        # before the loop: ceil(N/chunk) calls
+        run_test(test, clf)               # drop-in for the agent
+
+    Classified one by one, every instance re-sends the same instructions and
+    few-shot examples; here the preamble is paid once per chunk. Chunks are
+    sized so preamble + queries + an output reserve stay within
+    classification.batch.max_prompt_tokens (and max_queries).
+
+    Accounting stays per instance. The chunk's LLM call is recorded into a
+    holding record, not into any instance; when an instance then calls
+    invoke() inside its own `LOG.instance(...)`, it receives a `classification`
+    stage call carrying its apportioned share: an equal part of the preamble
+    plus its own query's tokens, and the same fraction of completion tokens,
+    cached tokens, cost and latency. Integer token shares are rounded so they
+    sum exactly to the chunk's totals. The call is tagged batched=True with
+    the chunk id and size, so stage_breakdown stays valid and the batching is
+    visible in calls.jsonl. A share is charged only when its instance runs:
+    instances skipped by a resume leave theirs unbilled. A query that occurs
+    several times in prepare()'s list is sent once and its slot is split
+    into one share per occurrence.
+
+    A query the model left out of its answer (or answered outside the label
+    set), or whose chunk's call failed, goes to `fallback.invoke` and is
+    logged as path "agent".
+    """
+
+    def __init__(self, cfg: ExpConfig, llm, fallback=None, examples: str = "",
+                 labels: Optional[List[str]] = None):
+        self.cfg = cfg
+        self.llm = llm
+        self.fallback = fallback
+        self.examples = examples or ""
+        self.opts = {**_BATCH_DEFAULTS,
+                     **(cfg.classification.get("batch") or {})}
+        knn = {**_KNN_DEFAULTS, **(cfg.classification.get("knn") or {})}
+        self.no_csv_label = knn["no_csv_label"]
+        self.labels = list(labels or cfg.classification.get("labels") or [])
+        if not self.labels:
+            raise ValueError("BatchClassifier needs classification.labels")
+        self._answers: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.calls: List[Dict[str, Any]] = []     # one per chunk, full cost
+
+    def _prompt(self, queries: List[str]) -> str:
+        ex = (f"\nExamples:\n{self.examples.strip()}\n"
+              if self.examples.strip() else "")
+        return BATCH_CLASSIFY_PROMPT.format(
+            labels=", ".join(self.labels), no_csv_label=self.no_csv_label,
+            examples=ex,
+            queries="\n\n".join(f"[{i}] {q}" for i, q in enumerate(queries)))
+
+    def _schema(self) -> Dict[str, Any]:
+        return {
+            "title": "batch_classification",
+            "description": "One problem category per numbered problem.",
+            "type": "object",
+            "properties": {"labels": {"type": "array", "items": {
+                "type": "object",
+                "properties": {"id": {"type": "integer"},
+                               "label": {"type": "string",
+                                         "enum": self.labels}},
+                "required": ["id", "label"]}}},
+            "required": ["labels"],
+        }
+
+    def chunks(self, queries: List[str]) -> List[List[str]]:
+        enc = self.cfg.token_fallback_encoder
+        budget = int(self.opts["max_prompt_tokens"])
+        fixed = _estimate_tokens(self._prompt([]), enc)
+        per_out = int(self.opts["output_tokens_per_query"])
+        out, cur, used = [], [], fixed
+        for q in queries:
+            t = _estimate_tokens(q, enc) + per_out + 4
+            if cur and (used + t > budget
+                        or len(cur) >= int(self.opts["max_queries"])):
+                out.append(cur)
+                cur, used = [], fixed
+            cur.append(q)
+            used += t
+        if cur:
+            out.append(cur)
+        return out
+
+    def prepare(self, queries) -> Dict[str, Optional[str]]:
+        """Classify every query; returns {query: label or None}."""
+        queries = [_classification_query(str(q)) for q in queries]
+        # a query repeated in the dataset (or across repeats) is sent once,
+        # but every occurrence is an instance that will ask for it
+        seen = Counter(q for q in queries if q not in self._answers)
+        todo = list(seen)
+        structured = self.llm.with_structured_output(self._schema())
+        enc = self.cfg.token_fallback_encoder
+        for chunk in self.chunks(todo):
+            holder = InstanceRecord(run_id=self.cfg.run_id,
+                                    instance_id="__batch__", dataset="",
+                                    method="", model_profile="",
+                                    repeat_index=0)
+            holder.t_start = time.perf_counter()
+            token = _CURRENT_RECORD.set(holder)
+            error = None
+            try:
+                with stage("classification"):
+                    out = call_with_retry(structured.invoke, self.cfg,
+                                          self._prompt(chunk))
+            except Exception as e:                    # noqa: BLE001
+                # the chunk's queries go to the agent like unanswered ones;
+                # whatever the failed attempts cost is still shared out
+                out, error = None, f"{type(e).__name__}: {e}"[:300]
+                print(f"[leanopt_exp] batch classification of {len(chunk)} "
+                      f"queries failed ({error}); they fall back to the agent")
+            finally:
+                _CURRENT_RECORD.reset(token)
+            got: Dict[int, str] = {}
+            for item in (out or {}).get("labels", []) if isinstance(out, dict) \
+                    else []:
+                try:
+                    i, lab = int(item["id"]), str(item["label"]).strip()
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if 0 <= i < len(chunk) and lab in self.labels:
+                    got[i] = lab
+
+            llm_calls = [c for c in holder.calls if c.get("type") == "llm"]
+            batch_id = f"b{len(self.calls)}"
+            total = {k: sum(c.get(k) or 0 for c in llm_calls)
+                     for k in ("prompt_tokens", "completion_tokens",
+                               "cached_prompt_tokens", "cost_usd",
+                               "cache_saved_usd", "latency_s")}
+            self.calls.append({"batch_id": batch_id, "size": len(chunk),
+                               **total, "error": error})
+            q_tok = [_estimate_tokens(q, enc) for q in chunk]
+            pre = max(total["prompt_tokens"] - sum(q_tok), 0)
+            denom = pre + sum(q_tok) or 1
+            # one share per occurrence: a query asked n times splits its
+            # slot n ways, so the shares still sum to the chunk's totals
+            slots = [i for i, q in enumerate(chunk) for _ in range(seen[q])]
+            fracs = [(pre / len(chunk) + q_tok[i]) / denom / seen[chunk[i]]
+                     for i in slots]
+            shares = {k: _largest_remainder(int(total[k]), fracs)
+                      for k in ("prompt_tokens", "completion_tokens",
+                                "cached_prompt_tokens")}
+            model = next((c.get("model") for c in llm_calls), None)
+            for j, i in enumerate(slots):
+                q = chunk[i]
+                ans = self._answers.setdefault(
+                    q, {"label": got.get(i), "batch_id": batch_id,
+                        "shares": deque()})
+                ans["shares"].append({
+                        "type": "llm", "stage": "classification",
+                        "model": model, "batched": True,
+                        "batch_id": batch_id, "batch_size": len(chunk),
+                        # the fraction of the chunk's requests (retries
+                        # included) this share stands for, so n_llm_calls
+                        # still sums to the requests actually sent
+                        "call_weight": len(llm_calls) / (len(chunk) * seen[q]),
+                        "prompt_tokens": shares["prompt_tokens"][j],
+                        "completion_tokens": shares["completion_tokens"][j],
+                        "total_tokens": shares["prompt_tokens"][j]
+                                        + shares["completion_tokens"][j],
+                        "cached_prompt_tokens":
+                            shares["cached_prompt_tokens"][j],
+                        "token_source": "apportioned",
+                        "latency_s": total["latency_s"] * fracs[j],
+                        "batch_latency_s": total["latency_s"],
+                        "cost_usd": total["cost_usd"] * fracs[j],
+                        "cache_saved_usd":
+                            total["cache_saved_usd"] * fracs[j],
+                        "ok": error is None
+                              and all(c.get("ok", True) for c in llm_calls),
+                    })
+        return {q: (self._answers.get(q) or {}).get("label") for q in queries}
+
+    def invoke(self, input, *args, **kwargs) -> Dict[str, Any]:
+        text = input if isinstance(input, str) else (input or {}).get("input", "")
+        query = _classification_query(str(text))
+        # the label stays for every later instance with the same query; each
+        # takes one of the shares prepare() set aside, and an instance beyond
+        # those (prepare() saw the query fewer times) reuses a paid answer
+        ans = self._answers.get(query)
+        rec = _CURRENT_RECORD.get()
+        if ans is not None and rec is not None:
+            with self._lock:
+                share = ans["shares"].popleft() if ans["shares"] else None
+            if share is not None:
+                rec.add_call(share)
+        if ans is not None and ans["label"] is not None:
+            if rec is not None:
+                rec.set(classification_path="batch",
+                        classification_batch=ans["batch_id"])
+            return {"input": text, "output": ans["label"],
+                    "classification_path": "batch"}
+        if self.fallback is None:
+            raise KeyError(f"query was not classified by prepare(): "
+                           f"{query[:80]!r}")
+        if rec is not None:
+            rec.set(classification_path="agent")
+        out = self.fallback.invoke(input, *args, **kwargs)
+        if isinstance(out, dict):
+            out = {**out, "classification_path": "agent"}
+        return out
+
+    __call__ = invoke
+
+
+def build_classifier(cfg: ExpConfig, agent, embeddings=None, llm=None,
+                     examples: str = ""):
+    """The classifier classification.mode asks for: the agent itself
+    ("agent", the default), a KnnClassifier that falls back to it ("knn"),
+    or a BatchClassifier over `llm` that falls back to it ("batch"; call its
+    prepare() on the queries before the loop)."""
+    mode = cfg.classification.get("mode", "agent")
+    if mode == "agent":
+        return agent
+    if mode == "knn":
+        if embeddings is None:
+            raise ValueError("classification.mode = knn needs the embeddings")
+        return KnnClassifier(cfg, embeddings, fallback=agent)
+    if mode == "batch":
+        if llm is None:
+            raise ValueError("classification.mode = batch needs the llm")
+        return BatchClassifier(cfg, llm, fallback=agent, examples=examples)
+    raise ValueError(f"classification.mode must be agent, knn or batch, "
+                     f"got {mode!r}")
+
+
+# Errors that will never succeed on retry: no credit, bad key, no permission.
+# Retrying these just burns wall-clock (and, across 101 instances, a lot of it).
+_FATAL_ERROR_MARKERS = (
+    "insufficient_quota",          # 429 but really "your balance is empty"
+    "invalid_api_key",
+    "authentication",
+    "permission_denied",
+    "model_not_found",
+    "billing_not_active",
+)
+
+
+def is_fatal_api_error(exc: BaseException) -> bool:
+    text = f"{type(exc).__name__}: {exc}".lower()
+    return any(m in text for m in _FATAL_ERROR_MARKERS)
+
+
+def call_with_retry(fn, cfg: ExpConfig, *args, **kwargs):
+    """Uniform failure handling; retries are counted into the current record."""
+    last = None
+    for attempt in range(cfg.max_retries):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:                       # noqa: BLE001
+            last = e
+            rec = _CURRENT_RECORD.get()
+            if rec is not None:
+                rec.n_retries += 1
+                rec.errors.append(f"attempt{attempt}: {type(e).__name__}: {e}")
             if is_fatal_api_error(e):
                 print(f"[leanopt_exp] not retrying, this will not fix itself: "
                       f"{type(e).__name__}: {str(e)[:160]}")
@@ -1224,6 +4114,34 @@ def call_with_retry(fn, cfg: ExpConfig, *args, **kwargs):
     raise last  # type: ignore[misc]
 
 
+async def ainvoke_with_retry(fn, cfg: ExpConfig, *args, **kwargs):
+    """
+    call_with_retry for coroutines: `await lx.ainvoke_with_retry(llm.ainvoke,
+    CFG, messages)`. Same retry count, same fatal-error short circuit, same
+    bookkeeping on the current record -- but the backoff is an asyncio.sleep,
+    so one instance waiting out a 429 does not stall the others sharing the
+    event loop.
+    """
+    last = None
+    for attempt in range(cfg.max_retries):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:                       # noqa: BLE001
+            last = e
+            rec = _CURRENT_RECORD.get()
+            if rec is not None:
+                rec.n_retries += 1
+                rec.errors.append(f"attempt{attempt}: {type(e).__name__}: {e}")
+            if is_fatal_api_error(e):
+                print(f"[leanopt_exp] not retrying, this will not fix itself: "
+                      f"{type(e).__name__}: {str(e)[:160]}")
+                break
+            if attempt == cfg.max_retries - 1:
+                break
+            await asyncio.sleep(cfg.retry_backoff_s * (2 ** attempt))
+    raise last  # type: ignore[misc]
+
+
 # --------------------------------------------------------------------------- #
 # 3.  Run logging
 # --------------------------------------------------------------------------- #
@@ -1242,10 +4160,15 @@ class InstanceRecord:
     calls: List[Dict[str, Any]] = field(default_factory=list)
     trace: List[Dict[str, Any]] = field(default_factory=list)
     errors: List[str] = field(default_factory=list)
+    # stage / chain spans for the timeline (calls carry their own timing)
+    spans: List[Dict[str, Any]] = field(default_factory=list)
     n_retries: int = 0
     n_provider_retries: int = 0
     extra: Dict[str, Any] = field(default_factory=dict)
+    # process telemetry, filled when the instance closes (ResourceSampler)
+    resources: Dict[str, Any] = field(default_factory=dict)
     t_start: float = 0.0
+    started_unix: float = 0.0          # time.time() at t_start
     wall_s: Optional[float] = None
     status: str = "pending"
 
@@ -1260,6 +4183,10 @@ class InstanceRecord:
         with self._lock:
             self.trace.append(item)
 
+    def add_span(self, span: Dict[str, Any]):
+        with self._lock:
+            self.spans.append(span)
+
     def fail(self, exc: BaseException, note: str = ""):
         """
         Mark this instance as failed when the exception is caught inside the
@@ -1284,18 +4211,25 @@ class InstanceRecord:
         tools = [c for c in self.calls if c.get("type") == "tool"]
         retr = [c for c in self.calls if c.get("type") == "retriever"]
         embs = [c for c in self.calls if c.get("type") == "embedding"]
+        sql = [c for c in self.calls if c.get("type") == "sql"]
+        idx = [c for c in self.calls if c.get("type") == "index"]
         def _blank():
             return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
-                    "cost_usd": 0.0, "latency_s": 0.0,
-                    "tool_calls": 0, "retriever_calls": 0, "tool_latency_s": 0.0}
+                    "cached_prompt_tokens": 0, "cost_usd": 0.0,
+                    "cache_saved_usd": 0.0, "latency_s": 0.0,
+                    "tool_calls": 0, "retriever_calls": 0, "tool_latency_s": 0.0,
+                    "retriever_latency_s": 0.0, "index_build_s": 0.0,
+                    "sql_queries": 0}
 
         by_stage: Dict[str, Dict[str, float]] = {}
         for c in llm:
             s = by_stage.setdefault(c.get("stage", "unassigned"), _blank())
-            s["calls"] += 1
+            s["calls"] += _call_weight(c)
             s["prompt_tokens"] += c.get("prompt_tokens") or 0
             s["completion_tokens"] += c.get("completion_tokens") or 0
+            s["cached_prompt_tokens"] += c.get("cached_prompt_tokens") or 0
             s["cost_usd"] += c.get("cost_usd") or 0.0
+            s["cache_saved_usd"] += c.get("cache_saved_usd") or 0.0
             s["latency_s"] += c.get("latency_s") or 0.0
         for c in tools:
             s = by_stage.setdefault(c.get("stage", "unassigned"), _blank())
@@ -1304,28 +4238,54 @@ class InstanceRecord:
         for c in retr:
             s = by_stage.setdefault(c.get("stage", "unassigned"), _blank())
             s["retriever_calls"] += 1
+            s["retriever_latency_s"] += c.get("latency_s") or 0.0
+        for c in sql:
+            s = by_stage.setdefault(c.get("stage", "unassigned"), _blank())
+            s["sql_queries"] += 1
+        for c in idx:
+            s = by_stage.setdefault(c.get("stage", "unassigned"), _blank())
+            s["index_build_s"] += c.get("latency_s") or 0.0
+        for s in by_stage.values():
+            s["calls"] = _as_count(s["calls"])
         return {
-            "n_llm_calls": len(llm),
+            # a batched call's share counts as its call_weight (1/batch_size
+            # unless a query filled several slots), so the run total is the
+            # number of requests actually sent
+            "n_llm_calls": _as_count(sum(_call_weight(c) for c in llm)),
             "n_llm_calls_failed": sum(1 for c in llm if not c.get("ok", True)),
             "n_tool_calls": len(tools),
             "n_tool_calls_failed": sum(1 for c in tools if not c.get("ok", True)),
             "n_retriever_calls": len(retr),
+            "n_sql_queries": len(sql),
+            "n_sql_queries_failed": sum(1 for c in sql if not c.get("ok", True)),
+            "n_sql_truncated": sum(1 for c in sql if c.get("truncated")),
+            "sql_rows_returned": sum(c.get("rows") or 0 for c in sql),
+            "sql_latency_s": round(sum(c.get("latency_s") or 0.0 for c in sql), 3),
             "prompt_tokens": sum(c.get("prompt_tokens") or 0 for c in llm),
             "completion_tokens": sum(c.get("completion_tokens") or 0 for c in llm),
             "cached_prompt_tokens": sum(c.get("cached_prompt_tokens") or 0
                                         for c in llm),
             "reasoning_tokens": sum(c.get("reasoning_tokens") or 0 for c in llm),
             "total_tokens": sum(c.get("total_tokens") or 0 for c in llm),
-            "n_embedding_calls": len(embs),
+            "n_embedding_calls": _as_count(sum(_call_weight(c) for c in embs)),
             "embedding_tokens": sum(c.get("prompt_tokens") or 0 for c in embs),
             "embedding_cost_usd": round(
                 sum(c.get("cost_usd") or 0.0 for c in embs), 6),
             "cost_usd": round(sum(c.get("cost_usd") or 0.0
                                   for c in llm + embs), 6),
             "llm_cost_usd": round(sum(c.get("cost_usd") or 0.0 for c in llm), 6),
+            "cache_saved_usd": round(
+                sum(c.get("cache_saved_usd") or 0.0 for c in llm), 6),
+            "n_cache_hits": sum(1 for c in llm if c.get("cache_hit")),
+            "replayed_cost_usd": round(
+                sum(c.get("replayed_cost_usd") or 0.0 for c in llm), 6),
             "llm_latency_s": round(sum(c.get("latency_s") or 0.0 for c in llm), 3),
             "tool_latency_s": round(sum(c.get("latency_s") or 0.0 for c in tools), 3),
+            "retriever_latency_s": round(
+                sum(c.get("latency_s") or 0.0 for c in retr), 3),
+            "index_build_s": round(sum(c.get("latency_s") or 0.0 for c in idx), 3),
             "wall_s": self.wall_s,
+            **self.resources,
             "n_estimated_token_calls": sum(
                 1 for c in llm if c.get("token_source") == "estimated"),
             "n_price_missing_calls": sum(
@@ -1355,10 +4315,26 @@ class InstanceRecord:
             "summary": self.summary(),
             "calls": calls,
             "trace": self.trace,
+            "started_unix": self.started_unix,
+            "spans": self.spans,
             **self.extra,
         }
 
 
+def _call_weight(call: Dict[str, Any]) -> float:
+    if call.get("call_weight") is not None:
+        return call["call_weight"]
+    if call.get("batched") and call.get("batch_size"):
+        return 1.0 / call["batch_size"]
+    return 1
+
+
+def _as_count(x: float):
+    # shares of 1/7 sum to 0.9999999999999998, not 1
+    x = round(float(x), 9)
+    return int(x) if x.is_integer() else x
+
+
 class BudgetExceeded(RuntimeError):
     """Raised after an instance pushes the run over cfg.budget_usd_per_run."""
 
@@ -1423,8 +4399,7 @@ class RunLogger:
         self._started = True
         print(f"[leanopt_exp] logging to {self._dir.resolve()}")
 
-    @contextlib.contextmanager
-    def instance(self, instance_id, query: str = "", gold_type=None, **extra):
+    def _new_record(self, instance_id, query, gold_type, extra):
         rec = InstanceRecord(
             run_id=self.cfg.run_id, instance_id=instance_id,
             dataset=self.cfg.dataset, method=self.cfg.method,
@@ -1434,6 +4409,26 @@ class RunLogger:
         )
         rec.extra.update(extra)
         rec.t_start = time.perf_counter()
+        rec.started_unix = time.time()
+        if self.cfg.telemetry.get("enabled", True):
+            RESOURCES.start(rec, self.cfg.telemetry.get("interval_s", 0.25))
+        return rec
+
+    @staticmethod
+    def _mark_raised(rec: InstanceRecord, e: BaseException):
+        # BaseException, not Exception: a KeyboardInterrupt (stopping the
+        # cell in Jupyter) used to slip through and leave the row stuck at
+        # status="pending", which then polluted the aggregation. A cancelled
+        # task is the async spelling of the same thing.
+        rec.status = ("interrupted"
+                      if isinstance(e, (KeyboardInterrupt,
+                                        asyncio.CancelledError))
+                      else "failed")
+        rec.errors.append(f"{type(e).__name__}: {e}")
+
+    @contextlib.contextmanager
+    def instance(self, instance_id, query: str = "", gold_type=None, **extra):
+        rec = self._new_record(instance_id, query, gold_type, extra)
         token = _CURRENT_RECORD.set(rec)
         try:
             yield rec
@@ -1442,21 +4437,60 @@ class RunLogger:
             if rec.status == "pending":
                 rec.status = "ok"
         except BaseException as e:                    # noqa: BLE001
-            # BaseException, not Exception: a KeyboardInterrupt (stopping the
-            # cell in Jupyter) used to slip through and leave the row stuck at
-            # status="pending", which then polluted the aggregation.
-            rec.status = ("interrupted"
-                          if isinstance(e, KeyboardInterrupt) else "failed")
-            rec.errors.append(f"{type(e).__name__}: {e}")
+            self._mark_raised(rec, e)
             raise
         finally:
             _CURRENT_RECORD.reset(token)
-            rec.wall_s = round(time.perf_counter() - rec.t_start, 3)
+            self._settle(rec)
             self._flush(rec)
             if self.cfg.sleep_between_instances_s:
                 time.sleep(self.cfg.sleep_between_instances_s)
         self.check_budget()
 
+    @contextlib.asynccontextmanager
+    async def ainstance(self, instance_id, query: str = "", gold_type=None,
+                        **extra):
+        """
+        `async with LOG.ainstance(...) as rec:` -- instance() for coroutines.
+
+        Every asyncio task runs in its own copy of the context, so the record
+        set here is the one the tracker sees for every call the task makes,
+        however many other instances are in flight on the same loop. Flushing
+        is synchronous and has no await in it, so lines from concurrent
+        instances never interleave in the JSONL files.
+        """
+        rec = self._new_record(instance_id, query, gold_type, extra)
+        token = _CURRENT_RECORD.set(rec)
+        try:
+            yield rec
+            if rec.status == "pending":
+                rec.status = "ok"
+        except BaseException as e:                    # noqa: BLE001
+            self._mark_raised(rec, e)
+            raise
+        finally:
+            _CURRENT_RECORD.reset(token)
+            self._settle(rec)
+            self._flush(rec)
+            if self.cfg.sleep_between_instances_s:
+                await asyncio.sleep(self.cfg.sleep_between_instances_s)
+        self.check_budget()
+
+    @staticmethod
+    def _settle(rec: InstanceRecord):
+        """Wait for the instance's unused early tool starts, close its SQL
+        connections, take the wall time, free its own vector stores (live index bytes before the
+        release, bytes freed) and close its telemetry, so rss_end_mb is
+        measured after the release."""
+        EARLY_TOOLS.release(rec)
+        CASCADE.release(rec)
+        SQL_TOOLS.release(rec)
+        rec.wall_s = round(time.perf_counter() - rec.t_start, 3)
+        live = INDEXES.nbytes()
+        freed = INDEXES.release(rec)
+        rec.set(index_bytes=live, index_bytes_freed=freed)
+        rec.resources = RESOURCES.stop(rec)
+
     def _flush(self, rec: InstanceRecord):
         self._ensure()
         self.records.append(rec)
@@ -1517,12 +4551,16 @@ class RunLogger:
         for k in keys:
             vals = [r.summary().get(k) or 0 for r in self.records]
             agg[f"total_{k}"] = round(sum(vals), 6)
+            if k.startswith("n_"):
+                agg[f"total_{k}"] = _as_count(agg[f"total_{k}"])
             agg[f"mean_{k}"] = round(sum(vals) / len(vals), 4) if vals else 0
         agg["n_failed"] = sum(1 for r in self.records if r.status == "failed")
         (self._dir / "summary.json").write_text(
             json.dumps(agg, indent=2, default=str), encoding="utf-8")
         self._inst_f.close()
         self._call_f.close()
+        if self.cfg.trace.get("write_on_close", True):
+            export_trace(self)
         # Safe to call close() after each slice of a batch: the next instance
         # simply reopens the same files in append mode.
         self._started = False
@@ -1532,3 +4570,210 @@ class RunLogger:
               f"${agg['total_cost_usd']:.4f} | "
               f"{agg['total_wall_s']:.1f}s")
         return agg
+
+
+# --------------------------------------------------------------------------- #
+# Timeline export (Chrome trace / Perfetto).
+#
+# The call records say how long each call took; they do not show where an
+# instance's wall clock went -- which calls ran back to back, what an agent
+# did between two LLM calls, what could have overlapped. chrome_trace lays
+# the instance out as nested spans:
+#
+#   instance -> stage -> agent / chain -> tool -> chain -> retriever / LLM
+#
+# from the stage and chain spans on the record plus every timed call. Open
+# the JSON in https://ui.perfetto.dev or chrome://tracing. Each instance gets
+# a row; spans that overlap without nesting (parallel tool calls, concurrent
+# instances' shared work) go to extra rows under it. LangChain's run ids are
+# kept in the span args (span_id / parent_id).
+# --------------------------------------------------------------------------- #
+def _trace_spans(d: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Spans of one instances.jsonl row (or InstanceRecord.to_json())."""
+    spans = [{"kind": "instance", "name": f"instance {d.get('instance_id')}",
+              "t0": 0.0, "t1": float(d.get("summary", {}).get("wall_s") or 0.0),
+              "status": d.get("status")}]
+    spans += [dict(s) for s in d.get("spans") or ()]
+    for c in d.get("calls") or ():
+        lat, t1 = c.get("latency_s"), c.get("t_rel_s")
+        if lat is None or t1 is None or c.get("batched"):
+            continue                # a batched share has no span of its own
+        kind = c.get("type", "call")
+        name = {"llm": c.get("model"), "tool": c.get("tool_name"),
+                "retriever": c.get("retriever"), "index": c.get("retriever"),
+                }.get(kind) or kind
+        args = {k: v for k, v in c.items()
+                if k not in ("prompts", "completion", "t_rel_s", "type")
+                and not isinstance(v, (dict, list))}
+        spans.append({**args, "kind": kind,
+                      "name": kind if name == kind else f"{kind}: {name}",
+                      "t0": max(0.0, t1 - lat), "t1": t1})
+    # wall_s is rounded to the millisecond; the instance encloses everything
+    spans[0]["t1"] = max(s["t1"] for s in spans)
+    return spans
+
+
+def _lanes(spans: List[Dict[str, Any]], eps: float = 5e-4) -> List[int]:
+    """Row for each span, so that the spans on one row nest. A span goes under
+    the innermost open span that encloses it (to rounding); one that encloses
+    nothing it overlaps takes a free row, or a new one."""
+    order = sorted(range(len(spans)),
+                   key=lambda i: (spans[i]["t0"], -spans[i]["t1"]))
+    stacks: List[List[Dict[str, Any]]] = []
+    lane = [0] * len(spans)
+    for i in order:
+        s = spans[i]
+        best, best_t0 = None, None
+        for j, stack in enumerate(stacks):
+            while stack and stack[-1]["t1"] <= s["t0"] + eps:
+                stack.pop()
+            top_t0 = stack[-1]["t0"] if stack else float("-inf")
+            fits = not stack or s["t1"] <= stack[-1]["t1"] + eps
+            if fits and (best is None or top_t0 > best_t0):
+                best, best_t0 = j, top_t0
+        if best is None:
+            stacks.append([])
+            best = len(stacks) - 1
+        stack = stacks[best]
+        if stack:
+            s["t1"] = min(s["t1"], stack[-1]["t1"])
+        stack.append(s)
+        lane[i] = best
+    return lane
+
+
+def chrome_trace(instances) -> Dict[str, Any]:
+    """
+    Chrome trace JSON for `instances`: InstanceRecords or instances.jsonl
+    rows, from one run or several. One process per run, one thread row per
+    instance (plus overflow rows), timestamps on the instances' real clock.
+    """
+    rows = [r.to_json(keep_prompts=False) if isinstance(r, InstanceRecord)
+            else r for r in instances]
+    t_origin = min((r.get("started_unix") or 0.0 for r in rows), default=0.0)
+    events: List[Dict[str, Any]] = []
+    pids: Dict[str, int] = {}
+    next_tid = 1
+    for r in rows:
+        run = str(r.get("run_id"))
+        if run not in pids:
+            pids[run] = len(pids) + 1
+            events.append({"ph": "M", "name": "process_name", "pid": pids[run],
+                           "tid": 0, "args": {"name": run}})
+        pid = pids[run]
+        base_us = ((r.get("started_unix") or t_origin) - t_origin) * 1e6
+        spans = _trace_spans(r)
+        lanes = _lanes(spans)
+        for k in range(max(lanes) + 1):
+            label = f"instance {r.get('instance_id')}" + (f" +{k}" if k else "")
+            events.append({"ph": "M", "name": "thread_name", "pid": pid,
+                           "tid": next_tid + k, "args": {"name": label}})
+            events.append({"ph": "M", "name": "thread_sort_index", "pid": pid,
+                           "tid": next_tid + k, "args": {"sort_index": next_tid + k}})
+        for s, k in zip(spans, lanes):
+            args = {a: v for a, v in s.items()
+                    if a not in ("kind", "name", "t0", "t1") and v is not None}
+            events.append({
+                "ph": "X", "name": s["name"], "cat": s["kind"],
+                "pid": pid, "tid": next_tid + k,
+                "ts": round(base_us + s["t0"] * 1e6, 1),
+                "dur": round(max(s["t1"] - s["t0"], 0.0) * 1e6, 1),
+                "args": args,
+            })
+        next_tid += max(lanes) + 1
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def _read_instances(path: Path) -> List[Dict[str, Any]]:
+    files = [path] if path.is_file() else sorted(path.rglob("instances.jsonl"))
+    out = []
+    for f in files:
+        for line in f.read_text(encoding="utf-8").splitlines():
+            if line.strip():
+                out.append(json.loads(line))
+    return out
+
+
+def export_trace(source, path=None, instance_id=None) -> Path:
+    """
+    Write chrome_trace(...) to `path` and return it.
+
+        lx.export_trace(rec, "trace_7.json")          # one instance
+        lx.export_trace(LOG)                          # runs/<run_id>/trace.json
+        lx.export_trace("runs/", "all.json")          # every run under runs/
+
+    `source` is an InstanceRecord, a list of them, a RunLogger, or a run
+    directory / instances.jsonl file; `instance_id` keeps only that instance.
+    """
+    default = None
+    if isinstance(source, RunLogger):
+        default = source.dir_path / "trace.json"
+        source = source.dir_path
+    if isinstance(source, InstanceRecord):
+        source = [source]
+    if isinstance(source, (str, Path)):
+        source = Path(source)
+        default = default or (source if source.is_dir()
+                              else source.parent) / "trace.json"
+        rows = _read_instances(source)
+    else:
+        rows = list(source)
+    if instance_id is not None:
+        rows = [r for r in rows if str(r.instance_id if isinstance(
+            r, InstanceRecord) else r.get("instance_id")) == str(instance_id)]
+    out = Path(path or default or "trace.json")
+    out.write_text(json.dumps(chrome_trace(rows), default=str), encoding="utf-8")
+    return out
+
+
+async def run_instances_async(log: RunLogger, jobs, worker,
+                              concurrency: Optional[int] = None) -> List[Any]:
+    """
+    Run many instances on one event loop, at most `concurrency` at a time.
+
+        async def solve(rec, job):
+            with lx.stage("single_call"):
+                resp = await lx.ainvoke_with_retry(llm.ainvoke, CFG, [...])
+            rec.set(model_output=resp.content)
+            return resp.content
+
+        jobs = [{"instance_id": i, "query": q} for i, q in ...]
+        results = asyncio.run(lx.run_instances_async(LOG, jobs, solve))
+
+    `jobs` are the keyword arguments of LOG.ainstance(); `worker(rec, job)` is
+    the per-instance coroutine. Build the LLMs (and agents, chains, ...) once
+    and share them across workers: one model object means one HTTP client and
+    so one connection pool, with keep-alive connections reused by every
+    instance instead of each one paying its own TLS handshake.
+
+    Returns the worker results in job order; an instance whose worker raised
+    yields None and is logged with status="failed", exactly as the sequential
+    loop would log it. BudgetExceeded is the exception: it cancels everything
+    still in flight (those rows are logged as "interrupted") and propagates,
+    so the cap stops the run the way it does sequentially -- with the
+    overshoot bounded by the instances already in flight rather than by one.
+    """
+    jobs = list(jobs)
+    limit = max(1, int(concurrency or log.cfg.async_concurrency or 1))
+    sem = asyncio.Semaphore(limit)
+
+    async def one(job):
+        async with sem:
+            try:
+                async with log.ainstance(**job) as rec:
+                    return await worker(rec, job)
+            except BudgetExceeded:
+                raise
+            except Exception as e:                    # noqa: BLE001
+                print(f"[leanopt_exp] instance {job.get('instance_id')} "
+                      f"failed: {type(e).__name__}: {str(e)[:160]}")
+                return None
+
+    tasks = [asyncio.ensure_future(one(j)) for j in jobs]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+monitor_runs.py
+===============
+Live view of a run while it is still going.
+
+    python monitor_runs.py runs/                     # the most recent run
+    python monitor_runs.py runs/<run_id>             # that run
+    python monitor_runs.py runs/ --run gpt-4.1 --total 101
+    python monitor_runs.py runs/<run_id> --once      # one snapshot, no refresh
+
+Why this exists
+---------------
+During a 30-minute batch the notebook prints one line per instance, and the
+totals only appear when LOG.close() runs. By then a mispriced profile, a
+provider throttling every other call or a stage that suddenly takes 40 s has
+already cost the whole batch.
+
+What it shows
+-------------
+calls / tokens / USD per minute, the call failure rate and the p95 latency of
+each stage, all over a rolling window (--window, default 5 min); instances
+done and failed; and an ETA from the remaining instance count at the run's
+throughput so far.
+
+How it reads
+------------
+RunLogger writes an instance's line to instances.jsonl and then its calls to
+calls.jsonl, once the instance ends. Both files are tailed by byte offset:
+each refresh reads only what was appended since the last one, so a refresh
+costs the same at instance 5 as at instance 500. A call's time is its
+instance's started_unix + t_rel_s, so the per-minute rates follow when the
+calls happened, not when they were flushed.
+"""
+
+from __future__ import annotations
+
+import argparse
+import bisect
+import json
+import math
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class JsonlTail:
+    """Reads the complete lines appended to a JSONL file since the last call."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.offset = 0
+        self._partial = b""
+
+    def read_new(self) -> List[Dict[str, Any]]:
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            return []
+        if size < self.offset:               # truncated / replaced: start over
+            self.offset, self._partial = 0, b""
+        if size == self.offset:
+            return []
+        with self.path.open("rb") as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        self.offset += len(data)
+        # a line still being written stays in _partial until its newline lands
+        *lines, self._partial = (self._partial + data).split(b"\n")
+        out = []
+        for line in lines:
+            if line.strip():
+                try:
+                    out.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+        return out
+
+
+def _p95(values: List[float]) -> float:
+    if not values:
+        return math.nan
+    v = sorted(values)
+    return v[min(len(v) - 1, int(math.ceil(0.95 * len(v))) - 1)]
+
+
+class Monitor:
+    """Running totals for one run directory, fed incrementally by poll()."""
+
+    def __init__(self, run_dir: Path, total: Optional[int] = None,
+                 window_s: float = 300.0):
+        self.run_dir = Path(run_dir)
+        self.window_s = window_s
+        self.total = total if total is not None else self._planned_instances()
+        self._inst = JsonlTail(self.run_dir / "instances.jsonl")
+        self._calls = JsonlTail(self.run_dir / "calls.jsonl")
+        self._started: Dict[str, float] = {}    # instance_id -> started_unix
+        self._status: Dict[str, str] = {}       # last record wins, as elsewhere
+        self.first_start: Optional[float] = None
+        # (t, stage, latency_s, tokens, cost_usd, ok) of the calls in the
+        # window, kept sorted by t: instances finish out of order under
+        # concurrency, so calls.jsonl is not in time order
+        self.window: List[Tuple[float, str, float, int, float, bool]] = []
+        self.n_calls = 0
+        self.cost_usd = 0.0
+        self.tokens = 0
+
+    def _planned_instances(self) -> Optional[int]:
+        """The dataset's row count from config.json (the run's manifest)."""
+        try:
+            cfg = json.loads((self.run_dir / "config.json").read_text(
+                encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            return None
+        return ((cfg.get("manifest") or {}).get("dataset") or {}).get("rows")
+
+    # ------------------------------------------------------------------ #
+    def poll(self, now: Optional[float] = None) -> int:
+        """Take in what was appended; returns how many lines that was."""
+        now = time.time() if now is None else now
+        inst = self._inst.read_new()
+        for d in inst:
+            iid = str(d.get("instance_id"))
+            t0 = d.get("started_unix")
+            if t0:
+                self._started[iid] = t0
+                self.first_start = min(self.first_start or t0, t0)
+            self._status[iid] = d.get("status") or "?"
+        calls = self._calls.read_new()
+        for c in calls:
+            t0 = self._started.get(str(c.get("instance_id")))
+            t = (t0 + (c.get("t_rel_s") or 0.0)) if t0 else now
+            tokens = (c.get("total_tokens") or 0) if c.get("type") == "llm" else 0
+            cost = c.get("cost_usd") or 0.0
+            self.n_calls += 1
+            self.tokens += tokens
+            self.cost_usd += cost
+            bisect.insort(self.window, (t, c.get("stage") or "unassigned",
+                                        c.get("latency_s") or 0.0, tokens,
+                                        cost, c.get("ok", True) is not False))
+        del self.window[:self._window_start(now)]
+        return len(inst) + len(calls)
+
+    def _window_start(self, now: float) -> int:
+        """Index of the first call inside the window ending at `now`."""
+        return bisect.bisect_left(self.window, (now - self.window_s,))
+
+    # ------------------------------------------------------------------ #
+    def snapshot(self, now: Optional[float] = None) -> Dict[str, Any]:
+        now = time.time() if now is None else now
+        # a window that began before the run did is only as long as the run
+        span = min(self.window_s, now - (self.first_start or now)) or self.window_s
+        per_min = 60.0 / span
+        window = self.window[self._window_start(now):]
+        stages: Dict[str, List[float]] = {}
+        for _, stage, lat, *_ in window:
+            stages.setdefault(stage, []).append(lat)
+        n_win = len(window)
+        done = len(self._status)
+        failed = sum(1 for s in self._status.values() if s != "ok")
+        eta = None
+        if self.total and done and self.first_start:
+            # the run's pace up to now, idle time since the last finish
+            # included: a stalled run's ETA grows instead of freezing
+            elapsed = max(now - self.first_start, 1e-9)
+            eta = max(self.total - done, 0) * elapsed / done
+        return {
+            "run": self.run_dir.name,
+            "done": done, "total": self.total, "failed": failed,
+            "calls_per_min": n_win * per_min,
+            "tokens_per_min": sum(w[3] for w in window) * per_min,
+            "usd_per_min": sum(w[4] for w in window) * per_min,
+            "call_failure_%": (100.0 * sum(1 for w in window if not w[5])
+                               / n_win) if n_win else math.nan,
+            "p95_latency_s": {s: _p95(v) for s, v in sorted(stages.items())},
+            "n_calls": self.n_calls, "tokens": self.tokens,
+            "cost_usd": self.cost_usd, "eta_s": eta,
+        }
+
+
+def render(s: Dict[str, Any], window_s: float) -> str:
+    def hms(sec):
+        if sec is None:
+            return "?"
+        sec = int(sec)
+        return f"{sec // 3600:d}:{sec % 3600 // 60:02d}:{sec % 60:02d}"
+
+    total = s["total"] if s["total"] is not None else "?"
+    lines = [
+        f"run       {s['run']}",
+        f"instances {s['done']} / {total} done, {s['failed']} failed"
+        f"   ETA {hms(s['eta_s'])}",
+        f"totals    {s['n_calls']} calls, {s['tokens']:,} tokens, "
+        f"${s['cost_usd']:.4f}",
+        f"last {window_s / 60:g} min: {s['calls_per_min']:.1f} calls/min, "
+        f"{s['tokens_per_min']:,.0f} tokens/min, ${s['usd_per_min']:.4f}/min, "
+        f"{s['call_failure_%']:.1f}% calls failed",
+        "p95 latency by stage:",
+    ]
+    for stage, v in s["p95_latency_s"].items():
+        lines.append(f"  {stage:<20} {v:8.2f} s")
+    if not s["p95_latency_s"]:
+        lines.append("  (no calls in the window yet)")
+    return "\n".join(lines)
+
+
+def _pick_run(root: Path, pattern: Optional[str]) -> Path:
+    if (root / "config.json").exists() or (root / "calls.jsonl").exists():
+        return root
+    runs = [d for d in root.iterdir() if d.is_dir()
+            and (pattern is None or pattern in d.name)]
+    if not runs:
+        raise SystemExit(f"no run directory under {root}"
+                         + (f" matching {pattern!r}" if pattern else ""))
+    # the run written to most recently is the one in progress
+    return max(runs, key=lambda d: max(
+        (f.stat().st_mtime for f in d.iterdir()), default=d.stat().st_mtime))
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("runs_dir", type=Path,
+                    help="a run directory, or runs/ to follow the latest run")
+    ap.add_argument("--run", default=None, help="substring filter on run_id")
+    ap.add_argument("--total", type=int, default=None,
+                    help="instances planned (default: dataset rows in "
+                         "config.json)")
+    ap.add_argument("--window", type=float, default=300.0,
+                    help="rolling window for the rates, seconds")
+    ap.add_argument("--interval", type=float, default=1.0)
+    ap.add_argument("--once", action="store_true",
+                    help="print one snapshot and exit")
+    args = ap.parse_args()
+
+    run_dir = _pick_run(args.runs_dir, args.run)
+    mon = Monitor(run_dir, total=args.total, window_s=args.window)
+    try:
+        while True:
+            mon.poll()
+            text = render(mon.snapshot(), args.window)
+            if args.once:
+                print(text)
+                return 0
+            # home + clear, so the block redraws in place
+            sys.stdout.write("\x1b[H\x1b[2J" + text + "\n")
+            sys.stdout.flush()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
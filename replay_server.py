@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+replay_server.py
+================
+A local OpenAI-compatible server that answers chat and embedding requests
+from the call records of earlier runs, so a whole pipeline can run offline.
+
+    python replay_server.py runs/                           # full speed
+    python replay_server.py runs/ --run LEAN-LLM-OPT__gpt-4.1 --port 8765
+    python replay_server.py runs/ --latency recorded        # as measured
+    python replay_server.py runs/ --latency recorded --latency-scale 0.25
+
+then run any notebook or script with the `replay` profile (or point any
+profile's base_url / embedding_base_url at http://127.0.0.1:8765/v1).
+
+Why this exists
+---------------
+A run's wall-clock is dominated by the provider, so nothing else in the
+pipeline -- FAISS builds, row serialisation, agent output parsing, logging,
+scoring -- can be measured on its own: every number carries the provider's
+latency, and that latency is neither ours nor repeatable. Replaying recorded
+answers takes the provider out. With `--latency none` what remains is the
+pipeline's own overhead; with `--latency recorded` the run keeps its original
+timing shape, which is what concurrency and caching changes need to be
+compared against, run after run, at no cost.
+
+How requests are matched
+------------------------
+Chat: the request's messages are flattened exactly the way UsageTracker
+flattens them into `prompts` ("human: ...\\nai: ...") and looked up verbatim.
+The response is the recorded `completion`, with the recorded usage,
+model name and system_fingerprint, so the tracker accounts for a replayed
+call the same way as for the original. Identical prompts recorded more than
+once are served in recorded order, round-robin.
+
+That needs runs recorded with log_prompts and log_raw_responses on (the
+default). A deterministic pipeline fed its own recorded answers asks the same
+questions again, so a replay of a temperature-0 run follows the original
+path; a prompt that was never recorded is a miss, answered with an
+OpenAI-style 404 (or a stub with --on-miss stub) and counted in /stats.
+
+Embeddings: the run log holds no vectors, so each text gets a deterministic
+pseudo-random unit vector seeded by its hash. Retrieval over them is not
+semantically meaningful, but index builds and searches do the same amount of
+work as with real vectors, which is what an overhead measurement needs.
+
+Tool-calling responses are replayed as their text only: the notebooks' agents
+are text ReAct agents, so the run log records no tool-call payloads.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import leanopt_exp as lx
+
+# OpenAI chat roles -> the message .type LangChain reports to the tracker,
+# which is what the recorded prompts were flattened with.
+ROLE_TO_TYPE = {"user": "human", "assistant": "ai", "system": "system",
+                "developer": "system", "tool": "tool", "function": "function"}
+
+
+def _key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _content_text(content) -> str:
+    if isinstance(content, list):                  # multi-part message
+        return "".join(p.get("text", "") for p in content
+                       if isinstance(p, dict))
+    return "" if content is None else str(content)
+
+
+def flatten_messages(messages: List[Dict[str, Any]]) -> str:
+    """Same rendering as UsageTracker.on_chat_model_start."""
+    return "\n".join(
+        f"{ROLE_TO_TYPE.get(m.get('role'), m.get('role'))}: "
+        f"{_content_text(m.get('content'))}" for m in messages)
+
+
+# --------------------------------------------------------------------------- #
+class Recordings:
+    """Recorded LLM calls, indexed by prompt text."""
+
+    def __init__(self):
+        self._by_key: Dict[str, deque] = defaultdict(deque)
+        self._lock = threading.Lock()
+        self.stats = {"records": 0, "skipped_no_prompt": 0, "hits": 0,
+                      "misses": 0, "embeddings": 0}
+
+    def load(self, root: Path, run_filter: Optional[str] = None) -> None:
+        for f in sorted(root.rglob("instances.jsonl")):
+            for line in f.read_text(encoding="utf-8").splitlines():
+                if not line.strip():
+                    continue
+                d = json.loads(line)
+                if run_filter and run_filter not in (d.get("run_id") or ""):
+                    continue
+                for c in d.get("calls") or []:
+                    if c.get("type") != "llm" or not c.get("ok", True):
+                        continue
+                    prompts = c.get("prompts")
+                    if not prompts or c.get("completion") is None:
+                        self.stats["skipped_no_prompt"] += 1
+                        continue
+                    self._by_key[_key("\n\n".join(prompts))].append(c)
+                    self.stats["records"] += 1
+
+    def count_embeddings(self, n: int) -> None:
+        with self._lock:
+            self.stats["embeddings"] += n
+
+    def __len__(self) -> int:
+        return len(self._by_key)
+
+    def take(self, prompt: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            q = self._by_key.get(_key(prompt))
+            if not q:
+                self.stats["misses"] += 1
+                return None
+            c = q[0]
+            q.rotate(-1)                          # round-robin over repeats
+            self.stats["hits"] += 1
+            return c
+
+
+def pseudo_embedding(text: str, dim: int) -> np.ndarray:
+    seed = int(_key(text)[:16], 16)
+    v = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+# --------------------------------------------------------------------------- #
+def make_handler(rec: Recordings, args):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"             # keep-alive for the pool
+
+        def log_message(self, fmt, *a):
+            if args.verbose:
+                super().log_message(fmt, *a)
+
+        # -- plumbing --------------------------------------------------- #
+        def _send_json(self, obj, status=200):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_json(self) -> Dict[str, Any]:
+            n = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(n) or b"{}")
+
+        def _sleep(self, latency_s):
+            if args.latency == "recorded" and latency_s:
+                time.sleep(float(latency_s) * args.latency_scale)
+
+        # -- routes ----------------------------------------------------- #
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                return self._send_json({"object": "list", "data": []})
+            if self.path.rstrip("/").endswith("/stats"):
+                return self._send_json({**rec.stats, "unique_prompts": len(rec)})
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+        def do_POST(self):
+            try:
+                req = self._read_json()
+            except ValueError as e:
+                return self._send_json(
+                    {"error": {"message": f"bad JSON: {e}"}}, 400)
+            if self.path.endswith("/chat/completions"):
+                return self._chat(req)
+            if self.path.endswith("/embeddings"):
+                return self._embeddings(req)
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+        def _chat(self, req):
+            prompt = flatten_messages(req.get("messages") or [])
+            c = rec.take(prompt)
+            if c is None:
+                if args.on_miss == "error":
+                    return self._send_json({"error": {
+                        "message": "replay_server: no recorded response for "
+                                   "this prompt",
+                        "type": "invalid_request_error",
+                        "code": "replay_miss"}}, 404)
+                c = {"completion": args.stub_text, "latency_s": 0.0,
+                     "prompt_tokens": lx._estimate_tokens(prompt),
+                     "completion_tokens": lx._estimate_tokens(args.stub_text)}
+            self._sleep(c.get("latency_s"))
+
+            text = c.get("completion") or ""
+            pt = int(c.get("prompt_tokens") or 0)
+            ct = int(c.get("completion_tokens") or 0)
+            usage = {"prompt_tokens": pt, "completion_tokens": ct,
+                     "total_tokens": pt + ct,
+                     "prompt_tokens_details": {
+                         "cached_tokens": int(c.get("cached_prompt_tokens") or 0)},
+                     "completion_tokens_details": {
+                         "reasoning_tokens": int(c.get("reasoning_tokens") or 0)}}
+            model = c.get("model") or req.get("model")
+            meta = {"id": f"chatcmpl-replay-{rec.stats['hits']}",
+                    "created": int(time.time()), "model": model,
+                    "system_fingerprint": c.get("system_fingerprint")}
+            n = int(req.get("n") or 1)
+
+            if not req.get("stream"):
+                return self._send_json({
+                    **meta, "object": "chat.completion",
+                    "choices": [{"index": i, "logprobs": None,
+                                 "finish_reason": "stop",
+                                 "message": {"role": "assistant",
+                                             "content": text}}
+                                for i in range(n)],
+                    "usage": usage})
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            def emit(obj):
+                self.wfile.write(f"data: {json.dumps(obj)}\n\n".encode())
+
+            chunk = {**meta, "object": "chat.completion.chunk"}
+            emit({**chunk, "choices": [{"index": 0, "finish_reason": None,
+                                        "delta": {"role": "assistant",
+                                                  "content": text}}]})
+            emit({**chunk, "choices": [{"index": 0, "finish_reason": "stop",
+                                        "delta": {}}]})
+            if (req.get("stream_options") or {}).get("include_usage"):
+                emit({**chunk, "choices": [], "usage": usage})
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+        def _embeddings(self, req):
+            inp = req.get("input")
+            if isinstance(inp, str) or (isinstance(inp, list) and inp
+                                        and isinstance(inp[0], int)):
+                inp = [inp]
+            texts = [t if isinstance(t, str) else json.dumps(t)
+                     for t in (inp or [])]
+            dim = int(req.get("dimensions") or args.embedding_dim)
+            b64 = req.get("encoding_format") == "base64"
+            data = []
+            for i, t in enumerate(texts):
+                v = pseudo_embedding(t, dim)
+                emb = (base64.b64encode(v.tobytes()).decode("ascii") if b64
+                       else v.tolist())
+                data.append({"object": "embedding", "index": i,
+                             "embedding": emb})
+            rec.count_embeddings(len(texts))
+            tok = sum(lx._estimate_tokens(t) for t in texts)
+            self._send_json({"object": "list", "data": data,
+                             "model": req.get("model"),
+                             "usage": {"prompt_tokens": tok,
+                                       "total_tokens": tok}})
+
+    return Handler
+
+
+# --------------------------------------------------------------------------- #
+def main() -> int:
+    ap = argparse.ArgumentParser(
+        description="Replay recorded LLM calls behind an OpenAI-compatible API.")
+    ap.add_argument("runs_dir", type=Path)
+    ap.add_argument("--run", default=None,
+                    help="substring filter on run_id; replay only those runs")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency", choices=["none", "recorded"], default="none",
+                    help="none: answer at once; recorded: sleep for the "
+                         "call's recorded latency_s before answering")
+    ap.add_argument("--latency-scale", type=float, default=1.0,
+                    help="multiply recorded latencies (0.25 = 4x faster)")
+    ap.add_argument("--on-miss", choices=["error", "stub"], default="error",
+                    help="unrecorded prompt: 404 (default) or a stub answer")
+    ap.add_argument("--stub-text", default="Final Answer: no recorded response")
+    ap.add_argument("--embedding-dim", type=int, default=1536)
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+
+    rec = Recordings()
+    rec.load(args.runs_dir, args.run)
+    print(f"[replay_server] {rec.stats['records']:,} recorded calls, "
+          f"{len(rec):,} distinct prompts"
+          f"{f' (run filter {args.run!r})' if args.run else ''}")
+    if rec.stats["skipped_no_prompt"]:
+        print(f"[replay_server] skipped {rec.stats['skipped_no_prompt']:,} "
+              f"calls logged without prompts/completion "
+              f"(log_prompts / log_raw_responses off)")
+    if not len(rec):
+        print("[replay_server] nothing to replay", file=sys.stderr)
+        return 1
+
+    srv = ThreadingHTTPServer((args.host, args.port), make_handler(rec, args))
+    srv.daemon_threads = True
+    print(f"[replay_server] listening on http://{args.host}:{args.port}/v1  "
+          f"latency={args.latency}"
+          f"{f' x{args.latency_scale:g}' if args.latency == 'recorded' else ''}")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+        s = rec.stats
+        print(f"\n[replay_server] served {s['hits']:,} hits, "
+              f"{s['misses']:,} misses, {s['embeddings']:,} embeddings")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,8 @@ be put side by side in the cost/accuracy table.
     python run_baseline.py --dataset Large-Scale-OR --profile gpt-5.2
     python run_baseline.py --dataset MAMO-complex   --profile gemini-3-pro
     python run_baseline.py --dataset Large-Scale-OR --profile gpt-4.1 --dry-run
+    python run_baseline.py --dataset Large-Scale-OR --profile gpt-4.1 --concurrency 32
+    python run_baseline.py --dataset Large-Scale-OR --profile gpt-4.1 --table-format csv
 
 Why this exists
 ---------------
@@ -37,6 +39,7 @@ truncated in the run log, so the paper can state exactly what the baseline saw.
 from __future__ import annotations
 
 import argparse
+import asyncio
 import json
 import re
 import sys
@@ -110,16 +113,18 @@ def load_dataset(name: str, cfg_raw: dict) -> pd.DataFrame:
 
 
 def build_data_section(dataset_address, max_rows_per_file: int,
-                       max_chars: int) -> tuple[str, dict]:
+                       max_chars: int, table_format: str = "kv"
+                       ) -> tuple[str, dict]:
     """
     Inline the referenced CSVs as text. Returns (text, stats).
 
     stats records exactly what the model was shown, so the truncation can be
-    reported rather than hidden.
+    reported rather than hidden. table_format is one of lx.TABLE_FORMATS; kv
+    lists the columns on a line of their own, the others carry their header.
     """
     stats = {"files": 0, "files_failed": 0, "rows_total": 0,
              "rows_included": 0, "truncated": False, "chars": 0,
-             "missing_files": []}
+             "missing_files": [], "table_format": table_format}
     if not isinstance(dataset_address, str) or not dataset_address.strip():
         return "", stats
 
@@ -145,12 +150,11 @@ def build_data_section(dataset_address, max_rows_per_file: int,
             note = (f"\n[... {len(df) - len(shown)} further rows omitted; "
                     f"the file has {len(df)} rows in total ...]")
 
-        body = "\n".join(
-            ", ".join(f"{c} = {r[c]}" for c in df.columns)
-            for _, r in shown.iterrows())
+        body = lx.serialize_table(shown, table_format)
+        columns = (f"Columns: {', '.join(map(str, df.columns))}\n"
+                   if table_format == "kv" else "")
         blocks.append(f"\n## File: {Path(fp).name}\n"
-                      f"Columns: {', '.join(map(str, df.columns))}\n"
-                      f"{body}{note}\n")
+                      f"{columns}{body}{note}\n")
 
     text = DATA_HEADER + "".join(blocks)
     if len(text) > max_chars:
@@ -191,8 +195,17 @@ def main() -> int:
     ap.add_argument("--max-rows-per-file", type=int, default=200)
     ap.add_argument("--max-data-chars", type=int, default=120_000)
     ap.add_argument("--query-column", default="Query")
+    ap.add_argument("--table-format", choices=lx.TABLE_FORMATS, default=None,
+                    help="how the inlined CSV rows are written (default: "
+                         "exp_config.yaml:table_format); --dry-run prints "
+                         "the prompt tokens of every format side by side")
     ap.add_argument("--dry-run", action="store_true",
                     help="build the prompts and report their size; no API calls")
+    ap.add_argument("--concurrency", type=int, default=1,
+                    help="instances in flight at once (default 1: the plain "
+                         "sequential loop). >1 drives the batch through "
+                         "lx.run_instances_async on one event loop sharing "
+                         "one model object and so one connection pool")
     args = ap.parse_args()
 
     _check_env()
@@ -219,6 +232,7 @@ def main() -> int:
                          notes=f"single-call baseline, "
                                f"max_rows_per_file={args.max_rows_per_file}")
 
+    table_format = args.table_format or cfg.table_format
     if not args.dry_run:
         lx.ensure_api_keys(cfg)
     log = lx.RunLogger(cfg)
@@ -246,31 +260,55 @@ def main() -> int:
         c = colmap.get(field)
         return row.get(c) if c else None
 
+    def report(idx, rec, code, dstats):
+        s = rec.summary()
+        print(f"[{idx}] {rec.status:7s} "
+              f"in={s['prompt_tokens']:>7,} out={s['completion_tokens']:>6,} "
+              f"${s['cost_usd']:.4f} {s['wall_s']:>5.1f}s "
+              f"code={'yes' if code else 'NO'}"
+              f"{' TRUNCATED-DATA' if dstats['truncated'] else ''}")
+
     rows_out = []
+    pending = []                         # (idx, query, prompt, dstats, job)
     for idx, row in test.iterrows():
         query = str(row[colmap["query"]])
         data_text, dstats = build_data_section(
             cell(row, "dataset_address"), args.max_rows_per_file,
-            args.max_data_chars)
+            args.max_data_chars, table_format)
         prompt = PROMPT_TEMPLATE.format(query=query, data_section=data_text)
         approx = lx._estimate_tokens(prompt, cfg.token_fallback_encoder)
 
         if args.dry_run:
+            # the same prompt in every table format, so the saving can be
+            # read off before paying for an accuracy comparison
+            by_fmt = {}
+            for f in lx.TABLE_FORMATS:
+                t, _ = build_data_section(
+                    cell(row, "dataset_address"), args.max_rows_per_file,
+                    args.max_data_chars, f)
+                by_fmt[f"tokens_{f}"] = lx._estimate_tokens(
+                    PROMPT_TEMPLATE.format(query=query, data_section=t),
+                    cfg.token_fallback_encoder)
             print(f"[{idx}] prompt ~{approx:>7,} tokens | "
                   f"files={dstats['files']} "
                   f"rows {dstats['rows_included']}/{dstats['rows_total']}"
                   f"{' TRUNCATED' if dstats['truncated'] else ''}")
             rows_out.append({"instance_id": idx, "approx_prompt_tokens": approx,
-                             **dstats})
+                             **by_fmt, **dstats})
             continue
 
-        with log.instance(instance_id=int(idx), query=query,
-                          gold_type=cell(row, "gold_type"),
-                          dataset_address=cell(row, "dataset_address"),
-                          size_class=cell(row, "size_class"),
-                          gold_objective=cell(row, "gold_objective"),
-                          prompt_chars=len(prompt),
-                          **{f"data_{k}": v for k, v in dstats.items()}) as rec:
+        job = dict(instance_id=int(idx), query=query,
+                   gold_type=cell(row, "gold_type"),
+                   dataset_address=cell(row, "dataset_address"),
+                   size_class=cell(row, "size_class"),
+                   gold_objective=cell(row, "gold_objective"),
+                   prompt_chars=len(prompt),
+                   **{f"data_{k}": v for k, v in dstats.items()})
+        if args.concurrency > 1:
+            pending.append((idx, query, prompt, dstats, job))
+            continue
+
+        with log.instance(**job) as rec:
             answer, code = None, None
             try:
                 with lx.stage("single_call"):
@@ -284,23 +322,58 @@ def main() -> int:
                 rec.fail(e)
                 rec.set(model_output=None, code_output=None)
 
-        s = log.records[-1].summary()
-        print(f"[{idx}] {log.records[-1].status:7s} "
-              f"in={s['prompt_tokens']:>7,} out={s['completion_tokens']:>6,} "
-              f"${s['cost_usd']:.4f} {s['wall_s']:>5.1f}s "
-              f"code={'yes' if code else 'NO'}"
-              f"{' TRUNCATED-DATA' if dstats['truncated'] else ''}")
+        report(idx, log.records[-1], code, dstats)
         rows_out.append({"instance_id": idx, "query": query,
                          "gold_type": cell(row, "gold_type"),
                          "model_output": answer, "code_output": code,
                          **{f"data_{k}": v for k, v in dstats.items()}})
 
+    if pending:
+        # Same prompt, same accounting, same failure handling as the loop
+        # above -- only the scheduling differs. Each worker returns what the
+        # sequential loop appends, and gather() keeps them in dataset order.
+        async def solve(rec, job):
+            idx, query, prompt, dstats, _ = by_id[job["instance_id"]]
+            answer, code = None, None
+            try:
+                with lx.stage("single_call"):
+                    resp = await lx.ainvoke_with_retry(
+                        llm.ainvoke, cfg, [HumanMessage(content=prompt)])
+                answer = resp.content
+                code = extract_code(answer)
+                rec.set(model_output=answer, code_output=code)
+            except Exception as e:                    # noqa: BLE001
+                print(f"[{idx}] failed: {type(e).__name__}: {e}")
+                rec.fail(e)
+                rec.set(model_output=None, code_output=None)
+            return rec, answer, code
+
+        by_id = {p[4]["instance_id"]: p for p in pending}
+        print(f"[run_baseline] {len(pending)} instances, "
+              f"{args.concurrency} in flight")
+        results = asyncio.run(lx.run_instances_async(
+            log, [p[4] for p in pending], solve,
+            concurrency=args.concurrency))
+        for (idx, query, _, dstats, job), res in zip(pending, results):
+            rec, answer, code = res or (None, None, None)
+            if rec is not None:
+                report(idx, rec, code, dstats)
+            rows_out.append({"instance_id": idx, "query": query,
+                             "gold_type": job["gold_type"],
+                             "model_output": answer, "code_output": code,
+                             **{f"data_{k}": v for k, v in dstats.items()}})
+
     if args.dry_run:
         df = pd.DataFrame(rows_out)
         print(f"\n{len(df)} instances | "
               f"prompt tokens: median {df['approx_prompt_tokens'].median():,.0f}, "
               f"max {df['approx_prompt_tokens'].max():,.0f} | "
               f"{int(df['truncated'].sum())} truncated")
+        kv = df["tokens_kv"].sum()
+        print("table formats (total prompt tokens): " + ", ".join(
+            f"{f} {df[f'tokens_{f}'].sum():,.0f}"
+            f" ({100 * (df[f'tokens_{f}'].sum() - kv) / max(kv, 1):+.1f}%)"
+            for f in lx.TABLE_FORMATS))
         print("no API calls made")
         return 0
 
@@ -26,7 +26,8 @@ HERE = Path(__file__).parent
 PROFILE_RE = re.compile(r"(model_profile\s*=\s*)(['\"])([^'\"]+)\2")
 
 # profiles that are interchangeable without changing anything else
-OPENAI_FAMILY = {"gpt-4.1", "gpt-5.2", "gemini-3-pro", "openrouter-gpt-4.1"}
+OPENAI_FAMILY = {"gpt-4.1", "gpt-5.2", "gemini-3-pro", "openrouter-gpt-4.1",
+                 "gpt-4.1-cascade"}
 
 
 def notebooks():
@@ -194,3 +194,1185 @@ assert r.returncode == 0
 print("\nfiles:", sorted(p.name for p in TABLES.iterdir()))
 print(pd.read_csv(TABLES / "classification.csv").to_string(index=False))
 print(pd.read_csv(TABLES / "stage_breakdown.csv").to_string(index=False))
+
+# --- async path: concurrent instances keep their own accounting ------------- #
+# Forty instances in flight on one loop, each LLM call suspended between its
+# start and end events so the calls of different instances interleave. Every
+# instance sends a prompt of its own length, so a call credited to the wrong
+# record shows up as a wrong prompt_tokens total.
+print("\n--- async attribution ---")
+import asyncio
+
+cfg_a = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                       method="ASYNC", dataset="Large-Scale-OR",
+                       out_dir=str(RUNS), log_prompts=False)
+log_a = lx.RunLogger(cfg_a)
+n_flaky = {"left": 2}
+
+
+async def fake_allm_call(pt):
+    rid = random.random()
+    lx.TRACKER.on_chat_model_start(
+        {"name": "ChatModel"}, [[SimpleNamespace(type="human", content="q")]],
+        run_id=rid, invocation_params={"model": "gpt-4.1-2025-04-14"})
+    await asyncio.sleep(random.random() / 100)
+    lx.TRACKER.on_llm_end(openai_style(pt, 10, "gpt-4.1-2025-04-14"), run_id=rid)
+
+
+async def worker(rec, job):
+    i = job["instance_id"]
+    with lx.stage("modeling"):
+        await fake_allm_call(1000 + i)
+    with lx.stage("codegen"):
+        await fake_allm_call(1000 + i)
+    if i == 7:
+        async def flaky():                   # fails twice, then succeeds
+            if n_flaky["left"]:
+                n_flaky["left"] -= 1
+                raise TimeoutError("transient")
+            return "ok"
+        cfg_a.retry_backoff_s = 0.0
+        assert await lx.ainvoke_with_retry(flaky, cfg_a) == "ok"
+    if i == 13:
+        raise ValueError("worker blew up")
+    return i
+
+
+out = asyncio.run(lx.run_instances_async(
+    log_a, [{"instance_id": i, "query": f"q{i}"} for i in range(40)], worker,
+    concurrency=16))
+log_a.close()
+assert out == [None if i == 13 else i for i in range(40)], out
+by_id = {r.instance_id: r for r in log_a.records}
+for i, r in by_id.items():
+    s = r.summary()
+    assert s["n_llm_calls"] == 2 and s["prompt_tokens"] == 2 * (1000 + i), (i, s)
+assert by_id[13].status == "failed" and by_id[0].status == "ok"
+assert by_id[7].n_retries == 2, by_id[7].errors
+print(f"  40 concurrent instances attributed correctly "
+      f"({sum(r.summary()['n_llm_calls'] for r in log_a.records)} calls)")
+
+# --- replay server: recorded answers behind an OpenAI-style API ----------- #
+print("\n--- replay server ---")
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import replay_server
+
+cfg_rp = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                        method="REPLAY", dataset="Large-Scale-OR",
+                        out_dir=str(RUNS), log_prompts=True,
+                        log_raw_responses=True)
+log_rp = lx.RunLogger(cfg_rp)
+with log_rp.instance(instance_id=0, query="q"):
+    with lx.stage("modeling"):
+        fake_llm_call(openai_style(250, 30, "gpt-4.1-2025-04-14"),
+                      "gpt-4.1-2025-04-14", n_prompt_chars=1000)
+log_rp.close()
+recs = replay_server.Recordings()
+recs.load(RUNS, run_filter="REPLAY__")
+assert recs.stats["records"] == 1 and len(recs) == 1, recs.stats
+srv_args = SimpleNamespace(verbose=False, latency="none", latency_scale=1.0,
+                           on_miss="error", stub_text="", embedding_dim=8)
+srv = ThreadingHTTPServer(("127.0.0.1", 0),                # a free port
+                          replay_server.make_handler(recs, srv_args))
+threading.Thread(target=srv.serve_forever, daemon=True).start()
+base = f"http://127.0.0.1:{srv.server_address[1]}/v1"
+
+
+def post(path, body):
+    req = urllib.request.Request(base + path, json.dumps(body).encode(),
+                                 {"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as r:
+            return r.status, json.loads(r.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+try:
+    st_hit, hit = post("/chat/completions", {
+        "model": "gpt-4.1", "messages": [{"role": "user", "content": "q" * 1000}]})
+    assert st_hit == 200, hit
+    assert hit["choices"][0]["message"]["content"] == "x" * 120
+    assert hit["usage"]["prompt_tokens"] == 250 and \
+        hit["model"] == "gpt-4.1-2025-04-14", hit
+    st_miss, miss = post("/chat/completions", {
+        "model": "gpt-4.1", "messages": [{"role": "user", "content": "new"}]})
+    assert st_miss == 404 and miss["error"]["code"] == "replay_miss", miss
+    st_emb, emb = post("/embeddings", {"model": "e", "input": ["a", "b"]})
+    assert st_emb == 200 and len(emb["data"]) == 2
+    assert len(emb["data"][0]["embedding"]) == 8
+    assert recs.stats["hits"] == 1 and recs.stats["misses"] == 1
+    assert recs.stats["embeddings"] == 2
+finally:
+    srv.shutdown()
+    srv.server_close()
+print(f"  chat hit, miss -> 404, 2 embeddings on port {srv.server_address[1]}")
+
+# --- shared clients: one model object per spec, one pool per event loop ---- #
+print("\n--- shared clients ---")
+try:
+    import os
+
+    import httpx
+
+    had_key = "OPENAI_API_KEY" in os.environ
+    os.environ.setdefault("OPENAI_API_KEY", "sk-smoke")   # never sent
+    lx.clear_clients()
+    cfg_h = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                           method="HTTP", dataset="Large-Scale-OR",
+                           out_dir=str(RUNS), log_prompts=False)
+    m1 = lx.build_llm(cfg_h, "modeler")
+    assert lx.build_llm(cfg_h, "modeler") is m1
+    assert lx.build_llm(cfg_h, "modeler", temperature=0.7) is not m1
+    cfg_h.models["modeler"].temperature = 0.3           # an edited spec
+    m2 = lx.build_llm(cfg_h, "modeler")
+    assert m2 is not m1 and lx.build_llm(cfg_h, "modeler") is m2
+    url = "https://api.openai.com/v1"
+    c_async = lx.http_client(cfg_h, url, asynchronous=True)
+    assert isinstance(c_async, httpx.AsyncClient)
+    assert lx.http_client(cfg_h, url, asynchronous=True) is c_async
+    cfg_h.http = {**cfg_h.http, "max_connections": 8}    # other limits
+    assert lx.http_client(cfg_h, url, asynchronous=True) is not c_async
+    lx.clear_clients()
+    assert not lx._MODEL_CACHE and not lx._HTTP_CLIENTS
+    assert lx.build_llm(cfg_h, "modeler") is not m2
+
+    # two asyncio.run() calls: the second must not reuse the first loop's pool
+    seen = []
+    per_loop = lx._per_loop_cls()(transport=httpx.MockTransport(
+        lambda req: httpx.Response(200, json={"ok": True})))
+
+    async def fetch():
+        r = await per_loop.get("http://replay.local/x")
+        seen.append(per_loop.for_loop(asyncio.get_running_loop()))
+        return r.json()
+
+    assert asyncio.run(fetch()) == {"ok": True}
+    assert asyncio.run(fetch()) == {"ok": True}
+    assert seen[0] is not seen[1] and len(per_loop._by_loop) == 1
+    lx.clear_clients()
+    if not had_key:
+        del os.environ["OPENAI_API_KEY"]
+    print("  model objects reused per spec; async pool per loop; clear resets")
+except ImportError as e:
+    print(f"  skipped (langchain_openai not installed here): {e}")
+
+# --- response cache: second identical call is replayed, not paid ------------ #
+print("\n--- response cache ---")
+try:
+    import tempfile
+    from langchain_core.language_models.fake_chat_models import \
+        GenericFakeChatModel
+    from langchain_core.messages import AIMessage
+
+    cfg_c = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                           method="CACHE", dataset="Large-Scale-OR",
+                           out_dir=str(RUNS), log_prompts=False)
+    cache_file = Path(tempfile.mkdtemp()) / "cache.sqlite"
+
+    def cached_model(mode):
+        reply = AIMessage(content="max 3x + 2y", usage_metadata={
+            "input_tokens": 500, "output_tokens": 50, "total_tokens": 550},
+            response_metadata={"model_name": "gpt-4.1-2025-04-14",
+                               "system_fingerprint": "fp_test"})
+        return GenericFakeChatModel(
+            messages=iter([reply]), callbacks=[lx.TRACKER],
+            cache=lx.ResponseCache(cache_file, cfg_c.spec("modeler"), mode))
+
+    log_c = lx.RunLogger(cfg_c)
+    for i, mode in enumerate(["read-write", "read-write", "read-only"]):
+        with log_c.instance(instance_id=i, query="q"):
+            with lx.stage("modeling"):
+                cached_model(mode).invoke("same prompt")
+    log_c.close()
+    paid, *replayed = [r.summary() for r in log_c.records]
+    assert paid["n_cache_hits"] == 0 and paid["cost_usd"] > 0, paid
+    for s_c in replayed:
+        assert s_c["n_cache_hits"] == 1 and s_c["cost_usd"] == 0, s_c
+        assert s_c["replayed_cost_usd"] == paid["cost_usd"], s_c
+        assert s_c["prompt_tokens"] == 500, s_c
+    print("  miss -> paid, hit -> replayed at $0 with stored usage")
+except ImportError as e:
+    print(f"  skipped (langchain not installed here): {e}")
+
+# --- kNN classification fast path ------------------------------------------- #
+# Toy embedding: one axis per class keyword, so the vote is decided by the
+# words in the query. Clear queries must skip the agent; a query that matches
+# two classes equally must reach it; both paths must be logged.
+print("\n--- knn classifier ---")
+
+
+class KeywordEmbeddings:
+    WORDS = ("flight", "shelf", "warehouse")
+
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+    def embed_query(self, text):
+        return [text.count(w) + 0.01 for w in self.WORDS]
+
+
+class CountingAgent:
+    n = 0
+
+    def invoke(self, x):
+        CountingAgent.n += 1
+        return {"output": "Resource Allocation"}
+
+
+from types import SimpleNamespace as _NS
+refdocs = [_NS(page_content=f"{w} {w}", metadata={"problem_type": lbl})
+           for w, lbl in [("flight", "Network Revenue Management"),
+                          ("shelf", "Resource Allocation"),
+                          ("warehouse", "Transportation Problem")] for _ in range(3)]
+cfg_k = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                       method="KNN", dataset="Large-Scale-OR", out_dir=str(RUNS))
+cfg_k.classification = {**cfg_k.classification,
+                        "knn": {**cfg_k.classification["knn"], "k": 6}}
+clf = lx.KnnClassifier(cfg_k, KeywordEmbeddings(), fallback=CountingAgent(),
+                       docs=refdocs)
+log_k = lx.RunLogger(cfg_k)
+cases = [("text:flight.csv demand", "Network Revenue Management", "knn"),
+         ("text:warehouse column costs", "Transportation", "knn"),
+         ("text:flight shelf data.csv", "Resource Allocation", "agent"),
+         ("text:no files at all", "Others without CSV", "rule")]
+for i, (q, want, path) in enumerate(cases):
+    with log_k.instance(instance_id=i, query=q, gold_type=want) as rec:
+        out = clf.invoke(q)
+        rec.set(pred_type=out["output"])
+        assert out["output"] == want and rec.extra["classification_path"] == path, \
+            (q, out, rec.extra)
+log_k.close()
+assert CountingAgent.n == 1, CountingAgent.n
+print("  confident votes skip the agent; ties fall back; paths logged")
+
+# --- batched classification: one call, cost split back per instance --------- #
+print("\n--- batch classifier ---")
+
+
+class FakeStructuredLLM:
+    """with_structured_output(schema).invoke(prompt) -> {"labels": [...]},
+    reporting one LLM call to the tracker like a real model would."""
+
+    def __init__(self):
+        self.n_calls = 0
+
+    def with_structured_output(self, schema):
+        llm = self
+
+        class Runnable:
+            def invoke(self, prompt):
+                llm.n_calls += 1
+                n = prompt.count("\n[")
+                rid = random.random()
+                lx.TRACKER.on_chat_model_start(
+                    {}, [[SimpleNamespace(type="human", content=prompt)]],
+                    run_id=rid, invocation_params={"model": "gpt-4.1-2025-04-14"})
+                lx.TRACKER.on_llm_end(openai_style(1001, 10 * n,
+                                                   "gpt-4.1-2025-04-14"),
+                                      run_id=rid)
+                # leave the last problem unanswered -> must go to fallback
+                return {"labels": [{"id": i, "label": "Transportation"}
+                                   for i in range(n - 1)]}
+        return Runnable()
+
+
+cfg_b = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                       method="BATCH", dataset="Large-Scale-OR", out_dir=str(RUNS))
+fake = FakeStructuredLLM()
+CountingAgent.n = 0
+bclf = lx.BatchClassifier(cfg_b, fake, fallback=CountingAgent())
+qs = [f"problem {i} with costs.csv" for i in range(7)]
+bclf.prepare(qs)
+assert fake.n_calls == 1, fake.n_calls
+log_b = lx.RunLogger(cfg_b)
+for i, q in enumerate(qs):
+    with log_b.instance(instance_id=i, query=q):
+        with lx.stage("classification"):
+            bclf.invoke(f"What is the problem type of the text? text:{q}")
+agg_b = log_b.close()
+assert agg_b["total_n_llm_calls"] == 1 and \
+    isinstance(agg_b["total_n_llm_calls"], int), agg_b    # 7 x 1/7, exactly
+paid = bclf.calls[0]
+shares = [r.summary()["by_stage"]["classification"] for r in log_b.records]
+assert sum(s_b["prompt_tokens"] for s_b in shares) == paid["prompt_tokens"]
+assert sum(s_b["completion_tokens"] for s_b in shares) == paid["completion_tokens"]
+assert abs(sum(s_b["cost_usd"] for s_b in shares) - paid["cost_usd"]) < 1e-12
+assert CountingAgent.n == 1 and \
+    log_b.records[-1].extra["classification_path"] == "agent"
+print(f"  7 queries, 1 call: {paid['prompt_tokens']} prompt tokens split "
+      f"{[s_b['prompt_tokens'] for s_b in shares]}")
+
+# a duplicated query is sent once, answered for every instance and billed
+# one share per occurrence; mode "batch" builds the same classifier
+cfg_b.classification = {**cfg_b.classification, "mode": "batch"}
+fake = FakeStructuredLLM()
+CountingAgent.n = 0
+bclf = lx.build_classifier(cfg_b, CountingAgent(), llm=fake)
+assert isinstance(bclf, lx.BatchClassifier)
+qs = ["dup problem with costs.csv", "other problem with costs.csv",
+      "dup problem with costs.csv", "dup problem with costs.csv", "last"]
+bclf.prepare(qs)
+assert fake.n_calls == 1 and bclf.calls[0]["size"] == 3, bclf.calls
+log_b = lx.RunLogger(cfg_b)
+for i, q in enumerate(qs):
+    with log_b.instance(instance_id=i, query=q):
+        with lx.stage("classification"):
+            bclf.invoke(q)
+agg_b = log_b.close()
+assert agg_b["total_n_llm_calls"] == 1, agg_b          # one request sent
+paid = bclf.calls[0]
+shares = [r.summary()["by_stage"]["classification"] for r in log_b.records]
+assert sum(s_b["prompt_tokens"] for s_b in shares) == paid["prompt_tokens"]
+assert abs(sum(s_b["cost_usd"] for s_b in shares) - paid["cost_usd"]) < 1e-12
+assert all(log_b.records[i].extra["classification_path"] == "batch"
+           for i in (0, 2, 3)) and CountingAgent.n == 1
+assert shares[2]["prompt_tokens"] > 0 and shares[3]["prompt_tokens"] > 0
+print(f"  duplicates: 5 instances, 3 distinct queries, shares "
+      f"{[s_b['prompt_tokens'] for s_b in shares]}")
+
+
+# a chunk whose call fails costs nothing extra to lose: its queries go to
+# the agent instead of failing prepare()
+class FailingStructuredLLM:
+    def with_structured_output(self, schema):
+        return SimpleNamespace(invoke=lambda prompt: (_ for _ in ()).throw(
+            ValueError("schema rejected")))
+
+
+cfg_b.retry_backoff_s = 0.0
+CountingAgent.n = 0
+bclf = lx.BatchClassifier(cfg_b, FailingStructuredLLM(),
+                          fallback=CountingAgent())
+assert bclf.prepare(["a.csv problem", "b.csv problem"]) == {
+    "a.csv problem": None, "b.csv problem": None}
+assert bclf.calls[0]["error"].startswith("ValueError")
+log_b = lx.RunLogger(cfg_b)
+with log_b.instance(instance_id=0, query="a.csv problem") as rec_f:
+    bclf.invoke("a.csv problem")
+agg_b = log_b.close()
+assert CountingAgent.n == 1 and rec_f.extra["classification_path"] == "agent"
+assert agg_b["total_n_llm_calls"] == 0, agg_b           # nothing was sent
+
+
+# --- prompt layout: per-instance parts last, prefix-cache hits reported ----- #
+print("\n--- prompt layout + prompt-cache reporting ---")
+parts = [("static", "RULES "), ("instance", "MODEL "), ("exemplars", "EXAMPLE ")]
+cfg_p = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                       method="LAYOUT", dataset="Large-Scale-OR",
+                       out_dir=str(RUNS), log_prompts=False)
+assert cfg_p.prompt_layout == "original"
+assert lx.assemble_prompt(cfg_p, parts) == "RULES MODEL EXAMPLE "
+ak = lx.agent_kwargs(cfg_p, [("static", "A "), ("instance", "FEW "),
+                             ("static", "B ")], "Begin! {input}")["agent_kwargs"]
+assert ak == {"prefix": "A FEW B ", "suffix": "Begin! {input}"}, ak
+cfg_p.prompt_layout = "cache_friendly"
+assert lx.assemble_prompt(cfg_p, parts) == "RULES EXAMPLE MODEL "
+ak = lx.agent_kwargs(cfg_p, [("static", "A "), ("instance", "FEW "),
+                             ("static", "B ")], "Begin! {input}")["agent_kwargs"]
+assert ak == {"prefix": "A B ", "suffix": "FEW Begin! {input}"}, ak
+
+import aggregate_runs
+log_p = lx.RunLogger(cfg_p)
+for i in range(3):
+    with log_p.instance(instance_id=i, query=f"q{i}"):
+        with lx.stage("modeling"):
+            # the first instance warms the provider cache, the others hit it
+            fake_llm_call(openai_style(4000, 100, "gpt-4.1-2025-04-14",
+                                       cached=3072 if i else 0),
+                          "gpt-4.1-2025-04-14")
+log_p.close()
+sb = aggregate_runs.stage_breakdown(
+    aggregate_runs.load_instances(RUNS / cfg_p.run_id))
+row = sb[sb["stage"] == "modeling"].iloc[0]
+assert abs(row["cache_hit_%"] - 100 * 6144 / 12000) < 0.01, row
+# 6144 cached tokens at $2.00 -> $0.50 per 1M
+saved = 6144 / 1e6 * 1.5 / 3
+assert abs(row["cost_no_cache_usd_mean"] - row["cost_usd_mean"] - saved) < 1e-4
+print(f"  cache hit {row['cache_hit_%']:.1f}%, saving {row['cache_saving_%']:.1f}%")
+
+
+# --- table formats: header once, one retriever call ------------------------- #
+print("\n--- table serialisation ---")
+tbl = pd.DataFrame({"Product": ["A", "B, large"], "Revenue": [10, 20],
+                    "Demand": [1.5, 2.0]})
+assert lx.serialize_table(tbl, "kv").splitlines()[1] == \
+    "Product = B, large, Revenue = 20, Demand = 2.0"
+# all-numeric rows come out of iterrows as floats; kv keeps that
+assert lx.serialize_table(tbl[["Revenue", "Demand"]], "kv").startswith(
+    "Revenue = 10.0,")
+assert lx.serialize_table(tbl, "csv").splitlines()[0] == "Product,Revenue,Demand"
+rep = {r["format"]: r for r in lx.table_format_report(tbl)}
+assert rep["csv"]["tokens"] < rep["kv"]["tokens"], rep
+try:
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from langchain_community.vectorstores import FAISS
+
+    cfg_t = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                           method="TABLE", dataset="Large-Scale-OR",
+                           out_dir=str(RUNS), log_prompts=False)
+    cfg_t.retrievers["data_nrm"]["table_format"] = "csv"
+    store = FAISS.from_documents(
+        lx.table_documents(tbl, "products.csv") + [Document(page_content="note")],
+        DeterministicFakeEmbedding(size=16))
+    log_t = lx.RunLogger(cfg_t)
+    with log_t.instance(instance_id=0, query="q"):
+        with lx.stage("data_retrieval"):
+            got = lx.build_retriever(cfg_t, store, "data_nrm").invoke("revenue")
+    log_t.close()
+    tables = [d for d in got if d.metadata.get("table_format") == "csv"]
+    assert len(got) == 2 and len(tables) == 1, got
+    assert tables[0].page_content.count("Product,Revenue,Demand") == 1
+    assert log_t.records[-1].summary()["n_retriever_calls"] == 1
+    print(f"  csv rows {rep['csv']['tokens']} tokens vs kv {rep['kv']['tokens']}")
+except ImportError as e:
+    print(f"  skipped (langchain/faiss not installed here): {e}")
+
+
+# --- column-wise row text == the notebooks' iterrows loops ------------------ #
+print("\n--- vectorised row serialisation ---")
+frames = [tbl, tbl[["Revenue", "Demand"]],
+          pd.DataFrame({"id": [1, 2, 3], "x": [None, 0.1, 1e16],
+                        "s": ["a", None, " b "]}),
+          pd.DataFrame({"a": []})]
+for f in frames:
+    want = [", ".join([f"{col} = {r[col]}" for col in f.columns])
+            for _, r in f.iterrows()]
+    assert lx.table_rows(f) == want, (lx.table_rows(f), want)
+    assert [d.page_content for d in lx.table_documents(f)] == want
+f = frames[2]
+want = ["\n".join(f"{c}: {str(r[c]).strip()}" for c in ["s", "x"]
+                  if not pd.isna(r[c]) and str(r[c]).strip() not in ("", "nan"))
+        for _, r in f.iterrows()]
+assert lx.table_rows(f, sep=": ", joiner="\n", columns=["s", "x"],
+                     skip_empty=True) == want
+print("  table_rows matches iterrows on", len(frames), "frames")
+
+
+# --- read-only SQL tool over the instance's CSVs ----------------------------- #
+print("\n--- SQL tool ---")
+sql_dir = RUNS / "sql_data"
+sql_dir.mkdir(parents=True, exist_ok=True)
+# three rows, so max_rows=2 below really truncates
+pd.concat([tbl, pd.DataFrame({"Product": ["C"], "Revenue": [30],
+                              "Demand": [2.5]})]).to_csv(
+    sql_dir / "Products.csv", index=False)
+pd.DataFrame({"Shelf": [1, 2], "Capacity": [30, 45]}).to_csv(
+    sql_dir / "2-capacity.csv", index=False)
+address = f"{sql_dir / 'Products.csv'}\n{sql_dir / '2-capacity.csv'}\n"
+cfg_s = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                       method="SQL", dataset="Large-Scale-OR",
+                       out_dir=str(RUNS), log_prompts=False)
+assert lx.data_tools(cfg_s, address) == []          # off by default
+sql = lx.SqlTool(cfg_s, address, max_rows=2)
+assert list(sql.tables) == ["products", "t_2_capacity"], sql.tables
+assert lx._sql_text('```sql\nSELECT 1;\n```') == "SELECT 1"
+assert lx._sql_text('"SELECT 1"') == "SELECT 1"
+try:
+    import duckdb  # noqa: F401
+
+    log_s = lx.RunLogger(cfg_s)
+    with log_s.instance(instance_id=0, query="q"):
+        with lx.stage("data_retrieval"):
+            total = sql.run("SELECT sum(Capacity) AS total FROM t_2_capacity")
+            every = sql.run("SELECT * FROM products")
+            bad = sql.run("DROP VIEW products")
+            escape = sql.run("SELECT * FROM read_csv_auto('/etc/passwd')")
+            named = sql.run("SELECT Revenue FROM products "
+                            "WHERE Product = 'x.csv'")
+    log_s.close()
+    sql.close()
+    assert total.splitlines() == ["total", "75"], total
+    assert "truncated" in every and every.count("\n") == 3, every
+    assert bad.startswith("SQL error: only a single SELECT"), bad
+    assert escape.startswith("SQL error"), escape   # the engine refuses it
+    assert sql.sandboxed and named.endswith("[no rows]"), named
+    s = log_s.records[-1].summary()
+    assert s["n_sql_queries"] == 5 and s["n_sql_queries_failed"] == 2, s
+    assert s["n_sql_truncated"] == 1 and s["sql_rows_returned"] == 3, s
+    assert s["by_stage"]["data_retrieval"]["sql_queries"] == 5
+    print("  schema:", lx.SqlTool(cfg_s, address).schema().splitlines()[0])
+except ImportError as e:
+    print(f"  skipped (duckdb not installed here): {e}")
+
+# the file-access guard holds without the engine's lockdown (and without
+# duckdb at all): it runs before the query reaches the connection
+sql = lx.SqlTool(cfg_s, address)                     # never connected
+assert sql.sandboxed is None
+for q in ["SELECT * FROM read_csv_auto('/etc/passwd')",
+          "SELECT * FROM '/etc/passwd'", 'SELECT * FROM "../x/costs.csv"',
+          "SELECT * FROM glob ('*')", "SELECT * FROM 'https://x.org/a.csv'"]:
+    assert sql._refuse(None, q) is not None, q
+assert sql._refuse(None, "SELECT * FROM products p, '/etc/passwd'")
+for q in ["SELECT \"Cost/unit\" FROM products WHERE name = 'a/b'",
+          "SELECT * FROM products WHERE Product = 'x.csv'",
+          "SELECT * FROM products WHERE Product LIKE '/%'"]:
+    assert sql._refuse(None, q) is None, q          # data filters, not reads
+
+
+class FakeCon:
+    closed = False
+
+    def close(self):
+        FakeCon.closed = True
+
+
+# data_tools' SqlTool is closed when its instance settles
+log_s = lx.RunLogger(cfg_s)
+with log_s.instance(instance_id=1, query="q"):
+    owned = lx.SqlTool(cfg_s, address)
+    owned._con = FakeCon()
+    lx.SQL_TOOLS.own(owned)
+log_s.close()
+assert FakeCon.closed and owned._con is None
+print("  table functions and file paths refused; connection closed at settle")
+
+
+# --- BM25 row retrieval: no embedding calls, latency logged per retriever --- #
+print("\n--- BM25 retrieval ---")
+rows_bm = lx.table_rows(pd.DataFrame({
+    "Product Name": ["Sony Bravia XR", "Apple iPad", "Sony Alpha 7", "Dell XPS"],
+    "Revenue": [900, 500, 1200, 800]}))
+ix = lx.BM25Index.from_texts(rows_bm)
+assert [rows_bm[i] for i in ix.ranked("sony products", 2)] == [rows_bm[0], rows_bm[2]]
+assert ix.ranked("sony", 10) == [0, 2, 1, 3]        # ties keep file order
+assert ix.ranked("nothing matches", 2) == [0, 1]
+try:
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    cfg_b = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                           method="BM25", dataset="Large-Scale-OR",
+                           out_dir=str(RUNS), log_prompts=False)
+    cfg_b.retrievers["data_nrm"]["search"] = "bm25"
+    cfg_b.retrievers["data_ra"] = {"k": 2, "search": "hybrid"}
+    emb = lx.CountingEmbeddings(DeterministicFakeEmbedding(size=16), cfg_b, 0.02)
+    log_b = lx.RunLogger(cfg_b)
+    with log_b.instance(instance_id=0, query="q"):
+        with lx.stage("data_retrieval"):
+            store = lx.build_store(cfg_b, "data_nrm", rows_bm, emb)
+            assert isinstance(store, lx.LexicalStore)
+            got = lx.build_retriever(cfg_b, store, "data_nrm").invoke("Apple")
+            hyb = lx.build_retriever(
+                cfg_b, lx.build_store(cfg_b, "data_ra", rows_bm, emb),
+                "data_ra").invoke("Sony Alpha")
+    log_b.close()
+    assert got[0].page_content == rows_bm[1] and len(got) == 4
+    assert len(hyb) == 2 and hyb[0].page_content == rows_bm[2], hyb
+    rec = log_b.records[-1]
+    s = rec.summary()
+    assert s["n_embedding_calls"] == 2, s      # hybrid only: rows + query
+    retr = [c for c in rec.calls if c["type"] == "retriever"]
+    assert [(c["retriever"], c["search"]) for c in retr] == [
+        ("data_nrm", "bm25"), ("data_ra", "hybrid")], retr
+    assert s["by_stage"]["data_retrieval"]["retriever_latency_s"] > 0
+    print(f"  bm25 build {ix.build_s * 1e3:.2f} ms, {ix.nbytes} bytes")
+except ImportError as e:
+    print(f"  skipped (langchain not installed here): {e}")
+
+
+# --- query embeddings prefetched in one call, billed per instance ---------- #
+print("\n--- query embedding prefetch ---")
+try:
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from langchain_community.vectorstores import FAISS
+
+    class _CountCalls(DeterministicFakeEmbedding):
+        n_doc_calls: int = 0
+        n_query_calls: int = 0
+
+        def embed_documents(self, texts):
+            self.n_doc_calls += 1
+            return super().embed_documents(texts)
+
+        def embed_query(self, text):
+            self.n_query_calls += 1
+            return super().embed_query(text)
+
+    cfg_e = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                           method="PREFETCH", dataset="Large-Scale-OR",
+                           out_dir=str(RUNS), log_prompts=False)
+    inner = _CountCalls(size=16)
+    emb = lx.CountingEmbeddings(inner, cfg_e, 0.02)
+    store = FAISS.from_texts(["alpha row", "beta row", "gamma row"], emb)
+    queries = pd.Series(["find alpha", "find beta", "find alpha", None])
+    assert lx.prefetch_queries(cfg_e, emb, queries) == 2
+    assert inner.n_doc_calls == 2                  # store + one prefetch
+    log_e = lx.RunLogger(cfg_e)
+    for i, q in enumerate(["find alpha", "find beta"]):
+        with log_e.instance(instance_id=i, query=q):
+            with lx.stage("modeling"):
+                hit = lx.build_retriever(cfg_e, store, "examples_nrm").invoke(q)
+                again = store.similarity_search_by_vector(emb.vector(q), k=1)
+            assert hit[0].page_content == again[0].page_content
+    log_e.close()
+    assert inner.n_query_calls == 0, inner.n_query_calls
+    s0 = log_e.records[0].summary()
+    assert s0["n_embedding_calls"] == 0.5, s0            # 1 of a batch of 2
+    assert s0["embedding_tokens"] == lx._estimate_tokens("find alpha")
+    assert lx.prefetch_queries(cfg_e, emb, queries) == 0  # cached for the run
+    print("  2 queries, 1 embed_documents call, 0 embed_query calls")
+except ImportError as e:
+    print(f"  skipped (langchain/faiss not installed here): {e}")
+
+
+# --- FAISS index factory: HNSW / IVF per retriever, build + search logged --- #
+print("\n--- FAISS index factory ---")
+try:
+    import faiss  # noqa: F401
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    cfg_f = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                           method="INDEX", dataset="Large-Scale-OR",
+                           out_dir=str(RUNS), log_prompts=False)
+    cfg_f.retrievers["data_nrm"] = {"k": 3, "index": "HNSW16",
+                                    "normalize": True, "ef_search": 32}
+    cfg_f.retrievers["data_ra"] = {"k": 3, "index": "IVF64,Flat", "nprobe": 4}
+    rows_f = [f"Product Name = item {i}, Revenue = {i}" for i in range(40)]
+    fake = DeterministicFakeEmbedding(size=32)
+    log_f = lx.RunLogger(cfg_f)
+    with log_f.instance(instance_id=0, query="q"):
+        with lx.stage("data_retrieval"):
+            hnsw = lx.build_store(cfg_f, "data_nrm", rows_f, fake)
+            top = lx.build_retriever(cfg_f, hnsw, "data_nrm").invoke(rows_f[7])
+            ivf = lx.build_store(cfg_f, "data_ra", rows_f, fake)
+            lx.build_retriever(cfg_f, ivf, "data_ra").invoke(rows_f[3])
+    log_f.close()
+    assert top[0].page_content == rows_f[7]       # exact match ranks first
+    rec = log_f.records[-1]
+    built = [c for c in rec.calls if c["type"] == "index"]
+    assert [c["index"] for c in built] == ["HNSW16", "Flat"], built
+    assert "index_fallback" in built[1]           # 40 vectors < 64 lists
+    retr = [c for c in rec.calls if c["type"] == "retriever"]
+    assert [c["index"] for c in retr] == ["HNSW16", "Flat"], retr
+    assert [c["search"] for c in retr] == ["dense", "dense"], retr
+    assert rec.summary()["index_build_s"] >= 0
+    print(f"  HNSW16 build {built[0]['latency_s'] * 1e3:.1f} ms, "
+          f"search {retr[0]['latency_s'] * 1e3:.1f} ms")
+except ImportError as e:
+    print(f"  skipped (faiss/langchain not installed here): {e}")
+
+
+# --- index registry: pinned stores reused, per-instance stores freed -------- #
+print("\n--- index registry ---")
+try:
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    cfg_r = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                           method="REGISTRY", dataset="Large-Scale-OR",
+                           out_dir=str(RUNS), log_prompts=False)
+    lx.INDEXES.clear()
+    emb = lx.CountingEmbeddings(DeterministicFakeEmbedding(size=16), cfg_r, 0.02)
+    exemplars = ["example one", "example two"]
+    log_r = lx.RunLogger(cfg_r)
+    stores = []
+    for i in range(2):
+        with log_r.instance(instance_id=i, query="q"):
+            with lx.stage("modeling"):
+                ex = lx.build_store(cfg_r, "examples_nrm", exemplars, emb)
+                data = lx.build_store(cfg_r, "data_nrm", [f"row {i}", "row x"], emb)
+                assert data.index.ntotal == 2
+                stores.append((ex, data))
+    log_r.close()
+    assert stores[0][0] is stores[1][0]                  # pinned: built once
+    assert all(d.index.ntotal == 0 for _, d in stores)   # freed at exit
+    r0, r1 = log_r.records
+    assert r0.summary()["n_embedding_calls"] == 2         # exemplars + data
+    assert r1.summary()["n_embedding_calls"] == 1         # data only
+    hits = [c for c in r1.calls if c["type"] == "index" and c.get("cache_hit")]
+    assert [c["retriever"] for c in hits] == ["examples_nrm"], hits
+    assert [c["index"] for c in hits] == ["Flat"], hits
+    assert r0.extra["index_bytes_freed"] > 0
+    # LRU: unpinned shared stores beyond max_bytes drop out, oldest first
+    cfg_r.index_registry["max_bytes"] = 1
+    a = lx.build_store(cfg_r, "air_flight", ["a"], emb)
+    lx.build_store(cfg_r, "air_demand", ["b"], emb)
+    assert lx.build_store(cfg_r, "air_flight", ["a"], emb) is not a
+    assert lx.INDEXES.n_evicted >= 1
+    # same name and content under another config or embedding model: rebuilt
+    small = lx.build_store(cfg_r, "examples_nrm", exemplars,
+                           DeterministicFakeEmbedding(size=8))
+    assert lx.build_store(cfg_r, "examples_nrm", exemplars,
+                          DeterministicFakeEmbedding(size=8)) is small
+    wide = lx.build_store(cfg_r, "examples_nrm", exemplars,
+                          DeterministicFakeEmbedding(size=32))
+    assert wide is not small and wide.index.d == 32
+    cfg_r.retrievers["examples_nrm"] = {
+        **cfg_r.retrievers.get("examples_nrm", {}), "search": "bm25"}
+    lexical = lx.build_store(cfg_r, "examples_nrm", exemplars,
+                             DeterministicFakeEmbedding(size=32))
+    assert isinstance(lexical, lx.LexicalStore), type(lexical)
+    lx.INDEXES.clear()
+    print(f"  index bytes {r1.extra['index_bytes']}, "
+          f"freed {r1.extra['index_bytes_freed']}")
+except ImportError as e:
+    print(f"  skipped (langchain/faiss not installed here): {e}")
+
+
+# --- process telemetry per instance ----------------------------------------- #
+print("\n--- process telemetry ---")
+import gc
+import time
+
+cfg_t = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                       method="TELEMETRY", dataset="Large-Scale-OR",
+                       out_dir=str(RUNS), log_prompts=False)
+cfg_t.telemetry["interval_s"] = 0.01
+log_t = lx.RunLogger(cfg_t)
+with log_t.instance(instance_id=0, query="q"):
+    # one block above the mmap threshold, so freeing it really unmaps it; a
+    # list of 1 MB chunks may stay in the allocator and keep RSS up
+    blob = b"x" * (48 * 2**20)                        # ~48 MB touched
+    sum(i * i for i in range(300_000))                # some CPU
+    gc.collect()
+    # sample while it lives instead of hoping the thread's 10 ms tick lands
+    # inside this window on a loaded machine
+    lx.RESOURCES._sample()
+    (open_t,) = lx.RESOURCES._open.values()
+    if open_t["t0"].get("rss"):
+        assert open_t["rss_peak"] >= open_t["t0"]["rss"] + 40 * 2**20, open_t
+    del blob
+log_t.close()
+st = json.loads((log_t.dir_path / "instances.jsonl").read_text().splitlines()[-1])["summary"]
+for k in ("cpu_user_s", "cpu_sys_s", "rss_peak_mb", "rss_end_mb",
+          "gc_collections", "gc_pause_s", "threads_max", "disk_read_mb"):
+    assert k in st, k
+assert st["cpu_user_s"] > 0 and st["gc_collections"] >= 1
+try:
+    import psutil  # noqa: F401
+    assert st["rss_peak_mb"] >= st["rss_end_mb"] + 30, st
+    assert st["threads_max"] >= 2                     # main + sampler
+except ImportError:
+    assert st["rss_peak_mb"] is None
+print(f"  cpu {st['cpu_user_s']}s user, rss peak {st['rss_peak_mb']} MB / "
+      f"end {st['rss_end_mb']} MB, gc {st['gc_collections']}x "
+      f"{st['gc_pause_s'] * 1e3:.1f} ms, threads {st['threads_max']}")
+
+
+# --- timeline export: nested spans as Chrome trace JSON --------------------- #
+print("\n--- timeline export ---")
+try:
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from langchain_core.language_models.fake_chat_models import \
+        GenericFakeChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.runnables import RunnableLambda
+    from langchain_core.tools import Tool
+
+    cfg_x = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                           method="TRACE", dataset="Large-Scale-OR",
+                           out_dir=str(RUNS), log_prompts=False)
+    lx.INDEXES.clear()
+    log_x = lx.RunLogger(cfg_x)
+    with log_x.instance(instance_id=3, query="q"):
+        with lx.stage("data_retrieval"):
+            store = lx.build_store(cfg_x, "data_nrm", ["row a", "row b"],
+                                   DeterministicFakeEmbedding(size=8))
+            retriever = lx.build_retriever(cfg_x, store, "data_nrm")
+            llm = GenericFakeChatModel(messages=iter([AIMessage(content="ok")]),
+                                       callbacks=[lx.TRACKER])
+
+            def lookup(q):
+                docs = retriever.invoke(q)
+                return llm.invoke(f"{q}: {docs[0].page_content}").content
+
+            qa = Tool(name="CSVQA", func=lookup, description="rows")
+            agent = RunnableLambda(lambda q: qa.invoke(q), name="AgentExecutor")
+            agent.invoke("row a")
+    log_x.close()
+    tr = json.loads((log_x.dir_path / "trace.json").read_text())
+    spans = [e for e in tr["traceEvents"] if e["ph"] == "X"]
+    by = {e["cat"]: e for e in spans}
+    for outer, inner in [("instance", "stage"), ("stage", "chain"),
+                         ("chain", "tool"), ("tool", "retriever"),
+                         ("tool", "llm")]:
+        o, i = by[outer], by[inner]
+        assert o["tid"] == i["tid"], (outer, inner)
+        assert o["ts"] <= i["ts"] + 1 and \
+            i["ts"] + i["dur"] <= o["ts"] + o["dur"] + 1, (outer, inner)
+    assert by["tool"]["args"]["parent_id"] == by["chain"]["args"]["span_id"]
+    assert by["chain"]["name"] == "AgentExecutor"
+    one = lx.export_trace(log_x.records[0], RUNS / "trace_3.json")
+    assert len(json.loads(one.read_text())["traceEvents"]) == len(tr["traceEvents"])
+    print(f"  {len(spans)} spans: " + ", ".join(sorted(by)))
+except ImportError as e:
+    print(f"  skipped (langchain not installed here): {e}")
+
+
+# --- latency table: percentiles, TTFT, throughput, instances per hour ------- #
+print("\n--- latency table ---")
+calls_l = pd.DataFrame([
+    {"run_id": "r", "dataset": "D", "method": "M", "model_profile": "p",
+     "instance_id": i % 4, "type": "llm", "stage": "modeling",
+     "model": "gpt-4.1", "provider": "openai", "latency_s": float(i + 1),
+     "ttft_s": 0.5, "completion_tokens": 100, "ok": True}
+    for i in range(100)
+] + [{"run_id": "r", "dataset": "D", "method": "M", "model_profile": "p",
+      "instance_id": 0, "type": "llm", "stage": "modeling", "model": "gpt-4.1",
+      "provider": "openai", "latency_s": 0.01, "ok": True, "cache_hit": True},
+     {"run_id": "r", "dataset": "D", "method": "M", "model_profile": "p",
+      "instance_id": 0, "type": "tool", "stage": "modeling",
+      "tool_name": "CSVQA", "latency_s": 2.0, "ok": False}],
+    columns=aggregate_runs.CALL_COLS)
+inst_l = pd.DataFrame({"run_id": "r", "dataset": "D", "method": "M",
+                       "model_profile": "p", "instance_id": range(4),
+                       "started_unix": [0.0, 0.0, 1800.0, 1800.0],
+                       "wall_s": [1800.0] * 4})
+lt = aggregate_runs.latency_table(calls_l, inst_l).set_index("type")
+llm_row, tool_row, inst_row = lt.loc["llm"], lt.loc["tool"], lt.loc["instance"]
+assert llm_row["n_calls"] == 100                      # the cache hit is left out
+assert abs(llm_row["latency_s_p50"] - 50.5) < 1e-6
+assert abs(llm_row["latency_s_p99"] - 99.01) < 1e-6
+assert llm_row["ttft_s_p90"] == 0.5
+assert abs(llm_row["tokens_per_s_p50"] - 100 / 50) < 1e-3
+assert tool_row["model"] == "CSVQA" and tool_row["n_failed"] == 1
+assert abs(inst_row["instances_per_hour"] - 4.0) < 1e-9   # 4 in one hour
+assert inst_row["n_instances"] == 4 and pd.isna(inst_row["n_calls"])
+print(f"  llm p50/p90/p99 {llm_row['latency_s_p50']}/{llm_row['latency_s_p90']}"
+      f"/{llm_row['latency_s_p99']} s, {inst_row['instances_per_hour']} inst/h")
+
+
+# --- live monitor: offset tailing, rolling rates, ETA ---------------------- #
+print("\n--- live monitor ---")
+import monitor_runs
+mon_dir = RUNS / "MONITOR"
+mon_dir.mkdir(parents=True, exist_ok=True)
+(mon_dir / "config.json").write_text(json.dumps(
+    {"manifest": {"dataset": {"rows": 10}}}))
+
+
+def _append(name, rows, partial=""):
+    with (mon_dir / name).open("a") as f:
+        f.write("".join(json.dumps(r) + "\n" for r in rows) + partial)
+
+
+t_base = 1_000_000.0
+_append("instances.jsonl", [
+    {"instance_id": i, "status": "ok" if i else "error",
+     "started_unix": t_base + 60 * i, "summary": {"wall_s": 60.0}}
+    for i in range(4)])
+_append("calls.jsonl", [
+    {"instance_id": i, "type": "llm", "stage": "modeling", "t_rel_s": 10.0,
+     "latency_s": 1.0 + i, "total_tokens": 1000, "cost_usd": 0.01, "ok": True}
+    for i in range(4)],
+    partial='{"instance_id": 3, "type": "tool"')    # line still being written
+mon = monitor_runs.Monitor(mon_dir, window_s=600)
+assert mon.total == 10
+assert mon.poll(now=t_base + 240) == 8              # the partial line waits
+snap = mon.snapshot(now=t_base + 240)
+assert snap["done"] == 4 and snap["failed"] == 1 and mon.n_calls == 4
+assert abs(snap["calls_per_min"] - 1.0) < 1e-9      # 4 calls in 4 minutes
+assert abs(snap["tokens_per_min"] - 1000.0) < 1e-9
+assert snap["p95_latency_s"]["modeling"] == 4.0
+assert abs(snap["eta_s"] - 6 * 60.0) < 1e-6         # 6 left at 1 per minute
+stalled = mon.snapshot(now=t_base + 480)            # nothing new for 4 min
+assert abs(stalled["eta_s"] - 6 * 120.0) < 1e-6     # the pace so far halves
+offset = mon._calls.offset
+_append("calls.jsonl", [], partial=', "stage": "data_retrieval", "ok": false, '
+                                   '"latency_s": 9.0}\n')
+assert mon.poll(now=t_base + 240) == 1
+assert mon._calls.offset - offset < 100             # only the new bytes read
+snap = mon.snapshot(now=t_base + 240)
+assert snap["p95_latency_s"]["data_retrieval"] == 9.0
+assert abs(snap["call_failure_%"] - 20.0) < 1e-9
+# an instance that started long before but was flushed last: its call
+# lands in time order, i.e. before the window, and is not counted
+_append("instances.jsonl", [{"instance_id": 9, "status": "ok",
+                             "started_unix": t_base - 500,
+                             "summary": {"wall_s": 30.0}}])
+_append("calls.jsonl", [{"instance_id": 9, "type": "llm", "stage": "modeling",
+                         "t_rel_s": 10.0, "latency_s": 50.0, "ok": True}])
+assert mon.poll(now=t_base + 240) == 2
+assert mon.snapshot(now=t_base + 240)["p95_latency_s"]["modeling"] == 4.0
+assert len(mon.window) == 5
+assert mon.poll(now=t_base + 240 + 3600) == 0 and not mon.window
+print("  " + monitor_runs.render(snap, 600).replace("\n", "\n  "))
+
+
+# --- run forecast: history bootstrap, input-size slope, makespan ----------- #
+print("\n--- run forecast ---")
+import numpy as np
+import pandas as pd
+import forecast_run
+
+cfg_f = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                       method="FORECAST", dataset="Large-Scale-OR",
+                       out_dir=str(RUNS), log_prompts=False)
+spec_f = cfg_f.models["modeler"]
+hist_rows, call_rows = [], []
+for i in range(20):
+    x = 1000.0 * (i + 1)
+    n = 2 if i % 2 == 0 else 4                       # milp needs more calls
+    prompt = n * (500 + 0.5 * x)                     # grows with the input
+    completion = 0.1 * prompt
+    hist_rows.append({
+        "run_id": "h", "instance_id": i, "dataset": "Large-Scale-OR",
+        "pred_type": "LP" if i % 2 == 0 else "MILP", "input_tokens": x,
+        "cost_usd": 0.0, "wall_s": 10.0 + completion / 100.0,
+        "stage::modeling::calls": n, "stage::modeling::prompt_tokens": prompt,
+        "stage::modeling::completion_tokens": completion,
+        "stage::modeling::cached_prompt_tokens": 0})
+    call_rows.append({"run_id": "h", "instance_id": i, "type": "llm",
+                      "stage": "modeling", "model": spec_f.model,
+                      "latency_s": completion / 100.0,
+                      "completion_tokens": completion})
+hist_f = pd.DataFrame(hist_rows)
+calls_f = pd.DataFrame(call_rows, columns=aggregate_runs.CALL_COLS)
+targets_f = pd.DataFrame({"instance_id": range(10), "input_tokens": 5000.0,
+                          "type": "lp"})
+fc = forecast_run.forecast(cfg_f, targets_f, hist_f, calls_f, concurrency=2,
+                           n_sims=200)
+want = 10 * (6000 * spec_f.price_in_per_1m + 600 * spec_f.price_out_per_1m) / 1e6
+assert abs(fc["stages"].set_index("stage").at["modeling", "slope"] - 0.5) < 1e-6
+assert abs(fc["cost_usd"] - want) < 1e-9 and fc["cost_usd_ci"][0] <= want
+assert abs(fc["decode_tokens_per_s"] - 100.0) < 1e-6
+assert abs(fc["wall_s"] - 5 * 16.0) < 1e-6          # 10 x 16 s on 2 workers
+assert forecast_run.makespan(np.array([3.0, 1.0, 1.0, 1.0]), 2) == 3.0
+# unknown types draw from every history instance: a real interval
+fc2 = forecast_run.forecast(cfg_f, targets_f.assign(type=None), hist_f,
+                            calls_f, n_sims=200)
+assert fc2["cost_usd_ci"][0] < fc2["cost_usd"] < fc2["cost_usd_ci"][1]
+print(f"  ${fc['cost_usd']:.4f} for 10 LP instances, wall {fc['wall_s']:.0f} s;"
+      f" any type: ${fc2['cost_usd_ci'][0]:.4f} - ${fc2['cost_usd_ci'][1]:.4f}")
+
+
+# --- adaptive retrieval k: table size x context budget, truncation logged --- #
+print("\n--- adaptive retrieval k ---")
+try:
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    cfg_k = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                           method="ADAPTIVE_K", dataset="Large-Scale-OR",
+                           out_dir=str(RUNS), log_prompts=False)
+    cfg_k.retrievers["data_nrm"] = {"k": "auto", "search": "bm25"}
+    cfg_k.retrievers["data_ra"] = {"k": "auto", "share": 1.0}
+    agent_spec = cfg_k.models["data_agent"]
+    agent_spec.context_window, agent_spec.output_reserve = 3000, 1000
+    big = lx.table_documents(pd.DataFrame({
+        "Product Name": [f"Product {i}" for i in range(400)],
+        "Revenue": range(400)}), source="big.csv")
+    small = big[:20]
+    emb_k = DeterministicFakeEmbedding(size=8)
+    log_k = lx.RunLogger(cfg_k)
+    with log_k.instance(instance_id=0, query="q") as rec_k:
+        r_big = lx.build_retriever(
+            cfg_k, lx.build_store(cfg_k, "data_nrm", big, emb_k), "data_nrm")
+        got_big = r_big.invoke("Product 7")
+        r_small = lx.build_retriever(
+            cfg_k, lx.build_store(cfg_k, "data_ra", small, emb_k), "data_ra")
+        got_small = r_small.invoke("Product 7")
+    log_k.close()
+    kb, ks = rec_k.extra["retrieval_k"]["data_nrm"], rec_k.extra["retrieval_k"]["data_ra"]
+    assert kb["budget_tokens"] == 500                   # (3000 - 1000) * 0.25
+    assert kb["k"] == int(500 // kb["row_tokens"]) and kb["truncated"], kb
+    assert kb["rows"] == 400 and len(got_big) == kb["k"]
+    assert ks == {**ks, "k": 20, "rows": 20, "truncated": False}, ks
+    assert len(got_small) == 20                         # the whole table fits
+    retr_k = [c["k"] for c in rec_k.calls if c["type"] == "retriever"]
+    assert retr_k == [kb["k"], 20], retr_k
+    line = json.loads((log_k.dir_path / "instances.jsonl").read_text()
+                      .splitlines()[-1])
+    assert line["retrieval_k"]["data_nrm"]["truncated"] is True
+    print(f"  data_nrm k={kb['k']} of {kb['rows']} rows "
+          f"({kb['row_tokens']} tokens/row), data_ra k={ks['k']}")
+except ImportError as e:
+    print(f"  skipped (langchain not installed here): {e}")
+
+
+# --- streaming: token timestamps, final-chunk usage, early tool start ------- #
+print("\n--- streaming / early tool start ---")
+try:
+    import threading
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessageChunk
+    from langchain_core.outputs import ChatGenerationChunk
+    from langchain_core.tools import Tool
+
+    class StreamingReAct(BaseChatModel):
+        """Streams a ReAct step the way ChatOpenAI does with stream_usage:
+        content chunks, one carrying finish_reason, then a usage-only chunk."""
+        streaming: bool = False
+        reply: str = ""
+        tail_s: float = 0.0
+
+        @property
+        def _llm_type(self):
+            return "streaming-react"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kw):
+            raise NotImplementedError
+
+        def _stream(self, messages, stop=None, run_manager=None, **kw):
+            words = self.reply.split(" ")
+            for i, w in enumerate(words):
+                last = i == len(words) - 1
+                yield ChatGenerationChunk(
+                    message=AIMessageChunk(content=w + ("" if last else " ")),
+                    generation_info={"finish_reason": "stop"} if last else None)
+                time.sleep(0.002)
+            time.sleep(self.tail_s)         # the usage chunk comes later
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content="", response_metadata={"model_name": "gpt-4.1-2025-04-14"},
+                usage_metadata={"input_tokens": 300, "output_tokens": 12,
+                                "total_tokens": 312}))
+
+    cfg_s = lx.load_config(HERE / "exp_config.yaml", model_profile="gpt-4.1",
+                           method="STREAM", dataset="Large-Scale-OR",
+                           out_dir=str(RUNS), log_prompts=False)
+    cfg_s.agent_early_tool_start = True
+    ran = []
+
+    def lookup(q):
+        ran.append((q, threading.current_thread().name))
+        return f"rows for {q}"
+
+    log_s = lx.RunLogger(cfg_s)
+    with log_s.instance(instance_id=0, query="q") as rec_s:
+        with lx.stage("data_retrieval"):
+            tools = lx.early_tools(cfg_s, [Tool(name="CSVQA", func=lookup,
+                                                description="rows")])
+            llm_s = StreamingReAct(streaming=True, callbacks=[lx.TRACKER],
+                                   tail_s=0.05, reply=(
+                'Thought: I need the rows\nAction: CSVQA\n'
+                'Action Input: "capacity of plant 3"'))
+            llm_s.invoke("go")
+            assert len(ran) == 1                    # started before the agent
+            out = tools[0].run("capacity of plant 3")
+            tools[0].run("something else")          # not speculated: runs now
+    log_s.close()
+    assert out == "rows for capacity of plant 3"
+    assert ran[0][1].startswith("leanopt-early-tool") and len(ran) == 2, ran
+    assert rec_s.extra["early_tool_hits"] == 1
+    assert rec_s.extra["early_tool_misses"] == 0
+    call = [c for c in rec_s.calls if c["type"] == "llm"][0]
+    assert call["streamed"] and call["token_source"] == "usage_metadata"
+    assert call["prompt_tokens"] == 300 and call["completion_tokens"] == 12
+    assert 0 < call["ttft_s"] <= call["last_token_s"] < call["latency_s"]
+    assert call["latency_s"] - call["last_token_s"] >= 0.04   # the usage tail
+    print(f"  ttft {call['ttft_s'] * 1e3:.1f} ms, last token "
+          f"{call['last_token_s'] * 1e3:.1f} ms, end {call['latency_s'] * 1e3:.1f} ms"
+          f", {call['stream_chunks']} chunks")
+except ImportError as e:
+    print(f"  skipped (langchain not installed here): {e}")
+
+
+# --- model cascade: cheap first, escalation signals, cost per path --------- #
+print("\n--- model cascade ---")
+try:
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+
+    class Scripted(BaseChatModel):
+        """Answers from a list, reporting usage under a fixed model id."""
+        model: str
+        replies: list
+
+        @property
+        def _llm_type(self):
+            return "scripted"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kw):
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(
+                content=self.replies.pop(0),
+                response_metadata={"model_name": self.model},
+                usage_metadata={"input_tokens": 1000, "output_tokens": 100,
+                                "total_tokens": 1100}))])
+
+    cfg_c = lx.load_config(HERE / "exp_config.yaml",
+                           model_profile="gpt-4.1-cascade", method="CASCADE",
+                           dataset="Large-Scale-OR", out_dir=str(RUNS),
+                           log_prompts=False)
+    lx.TRACKER.bind(cfg_c)
+    mini = lx.cascade_first(cfg_c.spec("modeler")).model
+    big_model = cfg_c.spec("modeler").model
+
+    def cascade(role, cheap, strong, **triggers):
+        spec = cfg_c.spec(role)
+        return lx._cascade_cls()(
+            first=Scripted(model=mini, replies=cheap, callbacks=[lx.TRACKER]),
+            strong=Scripted(model=big_model, replies=strong,
+                            callbacks=[lx.TRACKER]),
+            role=role, cache=False, metadata={lx._CASCADE_MARK: role},
+            triggers={**lx.cascade_triggers(cfg_c, spec), **triggers})
+
+    react = ["\nObservation:"]
+    log_c = lx.RunLogger(cfg_c)
+    with log_c.instance(instance_id=0, query="q") as rec0:
+        agent = cascade("data_agent", ["I am not sure."], ["Final Answer: 3",
+                                                            "Final Answer: 4"])
+        assert agent.invoke("go", stop=react).content == "Final Answer: 3"
+        assert agent.invoke("again", stop=react).content == "Final Answer: 4"
+        coder = cascade("coder", ["```python\nx = [1,\n```"],
+                        ["```python\nx = [1]\n```"])
+        assert coder.invoke("code").content.endswith("[1]\n```")
+        lx.CASCADE.knn(rec0, cfg_c, 0.1)              # a close kNN vote
+    with log_c.instance(instance_id=1, query="q") as rec1:
+        modeler = cascade("modeler", ["Let x be the flow."], [])
+        assert modeler.invoke("model").content == "Let x be the flow."
+    with log_c.instance(instance_id=2, query="q") as rec2:
+        steps = cascade("data_agent", ["Action: CSVQA\nAction Input: a"] * 2,
+                        ["Final Answer: 5"], iteration_limit=2)
+        for _ in range(3):
+            out = steps.invoke("step", stop=react)
+        assert out.content == "Final Answer: 5"       # third step: strong
+    with log_c.instance(instance_id=3, query="q") as rec3:
+        # two data agents of one instance, each a step short of the limit:
+        # steps are counted per AgentExecutor run, not summed across them
+        from langchain_core.runnables import RunnableLambda
+        runs = cascade("data_agent", ["Action: CSVQA\nAction Input: a"] * 2,
+                       [], iteration_limit=2)
+        executor = RunnableLambda(
+            lambda x: runs.invoke(x, stop=react)).with_config(
+                run_name="AgentExecutor", callbacks=[lx.TRACKER])
+        executor.invoke("agent one")
+        executor.invoke("agent two")
+    log_c.close()
+    assert rec3.extra["cascade"]["data_agent"] == {
+        "first_calls": 2, "strong_calls": 0, "escalated_by": None}
+
+    c0 = rec0.extra["cascade"]
+    assert c0["data_agent"] == {"first_calls": 1, "strong_calls": 2,
+                                "escalated_by": "parse_failure"}, c0
+    assert c0["coder"]["escalated_by"] == "code_compile"
+    assert c0["classifier"]["escalated_by"] == "knn_margin"
+    assert rec0.extra["cascade_path"] == "escalated"
+    assert rec1.extra == {**rec1.extra, "cascade_path": "first"}
+    assert rec1.extra["cascade"]["modeler"]["strong_calls"] == 0
+    assert rec2.extra["cascade"]["data_agent"]["escalated_by"] == "iteration_limit"
+    llm0 = [c for c in rec0.calls if c["type"] == "llm"]
+    assert len(llm0) == 5                             # no call for the wrapper
+    cheap_cost = (1000 * 0.40 + 100 * 1.60) / 1e6
+    assert abs(llm0[0]["cost_usd"] - cheap_cost) < 1e-12, llm0[0]
+    assert abs(rec1.summary()["cost_usd"] - cheap_cost) < 1e-12
+    df_c = aggregate_runs.load_instances(log_c.dir_path)
+    ct_c = aggregate_runs.cost_table(aggregate_runs.attach_gold(df_c, None))
+    assert abs(ct_c["cascade_escalated_%"].iloc[0] - 50) < 1e-3
+
+    # the cached model object follows the triggers derived outside the spec
+    import os
+    had_key = "OPENAI_API_KEY" in os.environ
+    os.environ.setdefault("OPENAI_API_KEY", "sk-smoke")   # never sent
+    lx.clear_clients()
+    m_c = lx.build_llm(cfg_c, "data_agent")
+    assert lx.build_llm(cfg_c, "data_agent") is m_c
+    cfg_c.agent_max_iterations += 4
+    m_c2 = lx.build_llm(cfg_c, "data_agent")
+    assert m_c2 is not m_c
+    assert m_c2.triggers["iteration_limit"] == m_c.triggers["iteration_limit"] + 4
+    cfg_c.classification = {**cfg_c.classification, "knn": {
+        **(cfg_c.classification.get("knn") or {}), "min_margin": 0.9}}
+    assert lx.build_llm(cfg_c, "data_agent").triggers["knn_margin"] == 0.9
+    lx.clear_clients()
+    if not had_key:
+        del os.environ["OPENAI_API_KEY"]
+    print(f"  escalated: {c0['data_agent']['escalated_by']}, "
+          f"{c0['coder']['escalated_by']}, {c0['classifier']['escalated_by']}, "
+          f"{rec2.extra['cascade']['data_agent']['escalated_by']}; "
+          f"{ct_c['cascade_escalated_%'].iloc[0]:.1f}% of instances")
+except ImportError as e:
+    print(f"  skipped (langchain not installed here): {e}")